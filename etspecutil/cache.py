@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+import os
+import stat
+import shutil
+import hashlib
+import logging
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+READ_ONLY = stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH
+
+
+def get_key(parts):
+    """Gets cache key for list of `parts`, such as a stage name, hashes
+       of input files and parameters, that determine what a stage writes
+       :returns: hex sha256 digest of the string form of `parts`
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def _link_or_copy(src, dest):
+    """Hard links `src` to `dest` replacing `dest` if it exists. Falls
+       back to a copy when a hard link is not possible, such as when
+       `src` and `dest` are on different file systems
+    """
+    if os.path.lexists(dest):
+        os.remove(dest)
+    try:
+        os.link(src, dest)
+    except (OSError, AttributeError):
+        shutil.copy2(src, dest)
+
+
+class ContentCache(object):
+    """Local content addressed cache of files written by a stage
+
+       An entry holds the output files of one stage run under a key
+       made by `get_key` from everything the outputs depend on, so the
+       entry is valid for any run with the same key no matter where
+       its output directory is. Files are hard linked in and out of the
+       cache when possible so reusing an entry costs no disk space or
+       copying. Files are named by position in an entry and not by
+       their original name.
+
+       Entries are built in a temporary directory and renamed into
+       place so a crash or a concurrent run never leaves a partial
+       entry. Since cached files share their inode with the files
+       linked out of the cache, callers must remove an output file
+       instead of writing over it, `fetch` and `store` do this already.
+       Cached files are made read only so a program that opens a
+       linked file for writing fails instead of corrupting the entry.
+       An entry can also hold the sha256 hash of each of its files so
+       files put in place from the cache do not need to be hashed.
+    """
+    DIGESTS_FILE = 'sha256'
+
+    def __init__(self, cachedir):
+        """Constructor
+        :param cachedir: directory of the cache, created on first store
+        """
+        self._cachedir = cachedir
+
+    def get_cache_dir(self):
+        return self._cachedir
+
+    def get_entry_dir(self, key):
+        """Gets directory of entry `key`
+        """
+        return os.path.join(self._cachedir, key[:2], key)
+
+    def has_entry(self, key):
+        """Checks if cache has an entry for `key`
+        """
+        return os.path.isdir(self.get_entry_dir(key))
+
+    def fetch(self, key, paths):
+        """Links or copies the files of entry `key` to `paths`
+        :param paths: list of destination paths in the order they were
+                      passed to `store`
+        :returns: True if the entry exists and its files were put in
+                  place otherwise False
+        """
+        entrydir = self.get_entry_dir(key)
+        if not os.path.isdir(entrydir):
+            return False
+        sources = [os.path.join(entrydir, str(pos))
+                   for pos in range(len(paths))]
+        for src in sources:
+            if not os.path.isfile(src):
+                logger.warning('Ignoring cache entry ' + entrydir +
+                               ' missing file ' + src)
+                return False
+        for (src, dest) in zip(sources, paths):
+            destdir = os.path.dirname(dest)
+            if destdir != '' and not os.path.isdir(destdir):
+                os.makedirs(destdir)
+            _link_or_copy(src, dest)
+        logger.debug('Reused cache entry ' + entrydir)
+        return True
+
+    def get_digests(self, key):
+        """Gets sha256 hashes stored with entry `key`
+        :returns: list of hex digests in the order of the files passed
+                  to `store` or None if the entry has no hashes
+        """
+        path = os.path.join(self.get_entry_dir(key),
+                            ContentCache.DIGESTS_FILE)
+        if not os.path.isfile(path):
+            return None
+        f = open(path, 'r')
+        try:
+            return f.read().split()
+        finally:
+            f.close()
+
+    def store(self, key, paths, digests=None):
+        """Adds the files in `paths` to the cache as entry `key`. Does
+           nothing if the entry already exists. The files in `paths` are
+           made read only when they are hard linked into the cache
+        :param digests: list of sha256 hex digests of the files in
+                        `paths` to keep with the entry or None
+        """
+        entrydir = self.get_entry_dir(key)
+        if os.path.isdir(entrydir):
+            return
+        parent = os.path.dirname(entrydir)
+        if not os.path.isdir(parent):
+            try:
+                os.makedirs(parent)
+            except OSError:
+                if not os.path.isdir(parent):
+                    raise
+        tmpdir = tempfile.mkdtemp(prefix='.tmp', dir=parent)
+        try:
+            for (pos, path) in enumerate(paths):
+                dest = os.path.join(tmpdir, str(pos))
+                _link_or_copy(path, dest)
+                os.chmod(dest, READ_ONLY)
+            if digests is not None:
+                f = open(os.path.join(tmpdir, ContentCache.DIGESTS_FILE),
+                         'w')
+                try:
+                    f.write('\n'.join(digests) + '\n')
+                finally:
+                    f.close()
+            os.rename(tmpdir, entrydir)
+        except OSError:
+            if not os.path.isdir(entrydir):
+                raise
+            # another run stored the same entry first
+        finally:
+            if os.path.isdir(tmpdir):
+                shutil.rmtree(tmpdir)
+        logger.debug('Stored cache entry ' + entrydir)
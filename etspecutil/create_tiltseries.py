@@ -3,9 +3,9 @@
 import sys
 import argparse
 import logging
-import multiprocessing
 
 import etspecutil
+from etspecutil import util
 from etspecutil.tiltseries import TiltSeriesCreator
 
 logger = logging.getLogger(__name__)
@@ -39,6 +39,7 @@ def _setup_logging(theargs):
     logging.basicConfig(format=theargs.logformat)
     logging.getLogger('etspecutil.marker').setLevel(theargs.numericloglevel)
     logging.getLogger('etspecutil.util').setLevel(theargs.numericloglevel)
+    logging.getLogger('etspecutil.imod').setLevel(theargs.numericloglevel)
     logging.getLogger('etspecutil.tiltseries').\
         setLevel(theargs.numericloglevel)
 
@@ -48,13 +49,7 @@ def create_tiltseries(theargs):
     """
     logger.info('Creating tilt series')
     if theargs.cores is None:
-        try:
-            cpucount = multiprocessing.cpu_count()
-        except NotImplementedError:
-            logger.exception('Unable to obtain cpu count from '
-                             'multiprocessing.cpu_count() defaulting to 1')
-            cpucount = 1
-        theargs.cores = cpucount
+        theargs.cores = util.get_cpu_count()
 
     logger.debug('Cores to use set to ' + str(theargs.cores))
     ts = TiltSeriesCreator(theargs)
@@ -122,10 +117,22 @@ def _parse_arguments(desc, args):
                              'for processing.  (default is number'
                              'of cores on machine or 1 if unable'
                              'to determine core count)')
+    parser.add_argument("--parallelrotations", default=1, type=int,
+                        help='Number of rotations to generate tilt series '
+                             'for at the same time. The --cores are split '
+                             'evenly between them (default 1)')
     parser.add_argument("--etspecbin", default='',
                         help='Sets directory where ET-SPEC/ETPhantom binaries '
                              'reside'
                              '(default empty string)')
+    parser.add_argument("--cachedir", default='',
+                        help='Directory of cache shared between runs of '
+                             'the all_255, extend_mean, rawtlt and '
+                             'warpZ_inter_del outputs, which only depend on '
+                             'the input MRC file and the tilt range. Runs '
+                             'that differ in other parameters reuse them. '
+                             'Clear it when the ET-SPEC binaries change '
+                             '(default empty string which disables cache)')
     parser.add_argument("--log", dest="loglevel", default='WARNING',
                         choices=['DEBUG', 'INFO', 'WARNING', 'ERROR',
                                  'CRITICAL'],
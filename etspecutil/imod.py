@@ -0,0 +1,442 @@
+# -*- coding: utf-8 -*-
+
+import math
+import struct
+import shutil
+import logging
+
+import numpy
+
+logger = logging.getLogger(__name__)
+
+
+class UnsupportedIMODModelError(Exception):
+    """Raised when a model file is not a binary V1.2 IMOD model or uses
+       a chunk type the native reader does not understand
+    """
+    pass
+
+
+class InvalidIMODModelError(Exception):
+    """Raised when a binary IMOD model file is truncated or corrupt
+    """
+    pass
+
+
+class IMODModelReader(object):
+    """Reads points from binary IMOD model files (ie .fid files) without
+       invoking model2point
+
+       The file is made up of chunks each starting with a 4 character
+       id. IMOD, OBJT, CONT and MESH chunks have fixed size headers.
+       All other chunks are followed by their size in bytes and are
+       skipped if they are in `SIZED_CHUNK_IDS`. All values are big
+       endian.
+    """
+    MAGIC = b'IMODV1.2'
+    MODEL_HEADER_SIZE = 232
+    OBJECT_HEADER_SIZE = 176
+    CONTOUR_HEADER_SIZE = 16
+    MESH_HEADER_SIZE = 16
+    FLIPYZ_FLAG = 1 << 16
+    OBJT_ID = b'OBJT'
+    CONT_ID = b'CONT'
+    MESH_ID = b'MESH'
+    IEOF_ID = b'IEOF'
+    SIZED_CHUNK_IDS = (b'SIZE', b'IMAT', b'VIEW', b'MINX', b'MOST',
+                       b'OBST', b'COST', b'MEST', b'SLAN', b'CLIP',
+                       b'MCLP', b'MEPA', b'OGRP', b'LABL', b'OLBL',
+                       b'REFI')
+
+    def __init__(self, modelfile):
+        self._modelfile = modelfile
+
+    def get_model_file(self):
+        """Returns path to IMOD model file
+        """
+        return self._modelfile
+
+    def set_model_file(self, modelfile):
+        """Sets IMOD model file
+        """
+        self._modelfile = modelfile
+
+    def get_points(self):
+        """Gets points in model
+
+           Contours are numbered from 1 within each object the same
+           way `model2point -contour` numbers them.
+
+           :raises UnsupportedIMODModelError: if file is not a binary
+                   V1.2 IMOD model or has chunks this reader does not
+                   understand
+           :raises InvalidIMODModelError: if file is truncated
+           :returns: tuple of numpy arrays (indexes, xs, ys, zs) where
+                     indexes holds the contour number of each point
+        """
+        indexes = []
+        points = []
+        f = open(self._modelfile, 'rb')
+        try:
+            for (contour_num, offset, pts) in self._iter_contours(f, True):
+                indexes.append(numpy.repeat(numpy.int64(contour_num),
+                                            len(pts)))
+                points.append(pts)
+        finally:
+            f.close()
+
+        if len(points) == 0:
+            return (numpy.empty(0, dtype=numpy.int64),
+                    numpy.empty(0), numpy.empty(0), numpy.empty(0))
+        pts = numpy.concatenate(points).astype(numpy.float64)
+        return (numpy.concatenate(indexes), pts[:, 0].copy(),
+                pts[:, 1].copy(), pts[:, 2].copy())
+
+    def iter_contours(self):
+        """Generator that reads the model one contour at a time so
+           models larger than memory can be processed
+
+           Contours are numbered from 1 within each object the same
+           way `model2point -contour` numbers them.
+
+           :raises UnsupportedIMODModelError: if file is not a binary
+                   V1.2 IMOD model or has chunks this reader does not
+                   understand
+           :raises InvalidIMODModelError: if file is truncated
+           :returns: yields (contour number, points) tuples where points
+                     is a float64 numpy array of shape (N, 3) holding x,
+                     y, z of each point
+        """
+        f = open(self._modelfile, 'rb')
+        try:
+            for (contour_num, offset, pts) in self._iter_contours(f, True):
+                yield contour_num, pts.astype(numpy.float64)
+        finally:
+            f.close()
+
+    def get_point_offsets(self, meshes=None):
+        """Gets location of the point data of every contour without
+           reading the points themselves
+
+           :param meshes: list the byte offset of every MESH chunk is
+                          appended to
+           :raises UnsupportedIMODModelError: if file is not a binary
+                   V1.2 IMOD model or has chunks this reader does not
+                   understand
+           :raises InvalidIMODModelError: if file is truncated
+           :returns: list of (byte offset, number of points) tuples
+        """
+        offsets = []
+        f = open(self._modelfile, 'rb')
+        try:
+            for (contour_num, offset, psize) in self._iter_contours(
+                    f, False, meshes):
+                offsets.append((offset, psize))
+        finally:
+            f.close()
+        return offsets
+
+    def get_contour_numbers(self):
+        """Gets the number of every contour, in file order, without
+           reading the points
+
+           :raises UnsupportedIMODModelError: if file is not a binary
+                   V1.2 IMOD model or has chunks this reader does not
+                   understand
+           :raises InvalidIMODModelError: if file is truncated
+           :returns: list of contour numbers
+        """
+        f = open(self._modelfile, 'rb')
+        try:
+            return [contour_num for (contour_num, offset, psize)
+                    in self._iter_contours(f, False)]
+        finally:
+            f.close()
+
+    def _iter_contours(self, f, read_points, meshes=None):
+        """Walks chunks in model file `f` yielding a tuple for each
+           contour of (contour number, byte offset of point data,
+           points) where points is a (N, 3) big endian float32 array
+           if `read_points` is True otherwise the number of points
+        :param meshes: list the byte offset of every MESH chunk is
+                       appended to or None
+        """
+        self._read_model_header(f)
+        contour_num = 0
+        while True:
+            chunk_id = _read_exact(f, 4)
+            if chunk_id == IMODModelReader.IEOF_ID:
+                break
+            if chunk_id == IMODModelReader.OBJT_ID:
+                _read_exact(f, IMODModelReader.OBJECT_HEADER_SIZE)
+                contour_num = 0
+            elif chunk_id == IMODModelReader.CONT_ID:
+                contour_num += 1
+                psize = self._read_contour_header(f)
+                offset = f.tell()
+                if read_points:
+                    yield contour_num, offset, self._read_points(f, psize)
+                else:
+                    _skip(f, psize * 12)
+                    yield contour_num, offset, psize
+            elif chunk_id == IMODModelReader.MESH_ID:
+                if meshes is not None:
+                    meshes.append(f.tell() - 4)
+                self._skip_mesh(f)
+            elif chunk_id in IMODModelReader.SIZED_CHUNK_IDS:
+                size = struct.unpack('>i', _read_exact(f, 4))[0]
+                _skip(f, size)
+            else:
+                raise UnsupportedIMODModelError('Unsupported chunk ' +
+                                                repr(chunk_id) +
+                                                ' in ' +
+                                                self._modelfile)
+
+    def _read_model_header(self, f):
+        """Reads and validates magic and model header
+        """
+        magic = f.read(len(IMODModelReader.MAGIC))
+        if magic != IMODModelReader.MAGIC:
+            raise UnsupportedIMODModelError(self._modelfile + ' is not a '
+                                            'binary V1.2 IMOD model')
+        header = _read_exact(f, IMODModelReader.MODEL_HEADER_SIZE)
+        flags = struct.unpack_from('>I', header, 144)[0]
+        if flags & IMODModelReader.FLIPYZ_FLAG:
+            raise UnsupportedIMODModelError(self._modelfile + ' has Y and '
+                                            'Z flipped')
+
+    def _read_contour_header(self, f):
+        """Reads contour header
+           :returns: number of points in contour
+        """
+        header = _read_exact(f, IMODModelReader.CONTOUR_HEADER_SIZE)
+        psize = struct.unpack_from('>i', header)[0]
+        if psize < 0:
+            raise InvalidIMODModelError('Negative point count in contour')
+        return psize
+
+    def _read_points(self, f, psize):
+        """Reads `psize` points
+           :returns: numpy big endian float32 array of shape (N, 3)
+        """
+        data = _read_exact(f, psize * 12)
+        return numpy.frombuffer(data, dtype='>f4').reshape(psize, 3)
+
+    def _skip_mesh(self, f):
+        """Skips over mesh chunk
+        """
+        header = _read_exact(f, IMODModelReader.MESH_HEADER_SIZE)
+        vsize, lsize = struct.unpack_from('>ii', header)
+        _skip(f, vsize * 12 + lsize * 4)
+
+
+class IMODModelWriter(object):
+    """Writes points to a binary IMOD model file (ie .fid file)
+       without invoking point2model
+
+       All points go into a single closed contour object with one
+       contour per distinct index, mirroring what
+       `point2model -circle <size>` produces.
+    """
+    # IMOD object symbol type, 0 is circle and 1 is none
+    CIRCLE_SYMBOL = 0
+
+    def __init__(self, modelfile):
+        self._modelfile = modelfile
+        self._circle_size = 6
+
+    def get_model_file(self):
+        """Returns path to IMOD model file
+        """
+        return self._modelfile
+
+    def set_model_file(self, modelfile):
+        """Sets IMOD model file
+        """
+        self._modelfile = modelfile
+
+    def get_circle_size(self):
+        """Returns size of circle drawn at each point
+        """
+        return self._circle_size
+
+    def set_circle_size(self, circle_size):
+        """Sets size of circle drawn at each point
+        """
+        self._circle_size = circle_size
+
+    def write_points(self, indexes, xs, ys, zs):
+        """Writes points to model file with one contour per
+           distinct value in `indexes`. Contours are written in
+           ascending index order and points keep their relative order
+           within each contour.
+
+           :param indexes: int array of contour index for each point
+           :param xs: array of x values
+           :param ys: array of y values
+           :param zs: array of z values
+        """
+        indexes = numpy.asarray(indexes)
+        order = numpy.argsort(indexes, kind='mergesort')
+        sorted_indexes = indexes[order]
+        starts = numpy.flatnonzero(numpy.diff(sorted_indexes)) + 1
+        offsets = [0] + starts.tolist() + [len(order)]
+        if len(order) == 0:
+            offsets = [0]
+        self.write_contours(numpy.asarray(xs)[order],
+                            numpy.asarray(ys)[order],
+                            numpy.asarray(zs)[order], offsets)
+
+    def write_contours(self, xs, ys, zs, offsets):
+        """Writes points that are already grouped by contour to model
+           file as a single object
+
+           :param xs: array of x values
+           :param ys: array of y values
+           :param zs: array of z values
+           :param offsets: sequence with one more element than there are
+                           contours where points of the Nth contour are
+                           at positions offsets[N] to offsets[N + 1]
+        """
+        offsets = [int(offset) for offset in offsets]
+        self.write_contour_iter([(xs[offsets[pos]:offsets[pos + 1]],
+                                  ys[offsets[pos]:offsets[pos + 1]],
+                                  zs[offsets[pos]:offsets[pos + 1]])
+                                 for pos in range(len(offsets) - 1)])
+
+    def write_contour_iter(self, contours):
+        """Writes contours to model file as a single object one at a
+           time so memory use only depends on the size of the largest
+           contour. The model and object headers hold the point maximums
+           and the contour count, they are written as placeholders and
+           filled in once all contours are written
+
+           :param contours: iterable of (xs, ys, zs) tuples of arrays,
+                            one per contour
+        """
+        maxes = None
+        num_contours = 0
+        f = open(self._modelfile, 'wb')
+        try:
+            f.write(IMODModelReader.MAGIC)
+            model_header_pos = f.tell()
+            f.write(self._get_model_header(None))
+            f.write(IMODModelReader.OBJT_ID)
+            object_header_pos = f.tell()
+            f.write(self._get_object_header(0))
+            for (xs, ys, zs) in contours:
+                points = numpy.empty((len(xs), 3), dtype='>f4')
+                points[:, 0] = xs
+                points[:, 1] = ys
+                points[:, 2] = zs
+                if len(points) > 0:
+                    if maxes is None:
+                        maxes = points.max(axis=0)
+                    else:
+                        maxes = numpy.maximum(maxes, points.max(axis=0))
+                f.write(IMODModelReader.CONT_ID +
+                        struct.pack('>iIii', len(points), 0, 0, 0))
+                f.write(points.tobytes())
+                num_contours += 1
+            f.write(IMODModelReader.IEOF_ID)
+            f.seek(model_header_pos)
+            f.write(self._get_model_header(maxes))
+            f.seek(object_header_pos)
+            f.write(self._get_object_header(num_contours))
+        finally:
+            f.close()
+
+    def _get_model_header(self, maxes):
+        """Gets model header with image size set from the maximum
+           point coordinates
+        :param maxes: maximum x, y, z of points or None if there are
+                      no points
+        """
+        if maxes is None:
+            maxes = [1, 1, 1]
+        else:
+            maxes = [max(1, int(math.ceil(v))) for v in maxes.tolist()]
+        name = b'IMOD-NewModel'
+        return struct.pack('>128s3iiI4i3f3f3i2ifii3f',
+                           name, maxes[0], maxes[1], maxes[2],
+                           1, 0, 1, 1, 0, 255,
+                           0.0, 0.0, 0.0,
+                           1.0, 1.0, 1.0,
+                           0, -1, -1,
+                           3, 128, 1.0, 0, 0,
+                           0.0, 0.0, 0.0)
+
+    def _get_object_header(self, num_contours):
+        """Gets object header for circle symbol, closed contour object
+        """
+        return struct.pack('>64s64siIii3fi8Bii', b'', b'',
+                           num_contours, 0, 0, 1,
+                           0.0, 1.0, 0.0, 0,
+                           IMODModelWriter.CIRCLE_SYMBOL,
+                           int(self._circle_size), 1, 1, 0, 0, 0, 0,
+                           0, 0)
+
+
+def copy_and_shift_points(inputfile, outputfile, xshift, yshift):
+    """Copies binary IMOD model `inputfile` to `outputfile` and then
+       adds `xshift` and `yshift` to every point by patching the big
+       endian float data of each contour through a memory map of the
+       copy. The image size in the model header is set from the largest
+       shifted x and y the same way `IMODModelWriter` sets it. All
+       other model data is left untouched.
+
+       :raises UnsupportedIMODModelError: if `inputfile` cannot be
+               patched, such as when it has meshes whose vertices
+               would no longer match the shifted contours, in which
+               case `outputfile` is not created
+       :raises InvalidIMODModelError: if `inputfile` is truncated
+    """
+    meshes = []
+    offsets = IMODModelReader(inputfile).get_point_offsets(meshes)
+    if len(meshes) > 0:
+        raise UnsupportedIMODModelError(inputfile + ' has ' +
+                                        str(len(meshes)) + ' mesh(es) '
+                                        'which cannot be patched')
+    shutil.copyfile(inputfile, outputfile)
+    contours = [(offset, psize) for (offset, psize) in offsets
+                if psize > 0]
+    if len(contours) == 0:
+        return
+
+    data = numpy.memmap(outputfile, dtype=numpy.uint8, mode='r+')
+    try:
+        # each contour is patched through a strided view of its own
+        # point block, which need not be 4 byte aligned, so memory use
+        # does not grow with the number of points
+        xmax = float('-inf')
+        ymax = float('-inf')
+        for (offset, psize) in contours:
+            pts = data[offset:offset + psize * 12].view('>f4')
+            pts[0::3] += xshift
+            pts[1::3] += yshift
+            xmax = max(xmax, float(pts[0::3].max()))
+            ymax = max(ymax, float(pts[1::3].max()))
+        header = data[len(IMODModelReader.MAGIC) + 128:
+                      len(IMODModelReader.MAGIC) + 136].view('>i4')
+        header[0] = max(1, int(math.ceil(xmax)))
+        header[1] = max(1, int(math.ceil(ymax)))
+        data.flush()
+    finally:
+        del data
+
+
+def _skip(f, size):
+    """Seeks `size` bytes forward in `f`. Seeking past the end is
+       caught by the next `_read_exact` call
+    """
+    f.seek(size, 1)
+
+
+def _read_exact(f, size):
+    """Reads exactly `size` bytes from `f`
+       :raises InvalidIMODModelError: if fewer bytes are available
+    """
+    data = f.read(size)
+    if len(data) != size:
+        raise InvalidIMODModelError('Unexpected end of IMOD model file')
+    return data
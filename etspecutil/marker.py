@@ -2,14 +2,21 @@
 
 import math
 import re
+import itertools
 import logging
+import warnings
 import tempfile
 import shutil
 import os.path
 
-logger = logging.getLogger(__name__)
+import numpy
 
 from etspecutil import util
+from etspecutil.imod import IMODModelReader
+from etspecutil.imod import IMODModelWriter
+from etspecutil.imod import UnsupportedIMODModelError
+
+logger = logging.getLogger(__name__)
 
 
 class InvalidAngleError(Exception):
@@ -32,18 +39,291 @@ class UnsetMarkersListError(Exception):
 
 class MarkersList(object):
     """Represents a set of markers
+
+       Markers are stored column wise in numpy arrays. The index
+       is kept in an int64 array and x, y, z are kept in float64
+       arrays so a marker costs 32 bytes instead of a python object
+       per point. The arrays are grown geometrically as markers are
+       added so `add_marker` is amortized constant time.
+
+       Coordinates set to `None` are stored as NaN and an index set
+       to `None` is stored as `NO_INDEX`
+
+       Rotations, shifts and scalings added via `add_rotation`,
+       `add_shift`, `add_scale` and `add_transform` are not applied
+       right away. Instead they are composed into a single pending 3x3
+       homogeneous matrix that is applied to x and y in one pass the
+       next time the coordinates are accessed, written or modified.
+       A different transform per slice (tilt) can be applied with
+       `apply_slice_transforms`.
+
+       In compact mode x, y, z are kept in float32 arrays which halves
+       the memory of the coordinates. Each stored value then differs
+       from the value it was set to by at most `COMPACT_ERROR` times
+       its magnitude, which is half a float32 unit in the last place.
+       For coordinates below 2048 that is at most 1.2e-4 so the
+       `%11f` output of `write_markers_to_file` matches that of a
+       double precision list to within 1.2e-4 plus 1e-6 of rounding.
+       Integral values below 2**24, such as tilt numbers, are exact.
+       Transforms are computed in double precision but each time they
+       are applied the result is rounded to float32 again.
     """
-    def __init__(self):
-        self._markers = []
+    NO_INDEX = numpy.iinfo(numpy.int64).min
+    COMPACT_ERROR = 2.0 ** -24
+    INITIAL_CAPACITY = 16
+    WRITE_CHUNK_SIZE = 65536
+    LINE_FORMAT = '%6d %11f %11f %11f\n'
+
+    def __init__(self, compact=False):
+        """Constructor
+        :param compact: if True coordinates are stored as float32
+        """
+        if compact is True:
+            dtype = numpy.float32
+        else:
+            dtype = numpy.float64
+        self._count = 0
+        self._index = numpy.empty(0, dtype=numpy.int64)
+        self._x = numpy.empty(0, dtype=dtype)
+        self._y = numpy.empty(0, dtype=dtype)
+        self._z = numpy.empty(0, dtype=dtype)
+        self._transform = None
+
+    def __len__(self):
+        return self._count
+
+    def is_compact(self):
+        """Returns True if coordinates are stored as float32
+        """
+        return self._x.dtype == numpy.float32
+
+    def _ensure_capacity(self, capacity):
+        """Grows storage arrays so they can hold at least
+           `capacity` markers
+        """
+        cur_capacity = len(self._index)
+        if capacity <= cur_capacity:
+            return
+        new_capacity = max(capacity, cur_capacity * 2,
+                           MarkersList.INITIAL_CAPACITY)
+        self._index = self._grow_array(self._index, new_capacity)
+        self._x = self._grow_array(self._x, new_capacity)
+        self._y = self._grow_array(self._y, new_capacity)
+        self._z = self._grow_array(self._z, new_capacity)
+
+    def _grow_array(self, array, capacity):
+        """Returns copy of `array` resized to `capacity` elements
+        """
+        new_array = numpy.empty(capacity, dtype=array.dtype)
+        new_array[:self._count] = array[:self._count]
+        return new_array
 
     def add_marker(self, index, x, y, z):
-        self._markers.append(Marker(index, x, y, z))
+        self.apply_transforms()
+        self._ensure_capacity(self._count + 1)
+        pos = self._count
+        if index is None:
+            self._index[pos] = MarkersList.NO_INDEX
+        else:
+            self._index[pos] = index
+        self._x[pos] = _none_to_nan(x)
+        self._y[pos] = _none_to_nan(y)
+        self._z[pos] = _none_to_nan(z)
+        self._count += 1
+
+    def add_markers(self, indexes, xs, ys, zs):
+        """Appends markers in bulk
+
+           :param indexes: sequence or array of integer indexes
+           :param xs: sequence or array of x values
+           :param ys: sequence or array of y values
+           :param zs: sequence or array of z values
+           :raises ValueError: if the parameters differ in length
+        """
+        indexes = numpy.asarray(indexes, dtype=numpy.int64).ravel()
+        xs = numpy.asarray(xs, dtype=numpy.float64).ravel()
+        ys = numpy.asarray(ys, dtype=numpy.float64).ravel()
+        zs = numpy.asarray(zs, dtype=numpy.float64).ravel()
+        num = len(indexes)
+        if len(xs) != num or len(ys) != num or len(zs) != num:
+            raise ValueError('indexes, xs, ys, and zs must be the same '
+                             'length')
+        self.apply_transforms()
+        self._ensure_capacity(self._count + num)
+        end = self._count + num
+        self._index[self._count:end] = indexes
+        self._x[self._count:end] = xs
+        self._y[self._count:end] = ys
+        self._z[self._count:end] = zs
+        self._count = end
+
+    def get_indexes(self):
+        """Returns view of the marker indexes as an int64 array
+        """
+        return self._index[:self._count]
+
+    def get_x(self):
+        """Returns view of the marker x values as a float array which
+           is float32 if the list is compact
+        """
+        self.apply_transforms()
+        return self._x[:self._count]
+
+    def get_y(self):
+        """Returns view of the marker y values as a float array
+        """
+        self.apply_transforms()
+        return self._y[:self._count]
+
+    def get_z(self):
+        """Returns view of the marker z values as a float array
+        """
+        return self._z[:self._count]
+
+    def get_valid_mask(self):
+        """Returns boolean array that is False for markers with any
+           field set to `None`
+        """
+        mask = self.get_indexes() != MarkersList.NO_INDEX
+        mask &= ~numpy.isnan(self.get_x())
+        mask &= ~numpy.isnan(self.get_y())
+        mask &= ~numpy.isnan(self.get_z())
+        return mask
 
     def get_markers(self):
-        return self._markers
+        """Returns markers as a list of `Marker` objects
+
+           The `Marker` objects are copies so changes made to them
+           are not reflected in this object
+        """
+        markers = []
+        for index, x, y, z in zip(self.get_indexes().tolist(),
+                                  self.get_x().tolist(),
+                                  self.get_y().tolist(),
+                                  self.get_z().tolist()):
+            if index == MarkersList.NO_INDEX:
+                index = None
+            markers.append(Marker(index, _nan_to_none(x),
+                                  _nan_to_none(y), _nan_to_none(z)))
+        return markers
 
     def clear_markers(self):
-        del self._markers[:]
+        self._count = 0
+        self._transform = None
+
+    def add_transform(self, matrix):
+        """Appends 3x3 homogeneous `matrix` to the pending transform
+           chain. The matrix is applied after any transforms already
+           in the chain
+
+           :param matrix: 3x3 matrix that maps column vector (x, y, 1)
+           :raises ValueError: if `matrix` is not 3x3
+        """
+        matrix = numpy.asarray(matrix, dtype=numpy.float64)
+        if matrix.shape != (3, 3):
+            raise ValueError('matrix must be 3x3 not ' + str(matrix.shape))
+        if self._transform is None:
+            self._transform = matrix.copy()
+        else:
+            self._transform = numpy.dot(matrix, self._transform)
+
+    def add_rotation(self, angle, xoffset, yoffset):
+        """Appends counter clockwise rotation by `angle` degrees about
+           (`xoffset`, `yoffset`) to the pending transform chain
+        """
+        if angle is None:
+            raise InvalidAngleError('Angle passed cannot be None')
+        self.add_transform(get_rotation_matrix(angle, xoffset, yoffset))
+
+    def add_shift(self, xshift, yshift):
+        """Appends shift of x and y to the pending transform chain
+        """
+        self.add_transform(get_shift_matrix(xshift, yshift))
+
+    def add_scale(self, xscale, yscale, xorigin=0, yorigin=0):
+        """Appends scaling about (`xorigin`, `yorigin`) to the pending
+           transform chain. Binning by 2 is a scale of 0.5
+        """
+        self.add_transform(get_scale_matrix(xscale, yscale, xorigin,
+                                            yorigin))
+
+    def get_transform(self):
+        """Returns copy of the pending 3x3 transform matrix which is
+           the identity matrix if no transforms are pending
+        """
+        if self._transform is None:
+            return numpy.identity(3)
+        return self._transform.copy()
+
+    def has_pending_transforms(self):
+        """Returns True if there are transforms that have not yet been
+           applied to the markers
+        """
+        return self._transform is not None
+
+    def apply_transforms(self):
+        """Applies pending transform chain to x and y of all markers
+           in a single pass and clears the chain
+        """
+        if self._transform is None:
+            return
+        matrix = self._transform
+        self._transform = None
+        xs = self._x[:self._count]
+        ys = self._y[:self._count]
+        newxs = xs * matrix[0, 0]
+        newxs += ys * matrix[0, 1]
+        newxs += matrix[0, 2]
+        ys *= matrix[1, 1]
+        ys += xs * matrix[1, 0]
+        ys += matrix[1, 2]
+        xs[:] = newxs
+
+    def apply_slice_transforms(self, zs, matrices):
+        """Applies a different 3x3 homogeneous transform to x and y of
+           the markers in each slice (tilt) in a single pass. The
+           coefficients of each marker's matrix are gathered by looking
+           up its z value in the table so the list is never split up
+           per slice. Any pending transform chain is applied first.
+
+           :param zs: z values of the slices, one per matrix, markers
+                      whose z value is not in `zs` are left unchanged
+           :param matrices: (K, 3, 3) array of matrices, see
+                            `get_slice_rotation_matrices` and
+                            `get_slice_shift_matrices`
+           :raises ValueError: if `matrices` is not (K, 3, 3) where K is
+                               the number of `zs` or `zs` has duplicates
+        """
+        zs = numpy.asarray(zs, dtype=numpy.float64).ravel()
+        matrices = numpy.asarray(matrices, dtype=numpy.float64)
+        if matrices.shape != (len(zs), 3, 3):
+            raise ValueError('matrices must be (' + str(len(zs)) +
+                             ', 3, 3) not ' + str(matrices.shape))
+        order = numpy.argsort(zs, kind='mergesort')
+        zs = zs[order]
+        matrices = matrices[order]
+        if numpy.any(zs[1:] == zs[:-1]):
+            raise ValueError('z values of slice transforms must be unique')
+
+        self.apply_transforms()
+        if len(zs) == 0 or self._count == 0:
+            return
+        markerzs = self._z[:self._count]
+        slots = numpy.searchsorted(zs, markerzs)
+        slots[slots == len(zs)] = 0
+        hits = numpy.flatnonzero(zs[slots] == markerzs)
+        slots = slots[hits]
+
+        xs = self._x[hits]
+        ys = self._y[hits]
+        newxs = xs * matrices[slots, 0, 0]
+        newxs += ys * matrices[slots, 0, 1]
+        newxs += matrices[slots, 0, 2]
+        newys = ys * matrices[slots, 1, 1]
+        newys += xs * matrices[slots, 1, 0]
+        newys += matrices[slots, 1, 2]
+        self._x[hits] = newxs
+        self._y[hits] = newys
 
     def rotate_by_angle(self, angle, xoffset, yoffset):
         """Rotates markers by angle
@@ -69,23 +349,587 @@ class MarkersList(object):
         logger.debug('angle = ' + str(angle) + ' theta = ' + str(theta) +
                      'xoffset = ' + str(xoff) + 'yoffset = ' + str(yoff))
 
-        for m in self._markers:
-            m.rotate_by_theta(theta, xoff, yoff)
+        self._rotate_by_theta(theta, xoff, yoff)
+
+    def _rotate_by_theta(self, theta, xoffset, yoffset):
+        """Rotates all markers by theta in one pass over the arrays
+
+           The operations are done in the same order as
+           `Marker.rotate_by_theta` so the results are bit for bit
+           identical to rotating each marker individually
+        """
+        cos_theta = math.cos(theta)
+        sin_theta = math.sin(theta)
+        xs = self.get_x()
+        ys = self.get_y()
+        dx = xs - xoffset
+        dy = ys - yoffset
+        numpy.multiply(dx, cos_theta, out=xs)
+        xs += dy * -sin_theta
+        xs += xoffset
+        dx *= sin_theta
+        dy *= cos_theta
+        numpy.add(dx, dy, out=ys)
+        ys += yoffset
+
+    def get_rotated_by_angles(self, angles, xoffset, yoffset):
+        """Rotates markers by every angle in `angles` at once without
+           modifying this object
+
+           The trig functions are computed once per angle and each
+           rotated set is bit for bit identical to what
+           `rotate_by_angle` would produce for that angle.
+
+           :param angles: list of angles in degrees, ie output of
+                          `util.get_evenly_distributed_rotations`
+           :param xoffset: x coordinate of center of rotation
+           :param yoffset: y coordinate of center of rotation
+           :raises InvalidAngleError: if any angle is None
+           :returns: numpy float array of shape
+                     (len(angles), number of markers, 3) where the
+                     last dimension is x, y, z
+        """
+        if xoffset is None:
+            xoffset = 0
+        if yoffset is None:
+            yoffset = 0
+
+        cos_thetas = []
+        sin_thetas = []
+        for angle in angles:
+            if angle is None:
+                raise InvalidAngleError('Angle passed cannot be None')
+            theta = 2 * math.pi * angle / 360
+            cos_thetas.append(math.cos(theta))
+            sin_thetas.append(math.sin(theta))
+        cos_thetas = numpy.array(cos_thetas)[:, numpy.newaxis]
+        sin_thetas = numpy.array(sin_thetas)[:, numpy.newaxis]
+
+        xs = self.get_x()
+        ys = self.get_y()
+        dx = xs - xoffset
+        dy = ys - yoffset
+        rotated = numpy.empty((len(cos_thetas), self._count, 3),
+                              dtype=xs.dtype)
+        rotated[:, :, 0] = dx * cos_thetas
+        rotated[:, :, 0] += dy * -sin_thetas
+        rotated[:, :, 0] += xoffset
+        rotated[:, :, 1] = dx * sin_thetas
+        rotated[:, :, 1] += dy * cos_thetas
+        rotated[:, :, 1] += yoffset
+        rotated[:, :, 2] = self.get_z()
+
+        # rotate_by_angle leaves markers untouched for an angle of 0
+        for pos, angle in enumerate(angles):
+            if angle == 0:
+                rotated[pos, :, 0] = xs
+                rotated[pos, :, 1] = ys
+        return rotated
+
+    def rotate_3d(self, angles, center, outcenter=None):
+        """Rotates markers in 3D the way IMOD rotatevol rotates a volume,
+           see `get_euler_rotation_matrix`. A rotation of (angle, 0, 0)
+           about (x/2, y/2, z/2) matches `rotate_by_angle` about
+           (x/2, y/2) to within rounding
+
+           :param angles: (z angle, y angle, x angle) in degrees, same
+                          as the value passed to rotatevol -angles
+           :param center: (x, y, z) center of rotation, usually
+                          `get_volume_center` of the volume
+           :param outcenter: (x, y, z) the center is moved to, defaults
+                             to `center`
+           :raises InvalidAngleError: if `angles` is not 3 angles
+        """
+        rotated = self.get_rotated_3d_by_angles([angles], center,
+                                                outcenter)[0]
+        self._x[:self._count] = rotated[:, 0]
+        self._y[:self._count] = rotated[:, 1]
+        self._z[:self._count] = rotated[:, 2]
+
+    def get_rotated_3d_by_angles(self, angles_list, center, outcenter=None):
+        """Rotates markers in 3D by every set of angles in `angles_list`
+           at once without modifying this object. All the rotations are
+           done with a single matrix multiply over the stacked rotation
+           matrices
+
+           :param angles_list: list of (z angle, y angle, x angle)
+                               tuples in degrees
+           :param center: (x, y, z) center of rotation
+           :param outcenter: (x, y, z) the center is moved to, defaults
+                             to `center`
+           :raises InvalidAngleError: if an entry is not 3 angles
+           :raises ValueError: if `center` or `outcenter` is not 3 values
+           :returns: numpy float array of shape
+                     (len(angles_list), number of markers, 3) where the
+                     last dimension is x, y, z
+        """
+        center = _get_3d_point(center)
+        if outcenter is None:
+            outcenter = center
+        else:
+            outcenter = _get_3d_point(outcenter)
+        matrices = numpy.empty((len(angles_list), 3, 3))
+        for pos, angles in enumerate(angles_list):
+            matrices[pos] = get_euler_rotation_matrix(angles)
+
+        points = numpy.empty((3, self._count))
+        points[0] = self.get_x()
+        points[1] = self.get_y()
+        points[2] = self.get_z()
+        points -= center[:, numpy.newaxis]
+        rotated = numpy.dot(matrices, points).transpose(0, 2, 1)
+        rotated += outcenter
+        return rotated
+
+    def write_rotated_markers_to_files(self, angles, xoffset, yoffset,
+                                       files):
+        """Writes markers rotated by each angle in `angles` to the
+           corresponding text file in `files`
+
+           :raises ValueError: if `angles` and `files` differ in length
+        """
+        if len(angles) != len(files):
+            raise ValueError('Number of angles and files must match')
+        rotated = self.get_rotated_by_angles(angles, xoffset, yoffset)
+        for pos, path in enumerate(files):
+            markers = MarkersList()
+            markers.add_markers(self.get_indexes(), rotated[pos, :, 0],
+                                rotated[pos, :, 1], rotated[pos, :, 2])
+            markers.write_markers_to_file(path)
+
+    def get_in_frame(self, fromframe, toframe):
+        """Gets copy of markers mapped from coordinate frame `fromframe`
+           to `toframe` keeping only the markers that land inside
+           `toframe`. The mapping and the bounds check are done in a
+           single pass over the arrays and this object is not modified
+
+           :param fromframe: `CoordinateFrame` the markers are in
+           :param toframe: `CoordinateFrame` to map the markers to
+           :returns: new MarkersList
+        """
+        matrix = toframe.get_transform_from(fromframe)
+        xs = self.get_x()
+        ys = self.get_y()
+        newxs = xs * matrix[0, 0]
+        newxs += ys * matrix[0, 1]
+        newxs += matrix[0, 2]
+        newys = ys * matrix[1, 1]
+        newys += xs * matrix[1, 0]
+        newys += matrix[1, 2]
+        mask = toframe.get_inside_mask(newxs, newys)
+
+        subset = MarkersList(compact=self.is_compact())
+        subset.add_markers(self.get_indexes()[mask], newxs[mask],
+                           newys[mask], self.get_z()[mask])
+        return subset
 
     def shift_markers(self, xshift, yshift, zshift):
         """Shifts each Marker by values in xshift and yshift
         """
-        for m in self._markers:
-            m.shift_marker(xshift, yshift, zshift)
+        self.get_x()[:] += xshift
+        self.get_y()[:] += yshift
+        self.get_z()[:] += zshift
 
     def write_markers_to_file(self, file):
-        """Writes markers to text file
+        """Writes markers to text file in the format of
+           `Marker.get_3dmarker_format` one per line. Markers with any
+           field set to `None` are skipped. The lines are formatted
+           `WRITE_CHUNK_SIZE` markers at a time and each chunk is
+           written to the file with a single call.
         """
+        mask = self.get_valid_mask()
+        values = numpy.empty((int(mask.sum()), 4))
+        values[:, 0] = self.get_indexes()[mask]
+        values[:, 1] = self.get_x()[mask]
+        values[:, 2] = self.get_y()[mask]
+        values[:, 3] = self.get_z()[mask]
+
         f = open(file, 'w')
-        for m in self._markers:
-            f.write(m.get_3dmarker_format() + '\n')
-        f.flush()
-        f.close()
+        try:
+            chunk_size = MarkersList.WRITE_CHUNK_SIZE
+            for start in range(0, len(values), chunk_size):
+                chunk = values[start:start + chunk_size]
+                f.write((MarkersList.LINE_FORMAT * len(chunk)) %
+                        tuple(chunk.ravel().tolist()))
+            f.flush()
+        finally:
+            f.close()
+
+
+def get_rotation_matrix(angle, xoffset, yoffset):
+    """Gets 3x3 homogeneous matrix that rotates counter clockwise by
+       `angle` degrees about (`xoffset`, `yoffset`) following the same
+       convention as `Marker.rotate_by_theta`
+    """
+    if xoffset is None:
+        xoffset = 0
+    if yoffset is None:
+        yoffset = 0
+    theta = 2 * math.pi * angle / 360
+    cos_theta = math.cos(theta)
+    sin_theta = math.sin(theta)
+    return numpy.array([[cos_theta, -sin_theta,
+                         xoffset - xoffset * cos_theta + yoffset * sin_theta],
+                        [sin_theta, cos_theta,
+                         yoffset - xoffset * sin_theta - yoffset * cos_theta],
+                        [0.0, 0.0, 1.0]])
+
+
+def get_shift_matrix(xshift, yshift):
+    """Gets 3x3 homogeneous matrix that shifts by `xshift`, `yshift`
+    """
+    return numpy.array([[1.0, 0.0, xshift],
+                        [0.0, 1.0, yshift],
+                        [0.0, 0.0, 1.0]])
+
+
+def get_scale_matrix(xscale, yscale, xorigin=0, yorigin=0):
+    """Gets 3x3 homogeneous matrix that scales by `xscale`, `yscale`
+       about (`xorigin`, `yorigin`)
+    """
+    return numpy.array([[xscale, 0.0, xorigin - xorigin * xscale],
+                        [0.0, yscale, yorigin - yorigin * yscale],
+                        [0.0, 0.0, 1.0]])
+
+
+def get_euler_rotation_matrix(angles):
+    """Gets 3x3 matrix that rotates (x, y, z) column vectors using the
+       convention of IMOD rotatevol -angles. The rotations are about
+       the Z, then the Y and then the X axis and each is counter
+       clockwise when looking down the axis toward the origin, so
+       the Z rotation is the same as `get_rotation_matrix`
+
+       :param angles: (z angle, y angle, x angle) in degrees
+       :raises InvalidAngleError: if `angles` is not 3 angles
+    """
+    if angles is None or len(angles) != 3 or None in angles:
+        raise InvalidAngleError('Expected 3 angles (z, y, x) not ' +
+                                str(angles))
+    (zangle, yangle, xangle) = [2 * math.pi * float(a) / 360
+                                for a in angles]
+    cos_z = math.cos(zangle)
+    sin_z = math.sin(zangle)
+    cos_y = math.cos(yangle)
+    sin_y = math.sin(yangle)
+    cos_x = math.cos(xangle)
+    sin_x = math.sin(xangle)
+    zrot = numpy.array([[cos_z, -sin_z, 0.0],
+                        [sin_z, cos_z, 0.0],
+                        [0.0, 0.0, 1.0]])
+    yrot = numpy.array([[cos_y, 0.0, sin_y],
+                        [0.0, 1.0, 0.0],
+                        [-sin_y, 0.0, cos_y]])
+    xrot = numpy.array([[1.0, 0.0, 0.0],
+                        [0.0, cos_x, -sin_x],
+                        [0.0, sin_x, cos_x]])
+    return numpy.dot(xrot, numpy.dot(yrot, zrot))
+
+
+def get_volume_center(xsize, ysize, zsize):
+    """Gets center of a volume of the given dimensions as used for
+       rotating markers, ie (x/2, y/2, z/2)
+    """
+    return float(xsize) / 2, float(ysize) / 2, float(zsize) / 2
+
+
+def _get_3d_point(point):
+    """Converts `point` to float array of 3 values
+       :raises ValueError: if `point` is not 3 values
+    """
+    point = numpy.asarray(point, dtype=numpy.float64)
+    if point.shape != (3,):
+        raise ValueError('Expected (x, y, z) not ' + str(point))
+    return point
+
+
+def get_slice_rotation_matrices(angles, xoffset, yoffset):
+    """Gets (K, 3, 3) array of matrices that each rotate counter
+       clockwise by the corresponding angle in `angles` degrees about
+       (`xoffset`, `yoffset`) for use with
+       `MarkersList.apply_slice_transforms`
+    """
+    return _get_matrices([get_rotation_matrix(angle, xoffset, yoffset)
+                          for angle in angles])
+
+
+def get_slice_shift_matrices(xshifts, yshifts):
+    """Gets (K, 3, 3) array of matrices that each shift by the
+       corresponding values in `xshifts` and `yshifts`, such as per
+       tilt offsets, for use with `MarkersList.apply_slice_transforms`
+       :raises ValueError: if `xshifts` and `yshifts` differ in length
+    """
+    if len(xshifts) != len(yshifts):
+        raise ValueError('Number of x and y shifts must match')
+    return _get_matrices([get_shift_matrix(xshift, yshift)
+                          for (xshift, yshift) in zip(xshifts, yshifts)])
+
+
+def _get_matrices(matrices):
+    """Stacks list of 3x3 matrices into (K, 3, 3) array
+    """
+    if len(matrices) == 0:
+        return numpy.empty((0, 3, 3))
+    return numpy.array(matrices)
+
+
+def _none_to_nan(val):
+    """Returns NaN if `val` is None otherwise `val`
+    """
+    if val is None:
+        return numpy.nan
+    return val
+
+
+def _nan_to_none(val):
+    """Returns None if `val` is NaN otherwise `val`
+    """
+    if val != val:
+        return None
+    return val
+
+
+class CoordinateFrame(object):
+    """Rectangular region of the full projection that marker x and y
+       coordinates can be relative to, such as the clipped projection
+       or a binned copy of it
+
+       The region starts at (`xoffset`, `yoffset`) and is `width` by
+       `height` pixels of the full projection. Coordinates in the frame
+       are relative to the start of the region and divided by
+       `binning`
+    """
+    def __init__(self, width, height, xoffset=0, yoffset=0, binning=1):
+        """Constructor
+        :param width: width of region in full projection pixels
+        :param height: height of region in full projection pixels
+        :param xoffset: x start of region in full projection
+        :param yoffset: y start of region in full projection
+        :param binning: binning factor of the frame
+        :raises ValueError: if `binning` is not > 0
+        """
+        if binning is None or not binning > 0:
+            raise ValueError('Binning must be > 0 : ' + str(binning))
+        self._width = width
+        self._height = height
+        self._xoffset = xoffset
+        self._yoffset = yoffset
+        self._binning = binning
+
+    def get_width(self):
+        return self._width
+
+    def get_height(self):
+        return self._height
+
+    def get_xoffset(self):
+        return self._xoffset
+
+    def get_yoffset(self):
+        return self._yoffset
+
+    def get_binning(self):
+        return self._binning
+
+    def get_binned(self, binning):
+        """Gets frame over the same region binned by `binning` on top
+           of the binning of this frame
+        """
+        return CoordinateFrame(self._width, self._height, self._xoffset,
+                               self._yoffset, self._binning * binning)
+
+    def get_to_full_matrix(self):
+        """Gets 3x3 homogeneous matrix mapping coordinates in this frame
+           to the unbinned full projection
+        """
+        matrix = get_scale_matrix(self._binning, self._binning)
+        matrix[0, 2] = self._xoffset
+        matrix[1, 2] = self._yoffset
+        return matrix
+
+    def get_from_full_matrix(self):
+        """Gets 3x3 homogeneous matrix mapping coordinates in the
+           unbinned full projection to this frame
+        """
+        scale = 1.0 / self._binning
+        matrix = get_scale_matrix(scale, scale)
+        matrix[0, 2] = -self._xoffset * scale
+        matrix[1, 2] = -self._yoffset * scale
+        return matrix
+
+    def get_transform_from(self, frame):
+        """Gets 3x3 homogeneous matrix mapping coordinates in `frame`
+           to this frame
+        """
+        return numpy.dot(self.get_from_full_matrix(),
+                         frame.get_to_full_matrix())
+
+    def get_inside_mask(self, xs, ys):
+        """Gets boolean array that is True where (`xs`, `ys`), given in
+           this frame, lie inside the region. Coordinates set to NaN
+           are outside
+        """
+        xs = numpy.asarray(xs)
+        ys = numpy.asarray(ys)
+        mask = xs >= 0
+        mask &= xs < float(self._width) / self._binning
+        mask &= ys >= 0
+        mask &= ys < float(self._height) / self._binning
+        return mask
+
+
+class TrackIndex(object):
+    """Groups the markers of a `MarkersList` by track index and by tilt
+       in the style of a compressed sparse row matrix. The markers are
+       copied once into track order and once into tilt order, O(n log n),
+       along with offset arrays marking where each track and each tilt
+       starts. Getting the markers of one track or one tilt is then a
+       slice of those arrays that returns views without any scanning.
+
+       Markers with any field set to `None` are left out.
+    """
+
+    def __init__(self, markers):
+        """Constructor
+        :param markers: MarkersList to index. Later changes to
+                        `markers` are not reflected in the index
+        """
+        positions = numpy.flatnonzero(markers.get_valid_mask())
+        indexes = markers.get_indexes()[positions]
+        xs = markers.get_x()[positions]
+        ys = markers.get_y()[positions]
+        zs = markers.get_z()[positions]
+
+        order = numpy.argsort(indexes, kind='mergesort')
+        self._track_order = positions[order]
+        self._track_indexes = indexes[order]
+        self._track_x = xs[order]
+        self._track_y = ys[order]
+        self._track_z = zs[order]
+        (self._track_ids,
+         self._track_offsets) = _get_sorted_groups(self._track_indexes)
+
+        order = numpy.argsort(zs, kind='mergesort')
+        self._tilt_order = positions[order]
+        self._tilt_indexes = indexes[order]
+        self._tilt_x = xs[order]
+        self._tilt_y = ys[order]
+        self._tilt_z = zs[order]
+        (self._tilts,
+         self._tilt_offsets) = _get_sorted_groups(self._tilt_z)
+
+    def __len__(self):
+        """Returns number of markers in index
+        """
+        return len(self._track_order)
+
+    def get_track_ids(self):
+        """Gets sorted numpy array of distinct track indexes
+        """
+        return self._track_ids
+
+    def get_track_offsets(self):
+        """Gets numpy array with one more element than there are tracks
+           where markers of the Nth track in `get_track_ids` are
+           at positions offsets[N] to offsets[N + 1] of the track
+           ordered arrays
+        """
+        return self._track_offsets
+
+    def get_track_lengths(self):
+        """Gets numpy array with number of markers in each track
+        """
+        return numpy.diff(self._track_offsets)
+
+    def get_track_order(self):
+        """Gets positions in the `MarkersList` of the markers in track
+           order. Markers of a track keep their relative order
+        """
+        return self._track_order
+
+    def get_track_ordered_markers(self):
+        """Gets all markers in track order
+        :returns: tuple of numpy arrays (indexes, xs, ys, zs)
+        """
+        return (self._track_indexes, self._track_x, self._track_y,
+                self._track_z)
+
+    def get_markers_list(self):
+        """Gets new MarkersList with all markers in track order which
+           is compact if the indexed list was compact
+        """
+        markers = MarkersList(compact=self._track_x.dtype ==
+                              numpy.float32)
+        markers.add_markers(self._track_indexes, self._track_x,
+                            self._track_y, self._track_z)
+        return markers
+
+    def get_track(self, index):
+        """Gets markers of track `index`
+        :returns: tuple of numpy array views (xs, ys, zs) which are
+                  empty if there is no such track
+        """
+        (start, end) = _get_group_bounds(self._track_ids,
+                                         self._track_offsets, index)
+        return (self._track_x[start:end], self._track_y[start:end],
+                self._track_z[start:end])
+
+    def get_tilts(self):
+        """Gets sorted numpy array of distinct z (tilt slice) values
+        """
+        return self._tilts
+
+    def get_tilt_offsets(self):
+        """Gets numpy array where markers of the Nth tilt in `get_tilts`
+           are at positions offsets[N] to offsets[N + 1] of the tilt
+           ordered arrays
+        """
+        return self._tilt_offsets
+
+    def get_tilt_order(self):
+        """Gets positions in the `MarkersList` of the markers in tilt
+           order. Markers of a tilt keep their relative order
+        """
+        return self._tilt_order
+
+    def get_tilt_ordered_markers(self):
+        """Gets all markers in tilt order
+        :returns: tuple of numpy arrays (indexes, xs, ys, zs)
+        """
+        return (self._tilt_indexes, self._tilt_x, self._tilt_y,
+                self._tilt_z)
+
+    def get_tilt(self, z):
+        """Gets markers visible in tilt slice `z`
+        :returns: tuple of numpy array views (indexes, xs, ys) which are
+                  empty if there is no such tilt
+        """
+        (start, end) = _get_group_bounds(self._tilts, self._tilt_offsets,
+                                         z)
+        return (self._tilt_indexes[start:end], self._tilt_x[start:end],
+                self._tilt_y[start:end])
+
+
+def _get_sorted_groups(sorted_values):
+    """Finds runs of equal values in `sorted_values`
+    :returns: tuple (distinct values, offsets) where offsets has one
+              more element than there are distinct values
+    """
+    if len(sorted_values) == 0:
+        return sorted_values[:0].copy(), numpy.zeros(1, dtype=numpy.intp)
+    starts = numpy.flatnonzero(sorted_values[1:] != sorted_values[:-1]) + 1
+    starts = numpy.concatenate(([0], starts))
+    return sorted_values[starts], numpy.append(starts, len(sorted_values))
+
+
+def _get_group_bounds(values, offsets, value):
+    """Gets start and end offsets of group `value`
+    :returns: tuple (start, end) which is (0, 0) if `value` is not
+              in `values`
+    """
+    pos = int(numpy.searchsorted(values, value))
+    if pos == len(values) or values[pos] != value:
+        return 0, 0
+    return int(offsets[pos]), int(offsets[pos + 1])
 
 
 class Marker(object):
@@ -117,10 +961,12 @@ class Marker(object):
            x' = x*cos(theta)+y*-sin(theta)
            y' = x*sin(theta)+y*cos(theta)
         """
+        cos_theta = math.cos(theta)
+        sin_theta = math.sin(theta)
         newX = ((self._x - xoffset) *
-                math.cos(theta) + (self._y - yoffset) * -math.sin(theta))
+                cos_theta + (self._y - yoffset) * -sin_theta)
         newY = ((self._x - xoffset) *
-                math.sin(theta) + (self._y - yoffset) * math.cos(theta))
+                sin_theta + (self._y - yoffset) * cos_theta)
 
         self._x = newX + xoffset
         self._y = newY + yoffset
@@ -164,8 +1010,19 @@ class Marker(object):
 class MarkersFrom3DMarkersFileFactory(object):
     """Loads Markers from 3DMarkers.txt file
     """
-    def __init__(self, markersfile):
+    BLOCK_SIZE = 4 * 1024 * 1024
+    MAX_REPORTED_LINES = 5
+    CACHE_SUFFIX = '.npy'
+    CACHE_DTYPE = numpy.dtype([('index', '<i8'), ('x', '<f8'),
+                               ('y', '<f8'), ('z', '<f8')])
+    COMPACT_CACHE_SUFFIX = '.f32.npy'
+    COMPACT_CACHE_DTYPE = numpy.dtype([('index', '<i4'), ('x', '<f4'),
+                                       ('y', '<f4'), ('z', '<f4')])
+
+    def __init__(self, markersfile, usecache=False, compact=False):
         self._markersfile = markersfile
+        self._usecache = usecache
+        self._compact = compact
 
     def get_markers_file(self):
         """Returns path to 3DMarkers.txt file
@@ -177,24 +1034,302 @@ class MarkersFrom3DMarkersFileFactory(object):
         """
         self._markersfile = markersfile
 
+    def get_use_cache(self):
+        """Returns True if binary sidecar cache is used
+        """
+        return self._usecache
+
+    def set_use_cache(self, usecache):
+        """Sets whether `get_markerslist` should load markers from and
+           save markers to a binary sidecar file next to the markers file
+        """
+        self._usecache = usecache
+
+    def get_compact(self):
+        """Returns True if markers are loaded into compact lists
+        """
+        return self._compact
+
+    def set_compact(self, compact):
+        """Sets whether `get_markerslist` returns a compact
+           `MarkersList` with float32 coordinates. Compact lists use
+           a sidecar of `COMPACT_CACHE_DTYPE` which is half the size of
+           the double precision one. See `MarkersList` for the error
+           this introduces
+        """
+        self._compact = compact
+
+    def get_cache_file(self):
+        """Gets path of binary sidecar file for the current version of
+           the markers file. The name of the sidecar is derived from
+           the name, size and modification time of the markers file so
+           a sidecar is only found if it was made from the file as it
+           is now. The sidecar is a .npy file holding a structured
+           array of `CACHE_DTYPE`, or of `COMPACT_CACHE_DTYPE` in compact
+           mode, that can be memory mapped.
+
+           :raises OSError: if markers file does not exist
+        """
+        stat = os.stat(self._markersfile)
+        return self._get_cache_prefix() + str(stat.st_size) + '_' + \
+            str(int(round(stat.st_mtime * 1000000))) + \
+            self._get_cache_suffix()
+
+    def _get_cache_suffix(self):
+        """Gets file suffix of sidecar for the current mode
+        """
+        if self._compact is True:
+            return MarkersFrom3DMarkersFileFactory.COMPACT_CACHE_SUFFIX
+        return MarkersFrom3DMarkersFileFactory.CACHE_SUFFIX
+
+    def _get_cache_dtype(self):
+        """Gets structured type of sidecar for the current mode
+        """
+        if self._compact is True:
+            return MarkersFrom3DMarkersFileFactory.COMPACT_CACHE_DTYPE
+        return MarkersFrom3DMarkersFileFactory.CACHE_DTYPE
+
+    def _get_cache_prefix(self):
+        """Gets start of name shared by all sidecar files of markers file
+        """
+        (dirname, basename) = os.path.split(self._markersfile)
+        return os.path.join(dirname, '.' + basename + '.')
+
+    def _get_cache_file_pattern(self):
+        """Gets compiled regular expression matching the name of any
+           sidecar file of markers file, in either mode, but not the
+           sidecars of other markers files whose name starts with the
+           same text
+        """
+        suffixes = [MarkersFrom3DMarkersFileFactory.COMPACT_CACHE_SUFFIX,
+                    MarkersFrom3DMarkersFileFactory.CACHE_SUFFIX]
+        return re.compile(re.escape(os.path.basename(
+            self._get_cache_prefix())) + r'\d+_\d+(' +
+            '|'.join([re.escape(x) for x in suffixes]) + ')$')
+
     def get_markerslist(self):
         """Returns Markers from 3DMarkers.txt file set in constructor
+
+           If cache is enabled via `set_use_cache` the markers are
+           loaded from the binary sidecar file when there is one for
+           the current version of the markers file. Otherwise the text
+           file is parsed and a new sidecar is written. The text file
+           remains the authoritative copy of the markers.
+
+           :raises ValueError: if a field cannot be converted to a
+                   number
         """
-        markers = MarkersList()
-        pattern = re.compile('\s+')
-
-        f = open(self._markersfile, 'r')
-        for line in f:
-            pline = pattern.split(line)
-            if len(pline) != 6:
-                logger.warning('Skipping line invalid # elements ' +
-                               str(len(pline)) + ' (' + line + ')')
-                continue
-            markers.add_marker(int(pline[1]), float(pline[2]),
-                               float(pline[3]), float(pline[4]))
-        f.close()
+        if self._usecache is not True:
+            return self._parse_markers_file()
+
+        cachefile = self.get_cache_file()
+        markers = self._load_cache_file(cachefile)
+        if markers is not None:
+            return markers
+        markers = self._parse_markers_file()
+        self._write_cache_file(cachefile, markers)
+        return markers
+
+    def _load_cache_file(self, cachefile):
+        """Loads markers from binary sidecar `cachefile`
+           :returns: MarkersList or None if sidecar is missing or
+                     could not be read
+        """
+        if not os.path.isfile(cachefile):
+            return None
+        try:
+            data = numpy.load(cachefile, mmap_mode='r')
+            if data.dtype != self._get_cache_dtype():
+                raise ValueError('Unexpected type ' + str(data.dtype))
+            markers = MarkersList(compact=self._compact)
+            markers.add_markers(data['index'], data['x'], data['y'],
+                                data['z'])
+            del data
+        except (IOError, ValueError) as e:
+            logger.warning('Ignoring unreadable marker cache ' + cachefile +
+                           ' : ' + str(e))
+            return None
+        logger.debug('Loaded ' + str(len(markers)) + ' markers from ' +
+                     cachefile)
         return markers
 
+    def _write_cache_file(self, cachefile, markers):
+        """Writes `markers` to binary sidecar `cachefile` removing any
+           sidecars made from older versions of the markers file. The
+           data is written to a temporary file that is renamed to
+           `cachefile` so readers never see a partially written sidecar.
+           The compact and the double precision sidecars of the current
+           version of the markers file are kept side by side. Failures
+           are logged and otherwise ignored since the cache is optional.
+        """
+        prefix = self._get_cache_prefix()
+        current = os.path.basename(
+            cachefile[:-len(self._get_cache_suffix())]) + '.'
+        try:
+            dirname = os.path.dirname(cachefile)
+            stale = self._get_cache_file_pattern()
+            for entry in os.listdir(dirname or os.curdir):
+                path = os.path.join(dirname, entry)
+                if (stale.match(entry) is not None and
+                        not entry.startswith(current)):
+                    logger.debug('Removing stale marker cache ' + path)
+                    os.unlink(path)
+
+            dtype = self._get_cache_dtype()
+            indexes = markers.get_indexes()
+            limits = numpy.iinfo(dtype['index'])
+            if len(indexes) > 0 and (indexes.min() < limits.min or
+                                     indexes.max() > limits.max):
+                logger.warning('Not writing marker cache ' + cachefile +
+                               ' since marker indexes do not fit in ' +
+                               str(dtype['index']))
+                return
+            data = numpy.empty(len(markers), dtype=dtype)
+            data['index'] = indexes
+            data['x'] = markers.get_x()
+            data['y'] = markers.get_y()
+            data['z'] = markers.get_z()
+
+            (fd, tmpfile) = tempfile.mkstemp(dir=dirname or os.curdir,
+                                             prefix=os.path.basename(prefix),
+                                             suffix='.tmp')
+            try:
+                f = os.fdopen(fd, 'wb')
+                try:
+                    numpy.save(f, data)
+                finally:
+                    f.close()
+                os.rename(tmpfile, cachefile)
+            except Exception:
+                os.unlink(tmpfile)
+                raise
+        except (IOError, OSError) as e:
+            logger.warning('Unable to write marker cache ' + cachefile +
+                           ' : ' + str(e))
+
+    def _parse_markers_file(self):
+        """Parses markers file set in constructor
+
+           The file is read in blocks of `BLOCK_SIZE` bytes and each
+           block is converted to arrays in one vectorized step. Lines
+           that do not have exactly 4 fields are skipped and reported
+           in a single warning once the whole file has been read.
+
+           :raises ValueError: if a field cannot be converted to a
+                   number
+        """
+        markers = MarkersList(compact=self._compact)
+        skipped_count = 0
+        skipped_lines = []
+        line_offset = 0
+        carry = b''
+        f = open(self._markersfile, 'rb')
+        try:
+            while True:
+                data = f.read(MarkersFrom3DMarkersFileFactory.BLOCK_SIZE)
+                block = carry + data
+                carry = b''
+                if len(data) > 0:
+                    cut = block.rfind(b'\n') + 1
+                    carry = block[cut:]
+                    block = block[:cut]
+                if len(block) > 0:
+                    (values, bad_lines,
+                     num_lines) = _parse_markers_block(block)
+                    markers.add_markers(values[:, 0], values[:, 1],
+                                        values[:, 2], values[:, 3])
+                    skipped_count += len(bad_lines)
+                    for line_num in bad_lines[:MarkersFrom3DMarkersFileFactory.
+                                              MAX_REPORTED_LINES -
+                                              len(skipped_lines)]:
+                        skipped_lines.append((line_offset + line_num + 1,
+                                              _get_block_line(block,
+                                                              line_num)))
+                    line_offset += num_lines
+                if len(data) == 0:
+                    break
+        finally:
+            f.close()
+
+        if skipped_count > 0:
+            logger.warning('Skipped ' + str(skipped_count) + ' line(s) '
+                           'with invalid # elements in ' +
+                           str(self._markersfile) + ' first ones: ' +
+                           ', '.join(['line ' + str(num) + ' (' + line + ')'
+                                      for (num, line) in skipped_lines]))
+        return markers
+
+
+def _get_block_line(block, line_num):
+    """Gets line `line_num` from `block` of bytes as a string
+    """
+    line = block.split(b'\n')[line_num]
+    return line.decode('ascii', 'replace').rstrip()
+
+
+def _parse_markers_block(block):
+    """Parses `block` of bytes made up of whole lines of
+       <index> <x> <y> <z>
+
+       :returns: tuple (values, bad_lines, number of lines) where
+                 values is a (N, 4) float64 array of the valid lines and
+                 bad_lines is an array of line numbers, relative to
+                 the start of the block, that did not have 4 fields
+       :raises ValueError: if a field is not a number or an index is
+                           not an integer
+    """
+    buf = numpy.frombuffer(block, dtype=numpy.uint8)
+    line_ends = numpy.flatnonzero(buf == 10)
+    if len(buf) > 0 and buf[-1] != 10:
+        line_ends = numpy.append(line_ends, len(buf))
+    num_lines = len(line_ends)
+    line_starts = numpy.concatenate(([0], line_ends[:-1] + 1))
+
+    # find where each whitespace separated field starts
+    space = buf <= 32
+    token_starts = ~space
+    token_starts[1:] &= space[:-1]
+    token_pos = numpy.flatnonzero(token_starts)
+
+    if (len(token_pos) == 4 * num_lines and
+            numpy.all(token_pos[0::4] >= line_starts) and
+            numpy.all(token_pos[3::4] < line_ends)):
+        bad_lines = numpy.empty(0, dtype=numpy.intp)
+    else:
+        counts = numpy.bincount(numpy.searchsorted(line_starts, token_pos,
+                                                   side='right') - 1,
+                                minlength=num_lines)
+        valid = counts == 4
+        bad_lines = numpy.flatnonzero(~valid)
+        line_lengths = numpy.diff(numpy.append(line_starts, len(buf)))
+        block = buf[numpy.repeat(valid, line_lengths)].tobytes()
+
+    values = _get_block_values(block, 4 * (num_lines - len(bad_lines)))
+    values = values.reshape(-1, 4)
+    if not numpy.array_equal(values[:, 0], numpy.floor(values[:, 0])):
+        raise ValueError('invalid literal for int() in block of marker '
+                         'lines')
+    return values, bad_lines, num_lines
+
+
+def _get_block_values(block, count):
+    """Parses whitespace separated numbers in `block` of bytes with
+       `numpy.fromstring` which is faster than splitting the block and
+       converting each field. Older NumPy stops at a field that is not
+       a number and only warns while newer NumPy raises, so if the
+       block does not give `count` values it is converted again field
+       by field to raise the usual ValueError
+    """
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', DeprecationWarning)
+            values = numpy.fromstring(block, dtype=numpy.float64, sep=' ')
+        if len(values) == count:
+            return values
+    except ValueError:
+        pass
+    return numpy.array(block.split(), dtype=numpy.float64)
+
 
 class MarkersFromIMODFiducialFileFactory(object):
     """Retrieves Markers from IMOD fiducial file
@@ -220,6 +1355,10 @@ class MarkersFromIMODFiducialFileFactory(object):
 
     def get_markers(self):
         """Gets markers from IMOD fiducial file
+
+           Binary IMOD models are parsed directly. Only if the file
+           uses a format or chunk the native reader does not support
+           is the model2point binary invoked.
         """
         markers = MarkersList()
         if self._fiducialfile is None:
@@ -230,6 +1369,66 @@ class MarkersFromIMODFiducialFileFactory(object):
             logger.warning('Fiducial file path does not point to file')
             return markers
 
+        try:
+            reader = IMODModelReader(self._fiducialfile)
+            (indexes, xs, ys, zs) = reader.get_points()
+            markers.add_markers(indexes, xs, ys, zs)
+            return markers
+        except UnsupportedIMODModelError as e:
+            logger.info('Falling back to ' + self._binary + ' : ' + str(e))
+
+        return self._get_markers_with_model2point()
+
+    def iter_markers(self):
+        """Generator that yields the markers of one contour at a time
+           as a `MarkersList` so fiducial files larger than memory can
+           be processed. If the file cannot be read natively all
+           markers are loaded with model2point and yielded grouped
+           by index.
+
+           :raises UnsupportedIMODModelError: if an unsupported chunk
+                   is found after contours have already been yielded
+        """
+        if self._fiducialfile is None:
+            logger.warning('Fiducial file is set to None')
+            return
+
+        if not os.path.isfile(self._fiducialfile):
+            logger.warning('Fiducial file path does not point to file')
+            return
+
+        reader = IMODModelReader(self._fiducialfile)
+        contours = reader.iter_contours()
+        try:
+            first = next(contours)
+        except StopIteration:
+            return
+        except UnsupportedIMODModelError as e:
+            logger.info('Falling back to ' + self._binary + ' : ' + str(e))
+            first = None
+
+        if first is not None:
+            for (contour_num, pts) in itertools.chain([first], contours):
+                markers = MarkersList()
+                markers.add_markers(numpy.repeat(contour_num, len(pts)),
+                                    pts[:, 0], pts[:, 1], pts[:, 2])
+                yield markers
+            return
+
+        allmarkers = self._get_markers_with_model2point()
+        indexes = allmarkers.get_indexes()
+        for index in numpy.unique(indexes):
+            mask = indexes == index
+            markers = MarkersList()
+            markers.add_markers(indexes[mask], allmarkers.get_x()[mask],
+                                allmarkers.get_y()[mask],
+                                allmarkers.get_z()[mask])
+            yield markers
+
+    def _get_markers_with_model2point(self):
+        """Gets markers by converting fiducial file to text with
+           model2point binary
+        """
         try:
             temp_dir = tempfile.mkdtemp()
             outfile = os.path.join(temp_dir, 'temp.txt')
@@ -248,10 +1447,17 @@ class MarkersFromIMODFiducialFileFactory(object):
 
 class MarkersToIMODFiducialFileWriter(object):
     """Writes Markers to IMOD Fiducial File
+
+       By default the binary IMOD model is written directly with one
+       contour per marker index and a circle size of 6, matching
+       `point2model -circle 6`. If a point2model binary is set via
+       `set_point2model_binary` that binary is invoked instead.
     """
+    CIRCLE_SIZE = 6
+
     def __init__(self, fiducialfile):
         self._fiducialfile = fiducialfile
-        self._binary = 'point2model'
+        self._binary = None
 
     def get_fiducial_file(self):
         """Returns path to 3DMarkers.txt file
@@ -270,7 +1476,8 @@ class MarkersToIMODFiducialFileWriter(object):
 
     def write_markers(self, markers):
         """Writes IMOD fiducial file with data from `markers` object passed in
-        :param markers: MarkersList object containing markers to write out
+        :param markers: MarkersList or TrackIndex object containing markers
+                        to write out. Each track becomes one contour
         :raises UnsetFiducialFileError: If fiducial file set via constructor
                 is None
         :raises UnsetMarkersListError if markers passed into this method is
@@ -284,12 +1491,26 @@ class MarkersToIMODFiducialFileWriter(object):
         if markers is None:
             raise UnsetMarkersListError('markers cannot be None')
 
+        if self._binary is None:
+            if not isinstance(markers, TrackIndex):
+                markers = TrackIndex(markers)
+            (indexes, xs, ys, zs) = markers.get_track_ordered_markers()
+            writer = IMODModelWriter(self._fiducialfile)
+            writer.set_circle_size(MarkersToIMODFiducialFileWriter.
+                                   CIRCLE_SIZE)
+            writer.write_contours(xs, ys, zs, markers.get_track_offsets())
+            return
+
+        if isinstance(markers, TrackIndex):
+            markers = markers.get_markers_list()
+
         try:
             temp_dir = tempfile.mkdtemp()
             tmpfile = os.path.join(temp_dir, 'out.txt')
             markers.write_markers_to_file(tmpfile)
-            cmd = (self._binary + ' -circle 6 ' + tmpfile + ' ' +
-                   self._fiducialfile)
+            cmd = (self._binary + ' -circle ' +
+                   str(MarkersToIMODFiducialFileWriter.CIRCLE_SIZE) + ' ' +
+                   tmpfile + ' ' + self._fiducialfile)
 
             (ecode, out, err) = util.run_external_command(cmd)
             if ecode != 0:
@@ -299,41 +1520,142 @@ class MarkersToIMODFiducialFileWriter(object):
         finally:
             shutil.rmtree(temp_dir)
 
+    def write_markers_iter(self, markerslists):
+        """Writes IMOD fiducial file one contour at a time from an
+           iterable of MarkersList objects, such as the one returned by
+           `MarkersFromIMODFiducialFileFactory.iter_markers`, so only one
+           contour is in memory at once. Each non empty MarkersList
+           becomes one contour in the order given. If a point2model
+           binary is set all markers are gathered and passed to
+           `write_markers`
+        :raises UnsetFiducialFileError: If fiducial file set via constructor
+                is None
+        """
+        if self._fiducialfile is None:
+            raise UnsetFiducialFileError('Fiducial File is set to None')
+
+        if self._binary is not None:
+            allmarkers = MarkersList()
+            for markers in markerslists:
+                allmarkers.add_markers(markers.get_indexes(),
+                                       markers.get_x(), markers.get_y(),
+                                       markers.get_z())
+            self.write_markers(allmarkers)
+            return
+
+        writer = IMODModelWriter(self._fiducialfile)
+        writer.set_circle_size(MarkersToIMODFiducialFileWriter.CIRCLE_SIZE)
+        writer.write_contour_iter((m.get_x(), m.get_y(), m.get_z())
+                                  for m in markerslists if len(m) > 0)
+
 
 class CommonByIndexMarkersListFilter(object):
     """Removes Marker objects from Markers objects that don't share indexes with
-       other Markers objects passed into the constructor
+       other Markers objects passed into the constructor or added later
+       with `add_markers_list`
     """
 
     def __init__(self, list_of_markers):
-        """Constructor"""
-        indexDict = {}
+        """Constructor
+        :param list_of_markers: list where each element is either a
+               `MarkersList` or an iterable of `MarkersList` objects
+               such as `MarkersFromIMODFiducialFileFactory.iter_markers`
+               which lets indexes be gathered without holding all
+               markers in memory
+        """
+        self._commonIndexes = numpy.empty(0, dtype=numpy.int64)
+        self._markers_count = 0
         for markersobj in list_of_markers:
-            indexSet = set()
-            for m in markersobj.get_markers():
-                indexSet.add(m.get_index())
-            for i in indexSet:
-                if i not in indexDict:
-                    indexDict[i] = 1
-                else:
-                    indexDict[i] += 1
-
-        self._commonIndexes = []
-        mlist_count = len(list_of_markers)
-        for k in indexDict.keys():
-            if indexDict[k] == mlist_count:
-                self._commonIndexes.append(k)
+            self.add_markers_list(markersobj)
+
+    def add_markers_list(self, markersobj):
+        """Narrows the common indexes down to the indexes that are also
+           in `markersobj`. This lets the common indexes be updated as
+           each Markers object becomes available instead of waiting
+           for all of them
+        :param markersobj: `MarkersList`, `TrackIndex` or iterable of
+                           `MarkersList` objects
+        """
+        if isinstance(markersobj, TrackIndex):
+            indexes = markersobj.get_track_ids()
+        else:
+            if isinstance(markersobj, MarkersList):
+                markersobj = [markersobj]
+            indexes = numpy.unique(numpy.concatenate(
+                [numpy.empty(0, dtype=numpy.int64)] +
+                [numpy.unique(chunk.get_indexes()) for chunk in markersobj]))
+        if self._markers_count == 0:
+            self._commonIndexes = indexes
+        else:
+            self._commonIndexes = numpy.intersect1d(self._commonIndexes,
+                                                    indexes,
+                                                    assume_unique=True)
+        self._markers_count += 1
+
+    def get_markers_list_count(self):
+        """Gets number of Markers objects the common indexes were
+           computed from
+        """
+        return self._markers_count
+
+    def get_common_indexes(self):
+        """Gets indexes found in every Markers object passed into the
+           constructor or `add_markers_list`
+           :returns: sorted numpy int64 array
+        """
+        return self._commonIndexes
+
+    def get_common_mask(self, markers):
+        """Gets mask of markers whose index is common to all Markers
+           objects passed into the constructor. Each index is looked up
+           with a binary search in the sorted common indexes
+           :param markers: MarkersList to check
+           :returns: numpy boolean array with an element per marker
+        """
+        return self._get_common_mask(markers.get_indexes())
+
+    def get_common_track_mask(self, trackindex):
+        """Gets mask of tracks in `trackindex` that are common to all
+           Markers objects. This only looks up each track once instead
+           of every marker
+           :param trackindex: TrackIndex to check
+           :returns: numpy boolean array with an element per track in
+                     `TrackIndex.get_track_ids`
+        """
+        return self._get_common_mask(trackindex.get_track_ids())
+
+    def _get_common_mask(self, indexes):
+        """Looks up each of `indexes` with a binary search in the sorted
+           common indexes
+        """
+        if len(self._commonIndexes) == 0:
+            return numpy.zeros(len(indexes), dtype=bool)
+        pos = numpy.searchsorted(self._commonIndexes, indexes)
+        pos[pos == len(self._commonIndexes)] = 0
+        return self._commonIndexes[pos] == indexes
 
     def filterMarkers(self, markers):
         """Filters out non common markers
+           :param markers: MarkersList or TrackIndex to filter
+           :returns: tuple (common MarkersList, unique MarkersList)
+                     with markers in the same order as `markers` or in
+                     track order if `markers` is a TrackIndex
         """
-        commonM = MarkersList()
-        uniqueM = MarkersList()
-        for m in markers.get_markers():
-            if m.get_index() in self._commonIndexes:
-                commonM.add_marker(m.get_index(), m.get_x(), m.get_y(),
-                                   m.get_z())
-            else:
-                uniqueM.add_marker(m.get_index(), m.get_x(), m.get_y(),
-                                   m.get_z())
+        if isinstance(markers, TrackIndex):
+            mask = numpy.repeat(self.get_common_track_mask(markers),
+                                markers.get_track_lengths())
+            markers = markers.get_markers_list()
+        else:
+            mask = self.get_common_mask(markers)
+        commonM = _get_markers_subset(markers, mask)
+        uniqueM = _get_markers_subset(markers, ~mask)
         return commonM, uniqueM
+
+
+def _get_markers_subset(markers, mask):
+    """Gets new MarkersList with the markers selected by `mask`
+    """
+    subset = MarkersList(compact=markers.is_compact())
+    subset.add_markers(markers.get_indexes()[mask], markers.get_x()[mask],
+                       markers.get_y()[mask], markers.get_z()[mask])
+    return subset
@@ -0,0 +1,547 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import logging
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from etspecutil import util
+
+logger = logging.getLogger(__name__)
+
+
+class InvalidPipelineError(Exception):
+    """Raised when stages of a pipeline do not form a valid dependency
+       graph, such as when there is a cycle, two stages share a name or
+       two stages produce the same output
+    """
+    pass
+
+
+class Stage(object):
+    """A step of a `Pipeline` that reads `inputs` and writes `outputs`
+
+       A stage depends on every other stage that lists one of its
+       inputs as an output. Inputs no stage produces are expected to
+       exist before the pipeline is run.
+    """
+    def __init__(self, name, func, inputs=None, outputs=None, cores=1,
+                 estimate=1.0, params=None):
+        """Constructor
+        :param name: unique name of stage
+        :param func: callable run with the number of cores granted to
+                     the stage as its only argument
+        :param inputs: list of inputs, usually file paths
+        :param outputs: list of outputs, usually file paths
+        :param cores: most cores the stage can use, 0 for stages that
+                      need so little cpu they do not count against the
+                      core budget
+        :param estimate: expected run time in seconds used to prioritize
+                         stages and to estimate the critical path before
+                         the stage has run
+        :param params: list of parameters other than the inputs that
+                       change what the stage writes, a checkpointed
+                       stage is redone when their string form changes
+        """
+        self._name = name
+        self._func = func
+        self._inputs = list(inputs or [])
+        self._outputs = list(outputs or [])
+        self._cores = cores
+        self._estimate = estimate
+        self._params = list(params or [])
+        self._duration = None
+
+    def get_name(self):
+        return self._name
+
+    def get_inputs(self):
+        return self._inputs
+
+    def get_outputs(self):
+        return self._outputs
+
+    def get_cores(self):
+        return self._cores
+
+    def get_estimate(self):
+        return self._estimate
+
+    def get_params(self):
+        return self._params
+
+    def get_duration(self):
+        """Gets run time in seconds of the last run of stage or None
+           if the stage has not run
+        """
+        return self._duration
+
+    def set_duration(self, duration):
+        """Sets run time in seconds of the stage, used for stages that
+           are skipped and for planning with known run times
+        """
+        self._duration = duration
+
+    def run(self, cores):
+        """Runs stage with `cores` cores recording how long it took
+        """
+        start = time.time()
+        try:
+            self._func(cores)
+        finally:
+            self._duration = time.time() - start
+
+
+class StageCheckpoint(object):
+    """Records completed stages in manifest files so a rerun can skip
+       the stages whose work is still valid
+
+       The manifest of a stage holds its parameters and the size,
+       modification time and sha256 hash of every input and output.
+       A stage is complete when its manifest exists, the parameters
+       match and every input and output still has the recorded size
+       and hash. A file whose size and modification time match the
+       manifest is not hashed again, the same shortcut make and git
+       take, so checking a pipeline that has not changed only costs a
+       stat per file. Each file is hashed at most once per instance.
+    """
+    MANIFEST_EXT = '.checkpoint.json'
+
+    def __init__(self, checkpointdir):
+        """Constructor
+        :param checkpointdir: directory manifest files are written to,
+                              created when the first manifest is written
+        """
+        self._checkpointdir = checkpointdir
+        self._lock = threading.Lock()
+        self._hashes = {}
+
+    def get_checkpoint_dir(self):
+        return self._checkpointdir
+
+    def get_manifest_path(self, stage):
+        """Gets path of manifest file for `stage`
+        """
+        return os.path.join(self._checkpointdir,
+                            str(stage.get_name()) +
+                            StageCheckpoint.MANIFEST_EXT)
+
+    def get_fingerprint(self, path, known=None):
+        """Gets fingerprint of file `path`
+        :param known: fingerprint recorded earlier for `path` which is
+                      returned without hashing the file if the size
+                      and modification time still match
+        :returns: dict with size, mtime and sha256 of file or None if
+                  `path` is not a file
+        """
+        if not os.path.isfile(path):
+            return None
+        st = os.stat(path)
+        if (known is not None and known.get('size') == st.st_size and
+                known.get('mtime') == st.st_mtime):
+            return known
+        key = (path, st.st_size, st.st_mtime)
+        self._lock.acquire()
+        try:
+            sha = self._hashes.get(key)
+        finally:
+            self._lock.release()
+        if sha is None:
+            sha = util.get_file_sha256(path)
+            self._lock.acquire()
+            try:
+                self._hashes[key] = sha
+            finally:
+                self._lock.release()
+        return {'size': st.st_size, 'mtime': st.st_mtime, 'sha256': sha}
+
+    def set_hash(self, path, sha):
+        """Records `sha` as the sha256 hash of file `path` as it is now,
+           such as a file put in place from a cache that knows its hash,
+           so `get_fingerprint` does not hash the file
+        """
+        st = os.stat(path)
+        self._lock.acquire()
+        try:
+            self._hashes[(path, st.st_size, st.st_mtime)] = sha
+        finally:
+            self._lock.release()
+
+    def _get_fingerprints(self, paths, known=None):
+        """Gets dict of path to fingerprint of every path in `paths`
+        """
+        known = known or {}
+        return dict([(p, self.get_fingerprint(p, known.get(p)))
+                     for p in paths])
+
+    def _read_manifest(self, stage):
+        """Reads manifest of `stage`
+        :returns: dict or None if there is no readable manifest
+        """
+        path = self.get_manifest_path(stage)
+        if not os.path.isfile(path):
+            return None
+        try:
+            f = open(path, 'r')
+            try:
+                return json.load(f)
+            finally:
+                f.close()
+        except ValueError:
+            logger.warning('Ignoring unreadable manifest ' + path)
+            return None
+
+    def _same_files(self, paths, recorded):
+        """Checks every path in `paths` has the size and hash
+           in `recorded` dict of path to fingerprint
+        """
+        if recorded is None or sorted(recorded.keys()) != sorted(paths):
+            return False
+        for (path, fp) in self._get_fingerprints(paths, recorded).items():
+            known = recorded[path]
+            if fp is None or known is None:
+                if fp is not known:
+                    return False
+                continue
+            if (fp['size'] != known.get('size') or
+                    fp['sha256'] != known.get('sha256')):
+                return False
+        return True
+
+    def is_complete(self, stage):
+        """Checks if `stage` has a manifest that still matches its
+           parameters, inputs and outputs
+        """
+        manifest = self._read_manifest(stage)
+        if manifest is None:
+            return False
+        if manifest.get('params') != [str(p) for p in stage.get_params()]:
+            return False
+        if not self._same_files(stage.get_inputs(), manifest.get('inputs')):
+            return False
+        outputs = manifest.get('outputs')
+        if outputs is None:
+            return False
+        for path in stage.get_outputs():
+            if outputs.get(path) is None:
+                return False
+        return self._same_files(stage.get_outputs(), outputs)
+
+    def remove(self, stage):
+        """Removes manifest of `stage` if there is one
+        """
+        path = self.get_manifest_path(stage)
+        if os.path.isfile(path):
+            os.remove(path)
+
+    def get_input_fingerprints(self, stage):
+        """Gets dict of input path to fingerprint of `stage` which should
+           be taken before the stage runs and passed to `write`
+        """
+        return self._get_fingerprints(stage.get_inputs())
+
+    def write(self, stage, inputs):
+        """Writes manifest of `stage` after it ran. The manifest is
+           written to a temporary file and renamed so a crash never
+           leaves a partial manifest
+        :param inputs: dict from `get_input_fingerprints`
+        """
+        if not os.path.isdir(self._checkpointdir):
+            try:
+                os.makedirs(self._checkpointdir)
+            except OSError:
+                if not os.path.isdir(self._checkpointdir):
+                    raise
+        manifest = {'stage': stage.get_name(),
+                    'params': [str(p) for p in stage.get_params()],
+                    'duration': stage.get_duration(),
+                    'inputs': inputs,
+                    'outputs': self._get_fingerprints(stage.get_outputs())}
+        path = self.get_manifest_path(stage)
+        f = open(path + '.tmp', 'w')
+        try:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+        os.rename(path + '.tmp', path)
+
+
+class Pipeline(object):
+    """Dependency graph of `Stage` objects with a scheduler that runs
+       independent stages concurrently in threads without using more
+       than a budget of cores at once
+
+       Ready stages are started in order of the longest estimated path
+       from them to the end of the pipeline so stages on the critical
+       path go first. Each stage gets as many of the free cores as it
+       can use while leaving one core for every other ready stage.
+
+       With a checkpoint directory every stage that finishes gets a
+       `StageCheckpoint` manifest and stages that are still complete
+       from an earlier run are skipped.
+    """
+    def __init__(self, stages=None, checkpointdir=None):
+        """Constructor
+        :param stages: list of `Stage` objects
+        :param checkpointdir: directory for stage manifests or None to
+                              run every stage every time
+        """
+        self._checkpoint = None
+        if checkpointdir is not None:
+            self._checkpoint = StageCheckpoint(checkpointdir)
+        self._stages = []
+        for stage in stages or []:
+            self.add_stage(stage)
+
+    def add_stage(self, stage):
+        """Adds `stage` to pipeline
+        :raises InvalidPipelineError: if there is already a stage with
+                                      the same name or an output of
+                                      `stage` is produced by another stage
+        """
+        for other in self._stages:
+            if other.get_name() == stage.get_name():
+                raise InvalidPipelineError('Duplicate stage name ' +
+                                           str(stage.get_name()))
+            for output in stage.get_outputs():
+                if output in other.get_outputs():
+                    raise InvalidPipelineError(
+                        'Output ' + str(output) + ' of stage ' +
+                        str(stage.get_name()) + ' is also produced by ' +
+                        str(other.get_name()))
+        self._stages.append(stage)
+
+    def get_stages(self):
+        """Gets list of stages in the order they were added
+        """
+        return self._stages
+
+    def get_checkpoint(self):
+        """Gets `StageCheckpoint` of pipeline or None if it was
+           created without a checkpoint directory
+        """
+        return self._checkpoint
+
+    def is_complete(self):
+        """Checks if every stage has a manifest that still matches,
+           which means running the pipeline would not run any stage.
+           Always False without a checkpoint directory
+        """
+        if self._checkpoint is None:
+            return False
+        for stage in self._stages:
+            if not self._checkpoint.is_complete(stage):
+                return False
+        return True
+
+    def get_dependencies(self):
+        """Gets dependencies of each stage
+        :returns: dict of stage name to list of names of the stages
+                  producing its inputs, in the order stages were added
+        """
+        producers = {}
+        for stage in self._stages:
+            for output in stage.get_outputs():
+                producers[output] = stage.get_name()
+        deps = {}
+        for stage in self._stages:
+            names = set([producers[i] for i in stage.get_inputs()
+                         if i in producers])
+            deps[stage.get_name()] = [s.get_name() for s in self._stages
+                                      if s.get_name() in names]
+        return deps
+
+    def get_order(self):
+        """Gets stage names in an order where every stage comes after
+           the stages it depends on. Ties keep the order stages were
+           added
+        :raises InvalidPipelineError: if the dependencies have a cycle
+        """
+        deps = self.get_dependencies()
+        order = []
+        done = set()
+        while len(order) < len(self._stages):
+            progress = False
+            for stage in self._stages:
+                name = stage.get_name()
+                if name in done:
+                    continue
+                if all([d in done for d in deps[name]]):
+                    order.append(name)
+                    done.add(name)
+                    progress = True
+            if progress is False:
+                raise InvalidPipelineError('Cycle among stages ' +
+                                           ', '.join([s.get_name()
+                                                      for s in self._stages
+                                                      if s.get_name() not in
+                                                      done]))
+        return order
+
+    def _get_path_lengths(self, times):
+        """Gets longest path from each stage to the end of the pipeline
+        :param times: dict of stage name to time of that stage
+        :returns: tuple of dicts (length, next) where next is the name
+                  of the following stage on the longest path or None
+        """
+        deps = self.get_dependencies()
+        length = {}
+        following = {}
+        for name in reversed(self.get_order()):
+            length[name] = times[name]
+            following[name] = None
+            for other in self._stages:
+                oname = other.get_name()
+                if name in deps[oname] and (times[name] + length[oname] >
+                                            length[name]):
+                    length[name] = times[name] + length[oname]
+                    following[name] = oname
+        return length, following
+
+    def get_critical_path(self):
+        """Gets the chain of dependent stages with the longest total
+           time, which is the shortest the pipeline can take no matter
+           how many cores are available. Measured durations are used
+           for stages that have run and estimates for the rest
+        :returns: tuple (list of stage names, total time in seconds)
+        """
+        times = {}
+        for stage in self._stages:
+            if stage.get_duration() is None:
+                times[stage.get_name()] = stage.get_estimate()
+            else:
+                times[stage.get_name()] = stage.get_duration()
+        (length, following) = self._get_path_lengths(times)
+        deps = self.get_dependencies()
+        path = []
+        name = None
+        for stage in self._stages:
+            sname = stage.get_name()
+            if len(deps[sname]) == 0 and (name is None or
+                                          length[sname] > length[name]):
+                name = sname
+        total = 0
+        if name is not None:
+            total = length[name]
+        while name is not None:
+            path.append(name)
+            name = following[name]
+        return path, total
+
+    def run(self, cores):
+        """Runs all stages using no more than `cores` cores at once. If
+           a stage raises an exception no new stages are started and
+           the exception is raised once the running stages finish
+        :param cores: core budget, None is treated as 1
+        :raises InvalidPipelineError: if the dependencies have a cycle
+        :returns: list of names of the stages that ran, which leaves out
+                  stages skipped because their checkpoint was complete
+        """
+        if cores is None:
+            budget = 1
+        else:
+            budget = max(1, int(cores))
+        self.get_order()
+        deps = self.get_dependencies()
+        estimates = dict([(s.get_name(), s.get_estimate())
+                          for s in self._stages])
+        priority = self._get_path_lengths(estimates)[0]
+        stages = dict([(s.get_name(), s) for s in self._stages])
+        waiting = dict([(name, set(d)) for (name, d) in deps.items()])
+
+        free = budget
+        running = {}
+        finished = queue.Queue()
+        error = None
+        ran = []
+        while len(waiting) > 0 or len(running) > 0:
+            if error is None:
+                free = self._start_ready_stages(stages, waiting, priority,
+                                                running, free, budget,
+                                                finished)
+            if len(running) == 0:
+                break
+            (name, exc, skipped) = finished.get()
+            free += running.pop(name)
+            if exc is not None:
+                logger.error('Stage ' + str(name) + ' failed : ' + str(exc))
+                if error is None:
+                    error = exc
+                continue
+            if skipped is False:
+                ran.append(name)
+                logger.debug('Stage ' + str(name) + ' took ' +
+                             str(stages[name].get_duration()) + ' seconds')
+            for remaining in waiting.values():
+                remaining.discard(name)
+        if error is not None:
+            raise error
+
+        (path, total) = self.get_critical_path()
+        logger.info('Critical path ' + ' -> '.join(path) + ' took ' +
+                    str(total) + ' seconds')
+        return [s.get_name() for s in self._stages if s.get_name() in ran]
+
+    def _start_ready_stages(self, stages, waiting, priority, running, free,
+                            budget, finished):
+        """Starts the stages in `waiting` whose dependencies are done
+           while cores are free
+        :returns: number of cores still free
+        """
+        ready = [name for (name, remaining) in waiting.items()
+                 if len(remaining) == 0]
+        order = dict([(s.get_name(), pos)
+                      for (pos, s) in enumerate(self._stages)])
+        ready.sort(key=lambda n: (-priority[n], order[n]))
+        for (pos, name) in enumerate(ready):
+            wanted = min(stages[name].get_cores(), budget)
+            if wanted > 0:
+                reserve = len([n for n in ready[pos + 1:]
+                               if stages[n].get_cores() > 0])
+                wanted = min(wanted, max(1, free - reserve))
+                if wanted > free:
+                    continue
+            del waiting[name]
+            running[name] = wanted
+            free -= wanted
+            logger.debug('Starting stage ' + str(name) + ' with ' +
+                         str(wanted) + ' core(s)')
+            thread = threading.Thread(target=_run_stage,
+                                      args=(stages[name], wanted, finished,
+                                            self._checkpoint))
+            thread.daemon = True
+            thread.start()
+        return free
+
+
+def _run_stage(stage, cores, finished, checkpoint=None):
+    """Runs `stage` in a scheduler thread and puts tuple of its name,
+       the exception it raised or None and whether it was skipped into
+       `finished` queue. With a `checkpoint` the stage is skipped, and
+       given a duration of 0, if it is complete. Otherwise its old
+       manifest is removed before it runs and a new one is written once
+       it succeeds
+    """
+    try:
+        if checkpoint is not None and checkpoint.is_complete(stage):
+            logger.info('Skipping stage ' + str(stage.get_name()) +
+                        ' since its checkpoint is complete')
+            stage.set_duration(0.0)
+            finished.put((stage.get_name(), None, True))
+            return
+        if checkpoint is None:
+            stage.run(cores)
+        else:
+            checkpoint.remove(stage)
+            inputs = checkpoint.get_input_fingerprints(stage)
+            stage.run(cores)
+            checkpoint.write(stage, inputs)
+        finished.put((stage.get_name(), None, False))
+    except Exception as e:
+        finished.put((stage.get_name(), e, False))
@@ -1,12 +1,15 @@
 #! /usr/bin/env python
 
 import sys
+import os.path
 import argparse
 import logging
 import etspecutil
 
 from etspecutil.marker import MarkersFromIMODFiducialFileFactory
 from etspecutil.marker import MarkersToIMODFiducialFileWriter
+from etspecutil.imod import UnsupportedIMODModelError
+from etspecutil import imod
 
 logger = logging.getLogger(__name__)
 
@@ -39,6 +42,7 @@ def _setup_logging(theargs):
     logging.basicConfig(format=theargs.logformat)
     logging.getLogger('etspecutil.marker').setLevel(theargs.numericloglevel)
     logging.getLogger('etspecutil.util').setLevel(theargs.numericloglevel)
+    logging.getLogger('etspecutil.imod').setLevel(theargs.numericloglevel)
 
 
 def shift_fiducial_file_markers(theargs):
@@ -46,16 +50,60 @@ def shift_fiducial_file_markers(theargs):
     """
     logger.info('Fiducial file set to ' + theargs.inputfidfile)
 
+    # a missing input file is left to the code below which logs it
+    if theargs.patch is True and os.path.isfile(theargs.inputfidfile):
+        try:
+            imod.copy_and_shift_points(theargs.inputfidfile,
+                                       theargs.outputfidfile,
+                                       theargs.xshift, theargs.yshift)
+            return
+        except UnsupportedIMODModelError as e:
+            logger.info('Unable to patch fiducial file, falling back '
+                        'to reading and writing markers : ' + str(e))
+
     fac = MarkersFromIMODFiducialFileFactory(theargs.inputfidfile)
+    writer = MarkersToIMODFiducialFileWriter(theargs.outputfidfile)
+
+    if _has_increasing_contour_numbers(theargs.inputfidfile):
+        writer.write_markers_iter(_get_shifted_markers(fac.iter_markers(),
+                                                       theargs.xshift,
+                                                       theargs.yshift))
+        return
 
     markers = fac.get_markers()
 
     markers.shift_markers(theargs.xshift, theargs.yshift, 0)
 
-    writer = MarkersToIMODFiducialFileWriter(theargs.outputfidfile)
     writer.write_markers(markers)
 
 
+def _has_increasing_contour_numbers(fidfile):
+    """Checks if contour numbers of `fidfile` only go up, which is the
+       case for models with a single object. Every contour then holds
+       a distinct index in ascending order and can be shifted and
+       written one at a time. Models with more objects repeat contour
+       numbers whose markers must be merged into one contour
+    """
+    if not os.path.isfile(fidfile):
+        return False
+    try:
+        numbers = imod.IMODModelReader(fidfile).get_contour_numbers()
+    except UnsupportedIMODModelError:
+        return False
+    for pos in range(1, len(numbers)):
+        if numbers[pos] <= numbers[pos - 1]:
+            return False
+    return True
+
+
+def _get_shifted_markers(markerslists, xshift, yshift):
+    """Generator that shifts each MarkersList in `markerslists`
+    """
+    for markers in markerslists:
+        markers.shift_markers(xshift, yshift, 0)
+        yield markers
+
+
 def _parse_arguments(desc, args):
     """Parses command line arguments
     """
@@ -73,6 +121,14 @@ def _parse_arguments(desc, args):
     parser.add_argument("--yshift", default=360, type=int,
                         help='Number of pixels to shift markers in Y '
                              'direction')
+    parser.add_argument("--patch", action='store_true',
+                        help='Copy input file and add shift directly to '
+                             'the point data in the copy. This is faster '
+                             'and keeps all other model data, except the '
+                             'image size in the header, as is. Falls back '
+                             'to reading and writing the markers if the '
+                             'file cannot be patched, such as when it has '
+                             'meshes')
     parser.add_argument("--log", dest="loglevel", default='WARNING',
                         choices=['DEBUG', 'INFO', 'WARNING', 'ERROR',
                                  'CRITICAL'],
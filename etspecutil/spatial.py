@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+
+import math
+import logging
+
+import numpy
+
+logger = logging.getLogger(__name__)
+
+
+class InvalidCellSizeError(Exception):
+    """Raised when cell size of spatial index is not a positive number
+    """
+    pass
+
+
+class SpatialIndex(object):
+    """Grid hash over 2D or 3D points that answers radius and k nearest
+       neighbour queries for many query points at once
+
+       Points are binned into square (cube) cells of `cellsize` and
+       sorted by cell so the points of a cell are a contiguous run
+       located with one binary search. A radius query only looks at
+       the cells overlapping the search radius which makes queries
+       close to linear in the number of points and results when the
+       cell size is on the order of the search radius.
+    """
+
+    def __init__(self, points, cellsize):
+        """Constructor
+        :param points: (N, D) array of point coordinates where D is 2
+                       or 3
+        :param cellsize: edge length of grid cells
+        :raises InvalidCellSizeError: if `cellsize` is not > 0
+        :raises ValueError: if `points` is not a (N, 2) or (N, 3) array
+        """
+        if cellsize is None or not cellsize > 0:
+            raise InvalidCellSizeError('Cell size must be > 0 : ' +
+                                       str(cellsize))
+        points = numpy.asarray(points, dtype=numpy.float64)
+        if points.ndim != 2 or points.shape[1] not in (2, 3):
+            raise ValueError('Points must be a (N, 2) or (N, 3) array')
+
+        self._points = points
+        self._cellsize = float(cellsize)
+        if len(points) > 0:
+            self._origin = points.min(axis=0)
+            cells = self._get_cells(points)
+            self._shape = cells.max(axis=0) + 1
+        else:
+            self._origin = numpy.zeros(points.shape[1])
+            cells = numpy.empty((0, points.shape[1]), dtype=numpy.int64)
+            self._shape = numpy.ones(points.shape[1], dtype=numpy.int64)
+
+        keys = self._get_keys(cells)
+        self._order = numpy.argsort(keys, kind='mergesort')
+        sorted_keys = keys[self._order]
+        (self._keys, starts) = numpy.unique(sorted_keys, return_index=True)
+        self._offsets = numpy.append(starts, len(sorted_keys))
+
+    def __len__(self):
+        """Returns number of points in index
+        """
+        return len(self._points)
+
+    def get_points(self):
+        """Gets (N, D) array of indexed points
+        """
+        return self._points
+
+    def get_cell_size(self):
+        """Gets edge length of grid cells
+        """
+        return self._cellsize
+
+    def _get_cells(self, points):
+        """Gets integer grid cell coordinates of `points`
+        """
+        return numpy.floor((points - self._origin) /
+                           self._cellsize).astype(numpy.int64)
+
+    def _get_keys(self, cells):
+        """Gets a single integer key for each row of grid cell
+           coordinates `cells`. Cells outside the grid get key -1
+        """
+        keys = numpy.zeros(len(cells), dtype=numpy.int64)
+        outside = numpy.zeros(len(cells), dtype=bool)
+        for dim in range(cells.shape[1]):
+            outside |= cells[:, dim] < 0
+            outside |= cells[:, dim] >= self._shape[dim]
+            keys *= self._shape[dim]
+            keys += cells[:, dim]
+        keys[outside] = -1
+        return keys
+
+    def _check_queries(self, queries):
+        """Converts `queries` to (M, D) float64 array
+        :raises ValueError: if dimension does not match the points
+        """
+        queries = numpy.asarray(queries, dtype=numpy.float64)
+        if queries.ndim != 2 or queries.shape[1] != self._points.shape[1]:
+            raise ValueError('Queries must be a (M, ' +
+                             str(self._points.shape[1]) + ') array')
+        return queries
+
+    def _get_candidates(self, queries, radius):
+        """Gets all (query, point) pairs where the point is in a cell
+           that overlaps the box of +/- `radius` around the query
+        :returns: tuple of arrays (query positions, point positions)
+        """
+        empty = numpy.empty(0, dtype=numpy.int64)
+        if len(self._keys) == 0 or len(queries) == 0:
+            return empty, empty
+
+        reach = int(math.ceil(radius / self._cellsize))
+        dims = queries.shape[1]
+        if (2 * reach + 1) ** dims >= len(self._keys):
+            # box spans more cells than are occupied so every point is
+            # a candidate
+            return (numpy.repeat(numpy.arange(len(queries)),
+                                 len(self._points)),
+                    numpy.tile(numpy.arange(len(self._points)),
+                               len(queries)))
+
+        cells = self._get_cells(queries)
+        stencil = numpy.indices((2 * reach + 1,) * dims).reshape(dims, -1).T
+        stencil -= reach
+        query_pos = [empty]
+        point_pos = [empty]
+        for delta in stencil:
+            keys = self._get_keys(cells + delta)
+            slots = numpy.searchsorted(self._keys, keys)
+            slots[slots == len(self._keys)] = 0
+            hits = numpy.flatnonzero((keys >= 0) &
+                                     (self._keys[slots] == keys))
+            starts = self._offsets[slots[hits]]
+            lengths = self._offsets[slots[hits] + 1] - starts
+            total = int(lengths.sum())
+            if total == 0:
+                continue
+            first = numpy.cumsum(lengths) - lengths
+            runs = numpy.arange(total) - numpy.repeat(first - starts,
+                                                      lengths)
+            query_pos.append(numpy.repeat(hits, lengths))
+            point_pos.append(self._order[runs])
+        return numpy.concatenate(query_pos), numpy.concatenate(point_pos)
+
+    def query_radius(self, queries, radius):
+        """Finds indexed points within `radius` of each query point
+
+        :param queries: (M, D) array of query points
+        :param radius: search radius, points at exactly `radius` are
+                       included
+        :returns: tuple (offsets, indices, distances) in compressed
+                  sparse row form where the matches of query N are
+                  indices[offsets[N]:offsets[N + 1]], sorted by distance
+                  and then by position in the indexed points
+        """
+        queries = self._check_queries(queries)
+        (query_pos, point_pos) = self._get_candidates(queries, radius)
+        distances = numpy.sqrt(((queries[query_pos] -
+                                 self._points[point_pos]) ** 2).sum(axis=1))
+        keep = distances <= radius
+        query_pos = query_pos[keep]
+        point_pos = point_pos[keep]
+        distances = distances[keep]
+
+        order = numpy.lexsort((point_pos, distances, query_pos))
+        counts = numpy.bincount(query_pos, minlength=len(queries))
+        offsets = numpy.concatenate(([0], numpy.cumsum(counts)))
+        return offsets, point_pos[order], distances[order]
+
+    def query_knn(self, queries, k):
+        """Finds the `k` indexed points nearest to each query point
+
+           The search radius starts at the cell size and is doubled for
+           the queries that do not yet have `k` points within it until
+           the radius spans all indexed points.
+
+        :param queries: (M, D) array of query points
+        :param k: number of neighbours to find
+        :returns: tuple (indices, distances) of (M, k) arrays sorted by
+                  distance. If there are fewer than `k` points the
+                  remaining entries are -1 with an infinite distance
+        """
+        queries = self._check_queries(queries)
+        indices = numpy.empty((len(queries), k), dtype=numpy.int64)
+        indices.fill(-1)
+        distances = numpy.empty((len(queries), k))
+        distances.fill(numpy.inf)
+        if len(self._points) == 0 or k <= 0:
+            return indices, distances
+
+        lower = self._points.min(axis=0)
+        upper = self._points.max(axis=0)
+        # distance from each query to the farthest indexed point is at
+        # most the distance to the farthest corner of their bounding box
+        farthest = numpy.sqrt((numpy.maximum(numpy.abs(queries - lower),
+                                             numpy.abs(queries - upper)) **
+                               2).sum(axis=1))
+        todo = numpy.arange(len(queries))
+        radius = self._cellsize
+        while len(todo) > 0:
+            (offsets, found, dists) = self.query_radius(queries[todo],
+                                                        radius)
+            counts = numpy.diff(offsets)
+            exhausted = farthest[todo] <= radius
+            done = (counts >= k) | exhausted
+            owner = numpy.repeat(numpy.arange(len(todo)), counts)
+            rank = numpy.arange(len(found)) - offsets[owner]
+            take = (rank < k) & done[owner]
+            indices[todo[owner[take]], rank[take]] = found[take]
+            distances[todo[owner[take]], rank[take]] = dists[take]
+            todo = todo[~done]
+            radius *= 2
+        return indices, distances
+
+    def find_pairs(self, radius):
+        """Finds pairs of indexed points no more than `radius` apart
+
+        :returns: tuple (first, second, distances) of arrays where
+                  first < second, sorted by first then second
+        """
+        (offsets, found, dists) = self.query_radius(self._points, radius)
+        first = numpy.repeat(numpy.arange(len(self._points)),
+                             numpy.diff(offsets))
+        keep = first < found
+        first = first[keep]
+        second = found[keep]
+        dists = dists[keep]
+        order = numpy.lexsort((second, first))
+        return first[order], second[order], dists[order]
+
+
+def get_markers_spatial_index(markers, cellsize, usez=False):
+    """Creates SpatialIndex over the x and y (and z if `usez` is True)
+       coordinates of all markers in a MarkersList. Markers with any
+       field set to `None` are left out
+
+    :param markers: MarkersList
+    :returns: tuple (SpatialIndex, positions) where positions maps each
+              indexed point to its position in `markers`
+    """
+    positions = numpy.flatnonzero(markers.get_valid_mask())
+    columns = [markers.get_x()[positions], markers.get_y()[positions]]
+    if usez is True:
+        columns.append(markers.get_z()[positions])
+    return SpatialIndex(numpy.column_stack(columns), cellsize), positions
+
+
+def get_tilt_spatial_index(trackindex, z, cellsize):
+    """Creates SpatialIndex over the x and y coordinates of the markers
+       in tilt slice `z` of a TrackIndex
+
+    :param trackindex: TrackIndex
+    :returns: tuple (SpatialIndex, indexes) where indexes holds the
+              track index of each indexed point
+    """
+    (indexes, xs, ys) = trackindex.get_tilt(z)
+    return SpatialIndex(numpy.column_stack((xs, ys)), cellsize), indexes
@@ -5,14 +5,88 @@ import logging
 import re
 import math
 import shutil
+import itertools
+import threading
+from multiprocessing.pool import ThreadPool
 from etspecutil import util
+from etspecutil.cache import ContentCache
+from etspecutil import cache
+from etspecutil.marker import MarkersList
 from etspecutil.marker import MarkersFrom3DMarkersFileFactory
 from etspecutil.marker import CommonByIndexMarkersListFilter
+from etspecutil.marker import MarkersToIMODFiducialFileWriter
+from etspecutil.marker import CoordinateFrame
+from etspecutil.pipeline import Stage
+from etspecutil.pipeline import Pipeline
 
 
 logger = logging.getLogger(__name__)
 
 
+class TiltSeriesContext(object):
+    """Holds the state a stage of `TiltSeriesCreator` works with, the
+       directory its files live in, the cores it may use and the
+       rotation it is for. Each rotation gets its own context and
+       commands are run in the context directory without changing
+       the working directory of the process so stages of different
+       rotations can run at the same time in threads
+    """
+    def __init__(self, workdir, cores, rotation=None):
+        """Constructor
+        :param workdir: absolute path of directory the stage works in
+        :param cores: number of cores the stage may use
+        :param rotation: rotation in degrees or None for stages that
+                         are not specific to a rotation
+        """
+        self._workdir = workdir
+        self._cores = cores
+        self._rotation = rotation
+
+    def get_workdir(self):
+        return self._workdir
+
+    def get_cores(self):
+        return self._cores
+
+    def get_rotation(self):
+        return self._rotation
+
+    def get_with_cores(self, cores):
+        """Gets copy of this context that may use `cores` cores
+        """
+        return TiltSeriesContext(self._workdir, cores, self._rotation)
+
+    def get_warpz_dir(self):
+        """Gets warpz dir
+        """
+        return os.path.join(self._workdir,
+                            TiltSeriesCreator.WARPZ_DIR_NAME)
+
+    def get_marker_dir(self):
+        """Gets marker dir
+        """
+        return os.path.join(self._workdir,
+                            TiltSeriesCreator.MARKER_DIR_NAME)
+
+    def get_projection_dir(self):
+        """Gets projection directory
+        """
+        return os.path.join(self._workdir,
+                            TiltSeriesCreator.PROJECTION_DIR_NAME)
+
+    def get_tracking_dir(self):
+        """Gets tracking directory
+        """
+        return os.path.join(self._workdir,
+                            TiltSeriesCreator.TRACKING_DIR_NAME)
+
+    def get_checkpoint_dir(self):
+        """Gets directory of stage checkpoint manifests
+        """
+        return os.path.join(self._workdir,
+                            TiltSeriesCreator.CHECKPOINT_DIR_NAME)
+
+
 class TiltSeriesCreator(object):
     """Creates a phantom tilt series using ETSpec
     """
@@ -34,6 +108,7 @@ class TiltSeriesCreator(object):
     TRACKING_DIR_NAME = 'tracking'
     TILTSERIES_DIR_NAME = 'tiltseries'
     PREPARED_DIR_NAME = 'prepared'
+    CHECKPOINT_DIR_NAME = 'checkpoint'
     THREE_D_MARKERS_TXT = '3Dmarkers.txt'
     PROJECTION = '_projection'
     PROJECTION_EXT = PROJECTION + MRC_EXT
@@ -55,6 +130,7 @@ class TiltSeriesCreator(object):
                         theargs.endtilt
                         theargs.tiltshift
                         theargs.cores
+                        theargs.parallelrotations
                         theargs.mpiexec
                         theargs.nummarkers
                         theargs.bottommarkersize
@@ -67,15 +143,18 @@ class TiltSeriesCreator(object):
                         theargs.numrotations
                         theargs.rotatinoangles
                         theargs.etspecbin
+                        theargs.cachedir
         :raises AttributeError: if the above attributes are not set
         """
         self._outdir = theargs.outputdirectory
-        self._workdir = os.getcwd()
         self._inputmrc = os.path.abspath(theargs.inputmrcfile)
         self._begintilt = theargs.begintilt
         self._endtilt = theargs.endtilt
         self._tiltshift = theargs.tiltshift
         self._cores = theargs.cores
+        if self._cores is None:
+            self._cores = util.get_cpu_count()
+        self._parallelrotations = theargs.parallelrotations
         self._mpiexec = theargs.mpiexec
         self._nummarkers = theargs.nummarkers
         self._bottommarkersize = theargs.bottommarkersize
@@ -99,18 +178,26 @@ class TiltSeriesCreator(object):
         else:
             self._etspecbin = os.path.abspath(theargs.etspecbin)
 
+        self._cache = None
+        if theargs.cachedir != '':
+            self._cache = ContentCache(os.path.abspath(theargs.cachedir))
+        self._cachelock = threading.Lock()
+        self._inputmrchash = None
+        self._rotatelock = threading.Lock()
+        self._rotatedmarkers = None
+        self._markerrotations = []
+
     def initialize(self):
         """Initializes file system
         """
+        self._outdir = os.path.abspath(self._outdir)
         if not os.path.isdir(self._outdir):
             os.makedirs(self._outdir)
-            os.chdir(self._outdir)
-            self._outdir = os.getcwd()
 
-        preparedir = os.path.join(self._outdir,
-                                  TiltSeriesCreator.PREPARED_DIR_NAME)
-        if not os.path.isdir(preparedir):
-            os.makedirs(preparedir)
+        self._preparedir = os.path.join(self._outdir,
+                                        TiltSeriesCreator.PREPARED_DIR_NAME)
+        if not os.path.isdir(self._preparedir):
+            os.makedirs(self._preparedir)
 
         self._inputmrcname = os.path.basename(self._inputmrc)
 
@@ -158,133 +245,255 @@ class TiltSeriesCreator(object):
 
     def prepare_mrc_for_tiltseries_generation(self):
         """Performs initial steps needed to generate tilt series
+           running the stages of `_get_prepare_pipeline` that do not
+           depend on each other at the same time. Stages left complete
+           by an earlier run, according to their checkpoint, are skipped
         """
-        current_working_dir = os.getcwd()
+        ctx = self._get_prepared_context()
+        self._get_prepare_pipeline(ctx).run(ctx.get_cores())
+
+    def _get_stage(self, name, method, ctx, inputs, outputs, cores,
+                   params=None):
+        """Gets `Stage` that calls `method` with a copy of `ctx` using
+           the cores the scheduler granted the stage
+        :param params: parameters passed to the command of the stage
+                       other than its input files
+        """
+        return Stage(name, lambda granted: method(ctx.get_with_cores(granted)),
+                     inputs=inputs, outputs=outputs, cores=cores,
+                     params=params)
+
+    def _get_prepare_pipeline(self, ctx):
+        """Gets `Pipeline` of the stages run in the prepared directory.
+           rawtlt and the parameter and project files do not depend on
+           the all_255, extend_mean, warpZ_inter_del and volume_marker
+           chain so they run alongside it
+        """
+        workdir = ctx.get_workdir()
+        unimrc = os.path.join(workdir, self._unimrc)
+        extmeanmrc = os.path.join(workdir, self._extmeanmrc)
+        warpz = os.path.join(ctx.get_warpz_dir(), self._warpz)
+        cores = int(ctx.get_cores() or 1)
+        tilts = [self._begintilt, self._tiltshift, self._endtilt]
+        markers = [self._nummarkers, self._bottommarkersize,
+                   self._topmarkersize, self._markernoise, self._markera,
+                   self._aparam]
+        rawtlt = os.path.join(workdir, self._rawtlt)
+        pipe = Pipeline(checkpointdir=ctx.get_checkpoint_dir())
+        check = pipe.get_checkpoint()
+        stages = [
+            self._get_stage('all_255',
+                            self._get_cached('all_255', self._run_all_255,
+                                             [unimrc], check),
+                            ctx, [self._inputmrc], [unimrc], cores),
+            self._get_stage('extend_mean',
+                            self._get_cached('extend_mean',
+                                             self._run_extend_mean,
+                                             [extmeanmrc], check),
+                            ctx, [unimrc], [extmeanmrc], cores),
+            self._get_stage('rawtlt',
+                            self._get_cached('rawtlt', self._run_raw_tilt,
+                                             [rawtlt], check),
+                            ctx, [], [rawtlt], 1, params=tilts),
+            self._get_stage('warpZ_inter_del',
+                            self._get_cached('warpZ_inter_del',
+                                             self._run_warpz, [warpz],
+                                             check),
+                            ctx, [extmeanmrc], [warpz], cores, params=tilts),
+            self._get_stage('volume_marker', self._run_volume_marker, ctx,
+                            [extmeanmrc, warpz],
+                            [os.path.join(ctx.get_marker_dir(),
+                                          self._markermrc),
+                             os.path.join(ctx.get_marker_dir(),
+                                          TiltSeriesCreator.
+                                          THREE_D_MARKERS_TXT)], cores,
+                            params=markers + tilts),
+            self._get_stage('parameter_file',
+                            self._write_etspec_parameter_file, ctx, [],
+                            [os.path.join(workdir, self._mrcname +
+                                          TiltSeriesCreator.PAR_EXT)], 0,
+                            params=tilts + markers +
+                            [self._shrinkage, self._projmaxangle]),
+            self._get_stage('project_file',
+                            self._write_etspec_prepared_project_file, ctx,
+                            [], [os.path.join(workdir, self._mrcname +
+                                              TiltSeriesCreator.PRO_EXT)],
+                            0, params=[self._inputmrc])]
+        for stage in stages:
+            pipe.add_stage(stage)
+        return pipe
+
+    def _get_cached(self, name, method, outputs, checkpoint=None):
+        """Gets function that takes a context like `method` and puts
+           the `outputs` of prepare stage `name` in place from the
+           content cache, only running `method` and adding its outputs
+           to the cache when the cache has no entry for the stage.
+
+           The `outputs` are removed before `method` runs, with or
+           without a cache, since they may be hard links into the cache
+           left by an earlier run that must not be written over
+        :param checkpoint: `StageCheckpoint` of the prepare pipeline
+                           whose hash of the input mrc file is reused
+                           for the cache key and which is given the
+                           hashes stored with a cache entry so outputs
+                           from the cache are not hashed again
+        """
+        def run_cached(ctx):
+            key = None
+            if self._cache is not None:
+                key = self._get_cache_key(name, checkpoint)
+                if self._cache.fetch(key, outputs):
+                    logger.info('Reusing cached output of ' + name)
+                    digests = self._cache.get_digests(key)
+                    if checkpoint is not None and digests is not None:
+                        for (path, sha) in zip(outputs, digests):
+                            checkpoint.set_hash(path, sha)
+                    return
+            for path in outputs:
+                if os.path.lexists(path):
+                    os.remove(path)
+            method(ctx)
+            if key is not None:
+                self._cache.store(key, outputs,
+                                  self._get_output_digests(outputs,
+                                                           checkpoint))
+        return run_cached
+
+    def _get_output_digests(self, outputs, checkpoint):
+        """Gets sha256 hashes of `outputs` from `checkpoint` which keeps
+           them for the manifest it writes once the stage is done
+        :returns: list of hex digests or None if there is no checkpoint
+                  or an output is missing
+        """
+        if checkpoint is None:
+            return None
+        digests = []
+        for path in outputs:
+            fp = checkpoint.get_fingerprint(path)
+            if fp is None:
+                return None
+            digests.append(fp['sha256'])
+        return digests
+
+    def _get_cache_key(self, name, checkpoint=None):
+        """Gets content cache key of prepare stage `name`. all_255 is
+           keyed by the hash of the input mrc file, extend_mean and
+           warpZ_inter_del by the key of the stage they read from and
+           rawtlt and warpZ_inter_del by the tilt range. None of them
+           depend on the marker parameters
+        :param checkpoint: `StageCheckpoint` passed to
+                           `_get_input_mrc_hash`
+        """
+        tilts = [float(self._begintilt), float(self._tiltshift),
+                 float(self._endtilt)]
+        if name == 'all_255':
+            return cache.get_key([name,
+                                  self._get_input_mrc_hash(checkpoint)])
+        if name == 'extend_mean':
+            return cache.get_key([name, self._get_cache_key('all_255',
+                                                            checkpoint)])
+        if name == 'rawtlt':
+            return cache.get_key([name] + tilts)
+        return cache.get_key([name, self._get_cache_key('extend_mean',
+                                                        checkpoint)] +
+                             tilts)
+
+    def _get_input_mrc_hash(self, checkpoint=None):
+        """Gets sha256 hash of input mrc file. With a `checkpoint` the
+           hash it took of the input mrc file before all_255 ran is
+           reused, otherwise the hash is computed once
+        :param checkpoint: `StageCheckpoint` of the prepare pipeline
+        :raises IOError: if the input mrc file cannot be read
+        """
+        if checkpoint is not None:
+            fp = checkpoint.get_fingerprint(self._inputmrc)
+            if fp is not None:
+                return fp['sha256']
+        self._cachelock.acquire()
         try:
-            logger.debug('Changing to ' + self._outdir + ' directory')
-            os.chdir(self._outdir)
-            logger.debug('Changing to ' + TiltSeriesCreator.PREPARED_DIR_NAME +
-                         ' directory')
-            os.chdir(TiltSeriesCreator.PREPARED_DIR_NAME)
-            self._workdir = os.getcwd()
-            self._preparedir = self._workdir
-
-            # run all_255
-            self._run_all_255()
-
-            # run extend_mean
-            self._run_extend_mean()
-
-            # run rawtilt
-            self._run_raw_tilt()
-
-            # run warpz
-            self._run_warpz()
-
-            # run volume_marker
-            self._run_volume_marker()
-
-            # write the parameter file
-            self._write_etspec_parameter_file()
-            self._write_etspec_prepared_project_file()
-
+            if self._inputmrchash is None:
+                self._inputmrchash = util.get_file_sha256(self._inputmrc)
+            return self._inputmrchash
         finally:
-            logger.debug('Changing back to ' + current_working_dir +
-                         ' directory')
-            os.chdir(current_working_dir)
+            self._cachelock.release()
 
-    def _run_all_255(self):
+    def _get_prepared_context(self):
+        """Gets context of the stages run in the prepared directory
+        """
+        return TiltSeriesContext(self._preparedir, self._cores)
+
+    def _run_all_255(self, ctx):
         """Runs all_255 command
         """
         cmd = (os.path.join(self._etspecbin, 'all_255') + ' ' +
                self._inputmrc + ' ' +
-               os.path.join(self._workdir, self._unimrc))
+               os.path.join(ctx.get_workdir(), self._unimrc))
         exitcode, out, err = util.run_mpiexec_command(cmd, self._mpiexec,
-                                                      self._cores)
+                                                      ctx.get_cores(),
+                                                      cwd=ctx.get_workdir())
         if exitcode != 0:
             raise Exception('Unable to run all_255 : ' + err)
 
-    def _run_extend_mean(self):
+    def _run_extend_mean(self, ctx):
         """Runs exteand_mean command
         """
         cmd = (os.path.join(self._etspecbin, 'extend_mean') + ' ' +
-               os.path.join(self._workdir, self._unimrc) + ' ' +
-               os.path.join(self._workdir, self._extmeanmrc))
+               os.path.join(ctx.get_workdir(), self._unimrc) + ' ' +
+               os.path.join(ctx.get_workdir(), self._extmeanmrc))
         exitcode, out, err = util.run_mpiexec_command(cmd, self._mpiexec,
-                                                      self._cores)
+                                                      ctx.get_cores(),
+                                                      cwd=ctx.get_workdir())
         if exitcode != 0:
             raise Exception('Unable to run extend_mean : ' + err)
 
-    def _run_raw_tilt(self):
+    def _run_raw_tilt(self, ctx):
         """Runs exteand_mean command
         """
         cmd = (os.path.join(self._etspecbin, 'rawtlt') + ' ' +
                str(self._begintilt) + ' ' + str(self._tiltshift) + ' ' +
                str(self._endtilt) + ' ' +
-               os.path.join(self._workdir, self._rawtlt))
+               os.path.join(ctx.get_workdir(), self._rawtlt))
 
         exitcode, out, err = util.run_mpiexec_command(cmd, self._mpiexec,
-                                                      1)
+                                                      1,
+                                                      cwd=ctx.get_workdir())
         if exitcode != 0:
             raise Exception('Unable to run rawtlt : ' + err)
 
-    def _get_warpz_dir(self):
-        """Gets warpz dir
-        """
-        return os.path.join(self._workdir,
-                            TiltSeriesCreator.WARPZ_DIR_NAME)
-
-    def _get_marker_dir(self):
-        """Gets marker dir
-        """
-        return os.path.join(self._workdir,
-                            TiltSeriesCreator.MARKER_DIR_NAME)
-
-    def _get_projection_dir(self):
-        """Gets projection directory
-        """
-        return os.path.join(self._workdir,
-                            TiltSeriesCreator.PROJECTION_DIR_NAME)
-
-    def _get_tracking_dir(self):
-        """Gets tracking directory
-        """
-        return os.path.join(self._workdir,
-                            TiltSeriesCreator.TRACKING_DIR_NAME)
-
     def _get_result_dir(self):
         return os.path.join(self._outdir,
                             TiltSeriesCreator.RESULT_DIR_NAME)
 
-    def _run_warpz(self):
+    def _run_warpz(self, ctx):
         """Runs exteand_mean command
         """
-        warpzdir = self._get_warpz_dir()
+        warpzdir = ctx.get_warpz_dir()
         if not os.path.isdir(warpzdir):
             os.makedirs(warpzdir)
 
         cmd = (os.path.join(self._etspecbin, 'warpZ_inter_del') + ' ' +
-               os.path.join(self._workdir, self._extmeanmrc) + ' ' +
-               os.path.join(self._workdir, self._extmeanmrc) + ' ' +
+               os.path.join(ctx.get_workdir(), self._extmeanmrc) + ' ' +
+               os.path.join(ctx.get_workdir(), self._extmeanmrc) + ' ' +
                os.path.join(warpzdir, self._warpz) + ' ' +
                str(self._get_number_of_tilts()) + ' 0 0 0 0')
 
         exitcode, out, err = util.run_mpiexec_command(cmd, self._mpiexec,
-                                                      self._cores)
+                                                      ctx.get_cores(),
+                                                      cwd=ctx.get_workdir())
         if exitcode != 0:
             raise Exception('Unable to run warpZ_inter_del : ' + err)
 
-    def _run_volume_marker(self):
+    def _run_volume_marker(self, ctx):
         """Runs exteand_mean command
         """
-        markerdir = self._get_marker_dir()
+        markerdir = ctx.get_marker_dir()
         if not os.path.isdir(markerdir):
             os.makedirs(markerdir)
 
-        warpzdir = self._get_warpz_dir()
+        warpzdir = ctx.get_warpz_dir()
 
         cmd = (os.path.join(self._etspecbin, 'volume_marker') + ' ' +
-               os.path.join(self._workdir, self._extmeanmrc) + ' ' +
+               os.path.join(ctx.get_workdir(), self._extmeanmrc) + ' ' +
                os.path.join(warpzdir, self._warpz) + ' ' +
                os.path.join(markerdir, self._markermrc) + ' ' +
                str(self._nummarkers) + ' ' +
@@ -296,7 +505,8 @@ class TiltSeriesCreator(object):
                str(self._aparam))
 
         exitcode, out, err = util.run_mpiexec_command(cmd, self._mpiexec,
-                                                      self._cores)
+                                                      ctx.get_cores(),
+                                                      cwd=ctx.get_workdir())
         if exitcode != 0:
             raise Exception('Unable to run rawtlt : ' + err)
 
@@ -314,66 +524,153 @@ class TiltSeriesCreator(object):
     def create_tiltseries(self):
         """Using output from `generate_basetiltseries` creates tiltseries
 
+           Rotation directories left by an earlier run are kept and
+           only the stages of a rotation whose checkpoint is incomplete
+           or out of date are run again.
+
            The generated tilt series are compatible with Txbr 3.0.0
         """
         dirlist = []
+        todo = []
+        existing = []
         for rotation in self._rotationangles:
-            logger.info('Creating tilt series for rotation: ' + str(rotation))
             rotationdir = os.path.join(self._outdir, str(rotation) + '_' +
                                        TiltSeriesCreator.TILTSERIES_DIR_NAME)
-            if os.path.isdir(rotationdir):
+            dirlist.append(rotationdir)
+            if not os.path.isdir(rotationdir):
+                os.makedirs(rotationdir)
+            elif self._get_rotation_pipeline(TiltSeriesContext(
+                    rotationdir, self._cores,
+                    rotation=rotation)).is_complete():
                 logger.info('Skipping rotation ' + str(rotation) +
-                            ' since directory exists')
+                            ' since its checkpoints are complete')
+                existing.append(rotationdir)
                 continue
+            else:
+                logger.info('Redoing out of date stages of rotation ' +
+                            str(rotation))
+            todo.append((rotation, rotationdir))
+
+        # 3Dmarkers.txt is rotated for all rotations to do at once the
+        # first time a rotate_3dmarkers stage runs
+        self._set_marker_rotations([r for (r, d) in todo])
+
+        # rotations already on disk go into the common marker filter
+        # first and each new rotation is added as soon as it is done.
+        # Rotations without markers are left out
+        filt = CommonByIndexMarkersListFilter([])
+        jobs = {}
+        for rotationdir in itertools.chain(
+                existing, self._generate_tilt_series_for_rotations(todo)):
+            job = self._add_to_common_markers_filter(rotationdir, filt)
+            if job is None:
+                dirlist.remove(rotationdir)
+            else:
+                jobs[rotationdir] = job
 
-            logger.info('Copying prepared dir to ' + rotationdir)
-            shutil.copytree(self._preparedir, rotationdir)
-            os.chdir(rotationdir)
-            # do processing here
-            self._generate_tilt_series(rotation, rotationdir)
-            dirlist.append(rotationdir)
-            os.chdir(self._outdir)
-
-        self._generate_common_marker_files(dirlist)
-
-    def _get_common_markers_filter(self, dirlist):
-        mlist = []
-        for path in dirlist:
-            logger.debug('Loading markers from ' + path)
-            self._workdir = path
-            two_d_txt = os.path.join(self._get_tracking_dir(),
-                                     TiltSeriesCreator.TWO_D_MARKERS_ALL_TXT)
-            mfac = MarkersFrom3DMarkersFileFactory(two_d_txt)
-            markers = mfac.get_markerslist()
-            mlist.append(markers)
-
-        return CommonByIndexMarkersListFilter(mlist)
+        self._generate_common_marker_files([jobs[path] for path in dirlist],
+                                           filt)
+        self._put_all_tilts_into_result_dir(dirlist)
 
-    def _generate_common_marker_files(self, dirlist):
-        """For each rotation eliminate missing tracks and write out
-           a new marker file and .fid file for each rotationdir
+    def _generate_tilt_series_for_rotations(self, todo):
+        """Generates tilt series for every rotation in `todo`. Up to
+           `parallelrotations` rotations are run at once in a thread
+           pool, each with its own `TiltSeriesContext`, and the `cores`
+           are split between them by `util.get_core_budget` so the
+           concurrent mpiexec jobs never use more than `cores` in total
+
+        :param todo: list of (rotation, rotationdir) tuples
+        :returns: generator yielding each rotationdir as soon as its
+                  tilt series is done, which is not necessarily in the
+                  order of `todo` when rotations are run in parallel
         """
-        filt = self._get_common_markers_filter(dirlist)
+        (concurrent, cores) = util.get_core_budget(
+            self._cores, min(int(self._parallelrotations), len(todo)))
+        if concurrent < min(int(self._parallelrotations), len(todo)):
+            logger.warning('Running ' + str(concurrent) + ' rotation(s) at '
+                           'a time instead of ' +
+                           str(self._parallelrotations) + ' since only ' +
+                           str(self._cores) + ' core(s) are available, '
+                           'raise --cores to run more')
+        contexts = [TiltSeriesContext(rotationdir, cores, rotation=rotation)
+                    for (rotation, rotationdir) in todo]
+        if concurrent <= 1:
+            for ctx in contexts:
+                yield self._generate_tilt_series(ctx)
+            return
+
+        logger.info('Creating tilt series for ' + str(len(todo)) +
+                    ' rotations ' + str(concurrent) + ' at a time with ' +
+                    str(cores) + ' core(s) each')
+        pool = ThreadPool(concurrent)
+        try:
+            for rotationdir in pool.imap_unordered(
+                    self._generate_tilt_series, contexts):
+                yield rotationdir
+        except Exception:
+            pool.terminate()
+            raise
+        finally:
+            pool.close()
+            pool.join()
 
-        for path in dirlist:
-            logger.debug('Saving common markers for ' + path)
-            self._workdir = path
-            two_d_txt = os.path.join(self._get_tracking_dir(),
-                                     TiltSeriesCreator.TWO_D_MARKERS_ALL_TXT)
-            mfac = MarkersFrom3DMarkersFileFactory(two_d_txt)
-            markers = mfac.get_markerslist()
-            com, uni = filt.filterMarkers(markers)
-            for m in uni.get_markers():
-                logger.debug('Unique marker ommitted: ' +
-                             m.get_3dmarker_format())
+    def _load_two_d_markers_all(self, path):
+        """Loads 2Dmarkers_all.txt from tracking directory of `path`
+        :returns: MarkersList
+        """
+        two_d_txt = os.path.join(path, TiltSeriesCreator.TRACKING_DIR_NAME,
+                                 TiltSeriesCreator.TWO_D_MARKERS_ALL_TXT)
+        mfac = MarkersFrom3DMarkersFileFactory(two_d_txt, usecache=True)
+        return mfac.get_markerslist()
+
+    def _add_to_common_markers_filter(self, path, filt):
+        """Loads markers tracked in rotation directory `path` and
+           narrows the common indexes of `filt` down to the tracks
+           in that rotation
+
+        :returns: tuple (path, markers, clipframe, fullframe) to pass
+                  to `_generate_common_marker_files` or None if `path`
+                  has no 2Dmarkers_all.txt file
+        """
+        two_d_txt = os.path.join(path, TiltSeriesCreator.TRACKING_DIR_NAME,
+                                 TiltSeriesCreator.TWO_D_MARKERS_ALL_TXT)
+        if not os.path.isfile(two_d_txt):
+            logger.warning('Leaving out ' + path + ' since ' + two_d_txt +
+                           ' does not exist')
+            return None
+
+        logger.debug('Loading markers from ' + path)
+        markers = self._load_two_d_markers_all(path)
+        (fullframe, clipframe) = self._get_projection_frames(
+            self._get_prepared_context())
+        filt.add_markers_list(markers)
+        logger.info(str(len(filt.get_common_indexes())) + ' tracks common '
+                    'to ' + str(filt.get_markers_list_count()) +
+                    ' rotation(s)')
+        return path, markers, clipframe, fullframe
+
+    def _generate_common_marker_files(self, jobs, filt):
+        """For each rotation eliminate missing tracks and write out
+           a new marker file and .fid files for each rotationdir
 
-            com_txt = os.path.join(self._get_tracking_dir(),
-                                   TiltSeriesCreator.TWO_D_MARKERS_COMMON_TXT)
-            com.write_markers_to_file(com_txt)
-            self._run_point2model_common()
-            self._run_shift_fidfilemarkers_common()
+           The markers loaded by `_add_to_common_markers_filter` are
+           reused so 2Dmarkers_all.txt files are not read again. The
+           output files of the rotations are written in parallel by up
+           to `cores` threads
 
-        self._put_all_tilts_into_result_dir(dirlist)
+        :param jobs: list of tuples returned by
+                     `_add_to_common_markers_filter`
+        :param filt: CommonByIndexMarkersListFilter holding the tracks
+                     common to all rotations
+        """
+        concurrent = util.get_core_budget(self._cores, max(1, len(jobs)))[0]
+        pool = ThreadPool(concurrent)
+        try:
+            pool.map(self._write_common_marker_files_for_job,
+                     [job + (filt,) for job in jobs])
+        finally:
+            pool.close()
+            pool.join()
 
     def _put_all_tilts_into_result_dir(self, dirlist):
 
@@ -381,6 +678,7 @@ class TiltSeriesCreator(object):
         if not os.path.isdir(resultdir):
             os.makedirs(resultdir)
 
+        rawtlt = os.path.join(self._preparedir, self._rawtlt)
         counter = 0
         for path in dirlist:
             tiltname = util.get_tilt_series_label(counter)
@@ -395,77 +693,190 @@ class TiltSeriesCreator(object):
                                      tiltname +
                                      TiltSeriesCreator.FID_EXT))
 
-            # copy rawtilt if it exists
-            rawtlt = os.path.join(path, self._rawtlt)
+            # copy prepared rawtilt if it exists
             if os.path.isfile(rawtlt):
-                destrawtlt = os.path.join(resultdir, self._mrcname + tiltname +
-                                          TiltSeriesCreator.RAW_TLT_EXT)
-                shutil.copy(rawtlt, destrawtlt)
-            else:
-                if destrawtlt is not None:
-
-                    shutil.copy(destrawtlt,
+                shutil.copyfile(rawtlt,
                                 os.path.join(resultdir,
                                              self._mrcname + tiltname +
                                              TiltSeriesCreator.RAW_TLT_EXT))
             counter += 1
 
-    def _generate_tilt_series(self, rotation, rotationdir):
-        """Generates tilt series for rotation passed in
+    def _generate_tilt_series(self, ctx):
+        """Generates tilt series for rotation of `ctx` in the context
+           directory
+        :param ctx: `TiltSeriesContext` of the rotation
+        :returns: directory of the rotation
         """
-        self._workdir = rotationdir
-
-        # rotate marker mrc file and 3Dmarkers.txt file
-        if math.fabs(rotation) > 0.001:
-            self._run_rotatevol(rotation)
-            self._run_rotate_3dmarkers(rotation)
-
-        self._run_project_all()
-        self._run_clip_projection_mrc()
-        self._run_volume_marker_position_all()
-        self._run_point2model()
-
-    def _run_rotatevol(self, rotation):
-        """Rotates mrc volume
+        logger.info('Creating tilt series for rotation: ' +
+                    str(ctx.get_rotation()))
+
+        self._get_rotation_pipeline(ctx).run(ctx.get_cores())
+        return ctx.get_workdir()
+
+    def _get_rotation_pipeline(self, ctx):
+        """Gets `Pipeline` of the stages that generate the tilt series
+           of the rotation of `ctx`. The stages read the marker volume
+           and 3Dmarkers.txt from the prepared directory, or the rotated
+           copies of them written by rotatevol and rotate_3dmarkers,
+           and write their outputs to the rotation directory so a rerun
+           only redoes the stages whose checkpoint is out of date. clip
+           and volume_marker_position_all both only need the output of
+           project_all so they run at the same time
         """
-        markermrc = os.path.join(self._get_marker_dir(), self._markermrc)
-        tmp_mrc = os.path.join(self._get_marker_dir(), 'tmp.mrc')
-        cmd = ('rotatevol -angles ' + str(rotation) + ',0,0 ' +
-               markermrc + ' ' + tmp_mrc)
+        workdir = ctx.get_workdir()
+        prepared = self._get_prepared_context()
+        (preparedmrc, prepared_txt) = self._get_marker_files(prepared)
+        (markermrc, three_d_txt) = self._get_marker_files(ctx)
+        projectionmrc = os.path.join(workdir, self._projectionmrc)
+        offset_all = os.path.join(ctx.get_projection_dir(),
+                                  TiltSeriesCreator.OFFSET_ALL_TXT)
+        two_d_txt = os.path.join(ctx.get_tracking_dir(),
+                                 TiltSeriesCreator.TWO_D_MARKERS_ALL_TXT)
+        cores = int(ctx.get_cores() or 1)
+        projection = [self._begintilt, self._tiltshift, self._endtilt,
+                      self._shrinkage, self._projmaxangle]
+        pipe = Pipeline(checkpointdir=ctx.get_checkpoint_dir())
+
+        if markermrc != preparedmrc:
+            pipe.add_stage(self._get_stage('rotatevol', self._run_rotatevol,
+                                           ctx, [preparedmrc], [markermrc],
+                                           1, params=[ctx.get_rotation()]))
+            pipe.add_stage(self._get_stage('rotate_3dmarkers',
+                                           self._run_rotate_3dmarkers, ctx,
+                                           [prepared_txt, preparedmrc],
+                                           [three_d_txt], 0,
+                                           params=[ctx.get_rotation()]))
+
+        pipe.add_stage(self._get_stage('project_all', self._run_project_all,
+                                       ctx, [markermrc],
+                                       [projectionmrc, offset_all], cores,
+                                       params=projection))
+        pipe.add_stage(self._get_stage('clip',
+                                       self._run_clip_projection_mrc, ctx,
+                                       [projectionmrc],
+                                       [os.path.join(
+                                           workdir,
+                                           self._projectionclipmrc)], 1))
+        pipe.add_stage(self._get_stage('volume_marker_position_all',
+                                       self._run_volume_marker_position_all,
+                                       ctx,
+                                       [markermrc, three_d_txt, offset_all],
+                                       [two_d_txt], 1,
+                                       params=[self._nummarkers,
+                                               ctx.get_rotation()] +
+                                       projection))
+        pipe.add_stage(self._get_stage('2Dmarkers_all_fid',
+                                       self._write_two_d_markers_all_fid,
+                                       ctx, [two_d_txt],
+                                       [os.path.join(workdir,
+                                                     TiltSeriesCreator.
+                                                     TWO_D_MARKERS_ALL_FID)],
+                                       0))
+        return pipe
+
+    def _get_marker_files(self, ctx):
+        """Gets the marker volume and 3Dmarkers.txt file the stages of
+           `ctx` read. A rotation of 0, or a context without a rotation,
+           uses the files in the prepared directory and any other
+           rotation the rotated copies in the marker directory of `ctx`
+        :returns: tuple (markermrc, 3Dmarkers.txt) of paths
+        """
+        rotation = ctx.get_rotation()
+        if rotation is None or math.fabs(rotation) <= 0.001:
+            markerdir = os.path.join(self._preparedir,
+                                     TiltSeriesCreator.MARKER_DIR_NAME)
+        else:
+            markerdir = ctx.get_marker_dir()
+        return (os.path.join(markerdir, self._markermrc),
+                os.path.join(markerdir,
+                             TiltSeriesCreator.THREE_D_MARKERS_TXT))
+
+    def _run_rotatevol(self, ctx):
+        """Rotates prepared marker mrc volume writing the result to the
+           marker directory of `ctx`
+        """
+        markerdir = ctx.get_marker_dir()
+        if not os.path.isdir(markerdir):
+            os.makedirs(markerdir)
+
+        cmd = ('rotatevol -angles ' + str(ctx.get_rotation()) + ',0,0 ' +
+               self._get_marker_files(self._get_prepared_context())[0] +
+               ' ' + self._get_marker_files(ctx)[0])
 
-        exitcode, out, err = util.run_external_command(cmd)
+        exitcode, out, err = util.run_external_command(
+            cmd, cwd=ctx.get_workdir())
         if exitcode != 0:
             raise Exception('Unable to run rotatevol : ' + err)
 
-        shutil.move(tmp_mrc, markermrc)
-
-    def _run_rotate_3dmarkers(self, rotation):
-        """ Rotates 3Dmarkers.txt file
-        :param rotation:
-        :return:
+    def _set_marker_rotations(self, rotations):
+        """Sets the rotations `_get_rotated_3dmarkers` rotates the
+           prepared 3Dmarkers.txt file by in one batch and drops the
+           markers rotated before so the prepared file is read again
         """
-        (x, y, z) = self._get_mrc_marker_image_dimensions()
-        three_d_markers_file = os.path.join(self._get_marker_dir(),
-                                            TiltSeriesCreator.
-                                            THREE_D_MARKERS_TXT)
-        cmd = ('rotate_3dmarkers.py --angle ' + str(rotation) +
-               ' --width ' + str(x) + ' --height ' + str(y) + ' ' +
-               three_d_markers_file)
-
-        exitcode, out, err = util.run_external_command(cmd,)
-        if exitcode != 0:
-            raise Exception('Unable to run rotate_3dmarkers.py : ' + err)
+        self._rotatelock.acquire()
+        try:
+            self._markerrotations = [r for r in rotations
+                                     if math.fabs(r) > 0.001]
+            self._rotatedmarkers = None
+        finally:
+            self._rotatelock.release()
+
+    def _get_rotated_3dmarkers(self, rotation):
+        """Gets the prepared 3Dmarkers.txt markers rotated by `rotation`
+           about the center of the prepared marker volume. The first
+           call parses the prepared file and rotates it by every
+           rotation set with `_set_marker_rotations`, and `rotation`, at
+           once with `MarkersList.get_rotated_by_angles`. Later calls,
+           which can come from several threads, only take their slice
+        :returns: MarkersList
+        """
+        self._rotatelock.acquire()
+        try:
+            if (self._rotatedmarkers is None or
+                    rotation not in self._rotatedmarkers[1]):
+                angles = list(self._markerrotations)
+                if rotation not in angles:
+                    angles.append(rotation)
+                prepared = self._get_prepared_context()
+                (x, y, z) = self._get_mrc_marker_image_dimensions(prepared)
+                mfac = MarkersFrom3DMarkersFileFactory(
+                    self._get_marker_files(prepared)[1])
+                markers = mfac.get_markerslist()
+                self._rotatedmarkers = (markers.get_indexes(), angles,
+                                        markers.get_rotated_by_angles(
+                                            angles, float(x) / 2,
+                                            float(y) / 2))
+            (indexes, angles, rotated) = self._rotatedmarkers
+        finally:
+            self._rotatelock.release()
+
+        pos = angles.index(rotation)
+        markers = MarkersList()
+        markers.add_markers(indexes, rotated[pos, :, 0], rotated[pos, :, 1],
+                            rotated[pos, :, 2])
+        return markers
+
+    def _run_rotate_3dmarkers(self, ctx):
+        """Writes the prepared 3Dmarkers.txt file rotated by the
+           rotation of `ctx`, see `_get_rotated_3dmarkers`, to the
+           marker directory of `ctx`
+        """
+        markerdir = ctx.get_marker_dir()
+        if not os.path.isdir(markerdir):
+            os.makedirs(markerdir)
+        self._get_rotated_3dmarkers(ctx.get_rotation()).\
+            write_markers_to_file(self._get_marker_files(ctx)[1])
 
-    def _run_project_all(self):
+    def _run_project_all(self, ctx):
         """Runs project_all
         """
-        projectiondir = self._get_projection_dir()
+        projectiondir = ctx.get_projection_dir()
         if not os.path.isdir(projectiondir):
             os.makedirs(projectiondir)
 
         cmd = (os.path.join(self._etspecbin, 'project_all') + ' ' +
-               os.path.join(self._get_marker_dir(), self._markermrc) + ' ' +
-               os.path.join(self._workdir, self._projectionmrc) + ' ' +
+               self._get_marker_files(ctx)[0] + ' ' +
+               os.path.join(ctx.get_workdir(), self._projectionmrc) + ' ' +
                str(self._begintilt) + ' ' +
                str(self._tiltshift) + ' ' +
                str(self._endtilt) + ' ' +
@@ -473,36 +884,49 @@ class TiltSeriesCreator(object):
                str(self._projmaxangle) + ' 0 0 0 0')
 
         exitcode, out, err = util.run_mpiexec_command(cmd, self._mpiexec,
-                                                      self._cores)
+                                                      ctx.get_cores(),
+                                                      cwd=ctx.get_workdir())
         if exitcode != 0:
             raise Exception('Unable to run project_all : ' + err)
 
-    def _run_clip_projection_mrc(self):
-        """Runs clip resize to get a clipped mrc file
+    def _get_projection_frames(self, ctx):
+        """Gets coordinate frames of the full projection and of the
+           clipped projection which is the center third of the full
+           projection in x and y. rotatevol keeps the size of the
+           volume so the frames are the same for every rotation
+        :returns: tuple (fullframe, clipframe) of `CoordinateFrame`
         """
-        (x, y, z) = self._get_mrc_marker_image_dimensions()
-        cmd = ('clip resize -ox ' + str(int(int(x)/3)) + ' -oy ' +
-               str(int(int(y)/3)) + ' ' +
-               os.path.join(self._workdir, self._projectionmrc) + ' ' +
-               os.path.join(self._workdir, self._projectionclipmrc))
+        (x, y, z) = self._get_mrc_marker_image_dimensions(ctx)
+        clipx = int(int(x)/3)
+        clipy = int(int(y)/3)
+        return (CoordinateFrame(int(x), int(y)),
+                CoordinateFrame(clipx, clipy, xoffset=clipx, yoffset=clipy))
 
-        exitcode, out, err = util.run_external_command(cmd)
+    def _run_clip_projection_mrc(self, ctx):
+        """Runs clip resize to get a clipped mrc file
+        """
+        (fullframe, clipframe) = self._get_projection_frames(ctx)
+        cmd = ('clip resize -ox ' + str(clipframe.get_width()) + ' -oy ' +
+               str(clipframe.get_height()) + ' ' +
+               os.path.join(ctx.get_workdir(), self._projectionmrc) + ' ' +
+               os.path.join(ctx.get_workdir(), self._projectionclipmrc))
+
+        exitcode, out, err = util.run_external_command(
+            cmd, cwd=ctx.get_workdir())
         if exitcode != 0:
             raise Exception('Unable to run clip : ' + err)
 
-    def _run_volume_marker_position_all(self):
+    def _run_volume_marker_position_all(self, ctx):
         """Runs volume_marker_position_all
         """
-        trackingdir = self._get_tracking_dir()
+        trackingdir = ctx.get_tracking_dir()
         if not os.path.isdir(trackingdir):
             os.makedirs(trackingdir)
 
+        (markermrc, three_d_txt) = self._get_marker_files(ctx)
         cmd = (os.path.join(self._etspecbin, 'volume_marker_position_all') +
-               ' ' +
-               os.path.join(self._get_marker_dir(), self._markermrc) + ' ' +
-               os.path.join(self._get_marker_dir(),
-                            TiltSeriesCreator.THREE_D_MARKERS_TXT) + ' ' +
-               os.path.join(self._get_projection_dir(),
+               ' ' + markermrc + ' ' + three_d_txt + ' ' +
+               os.path.join(ctx.get_projection_dir(),
                             TiltSeriesCreator.OFFSET_ALL_TXT) + ' ' +
                str(self._nummarkers) + ' ' +
                str(self._begintilt) + ' ' +
@@ -512,73 +936,93 @@ class TiltSeriesCreator(object):
                str(self._projmaxangle) + ' 0 0 0 0')
 
         exitcode, out, err = util.run_mpiexec_command(cmd, self._mpiexec,
-                                                      1)
+                                                      1,
+                                                      cwd=ctx.get_workdir())
         if exitcode != 0:
             raise Exception('Unable to run volume_marker_position_all : ' +
                             err)
 
-    def _run_point2model(self):
-        """runs point2model for fid file
+    def _write_two_d_markers_all_fid(self, ctx):
+        """Writes 2Dmarkers_all.txt from tracking directory to
+           2Dmarkers_all.fid file
         """
-        two_d_fid = os.path.join(self._workdir,
+        two_d_fid = os.path.join(ctx.get_workdir(),
                                  TiltSeriesCreator.TWO_D_MARKERS_ALL_FID)
-        cmd = ('point2model -circle 6 ' +
-               os.path.join(self._get_tracking_dir(),
-                            TiltSeriesCreator.TWO_D_MARKERS_ALL_TXT) + ' ' +
-               two_d_fid)
-
-        exitcode, out, err = util.run_external_command(cmd)
-        if exitcode != 0:
-            raise Exception('Unable to run point2model : ' +
-                            err)
+        writer = MarkersToIMODFiducialFileWriter(two_d_fid)
+        writer.write_markers(self._load_two_d_markers_all(
+            ctx.get_workdir()))
 
-    def _run_point2model_common(self):
-        """runs point2model for fid file
+    def _write_common_marker_files_for_job(self, job):
+        """Calls `_write_common_marker_files` with arguments in `job`
+           tuple so it can be used with `ThreadPool.map`
         """
-        common_fid = os.path.join(self._workdir,
-                                  self._mrcname +
-                                  TiltSeriesCreator.PROJECTION_CLIP +
-                                  TiltSeriesCreator.FID_EXT)
-
-        cmd = ('point2model -circle 6 ' +
-               os.path.join(self._get_tracking_dir(),
-                            TiltSeriesCreator.TWO_D_MARKERS_COMMON_TXT) + ' ' +
-               common_fid)
-
-        exitcode, out, err = util.run_external_command(cmd)
-        if exitcode != 0:
-            raise Exception('Unable to run point2model : ' +
-                            err)
-
-    def _run_shift_fidfilemarkers_common(self):
-        """Runs shift_fidfilemarkers to shift fid file for non clipped
-           projection
-        """
-        common_fid = os.path.join(self._workdir,
-                                  self._mrcname +
-                                  TiltSeriesCreator.PROJECTION_CLIP +
-                                  TiltSeriesCreator.FID_EXT)
-
-        (x, y, z) = self._get_mrc_marker_image_dimensions()
-        cmd = ('shift_fidfilemarkers.py --xshift ' + str(int(int(x)/3)) +
-               ' --yshift ' +
-               str(int(int(y)/3)) + ' ' +
-               common_fid + ' ' +
-               os.path.join(self._workdir, self._mrcname +
-                            TiltSeriesCreator.PROJECTION +
-                            TiltSeriesCreator.FID_EXT))
-
-        exitcode, out, err = util.run_external_command(cmd)
-        if exitcode != 0:
-            raise Exception('Unable to run shif_fidfilemarkers.py : ' + err)
+        (path, markers, clipframe, fullframe, filt) = job
+        self._write_common_marker_files(path, markers, filt, clipframe,
+                                        fullframe)
+
+    def _write_common_marker_files(self, path, markers, filt, clipframe,
+                                   fullframe):
+        """Writes markers common to all rotations to 2Dmarkers_common.txt
+           and to fid files for the clipped and the full projection of
+           rotation directory `path`. This method only uses `path` and
+           not the current working directory so rotations can be
+           written concurrently. Markers that fall outside the clipped
+           or the full projection are left out of the corresponding fid
+           file.
+
+        :param markers: MarkersList loaded from 2Dmarkers_all.txt which
+                        are in the coordinates of the clipped projection
+        :param filt: CommonByIndexMarkersListFilter for all rotations
+        :param clipframe: `CoordinateFrame` of the clipped projection
+        :param fullframe: `CoordinateFrame` of the full projection
+        """
+        logger.debug('Saving common markers for ' + path)
+        com, uni = filt.filterMarkers(markers)
+        if logger.isEnabledFor(logging.DEBUG):
+            for m in uni.get_markers():
+                logger.debug('Unique marker ommitted: ' +
+                             m.get_3dmarker_format())
 
-    def _get_mrc_marker_image_dimensions(self):
-        """Gets dimensions of marker mrc file
+        com.write_markers_to_file(os.path.join(
+            path, TiltSeriesCreator.TRACKING_DIR_NAME,
+            TiltSeriesCreator.TWO_D_MARKERS_COMMON_TXT))
+
+        writer = MarkersToIMODFiducialFileWriter(os.path.join(
+            path, self._mrcname + TiltSeriesCreator.PROJECTION_CLIP +
+            TiltSeriesCreator.FID_EXT))
+        writer.write_markers(self._get_markers_in_frame(path, com,
+                                                        clipframe,
+                                                        clipframe))
+
+        writer.set_fiducial_file(os.path.join(
+            path, self._mrcname + TiltSeriesCreator.PROJECTION +
+            TiltSeriesCreator.FID_EXT))
+        writer.write_markers(self._get_markers_in_frame(path, com,
+                                                        clipframe,
+                                                        fullframe))
+
+    def _get_markers_in_frame(self, path, markers, fromframe, toframe):
+        """Maps `markers` from `fromframe` to `toframe` dropping the
+           markers outside of `toframe` and logs how many were dropped
+        :returns: MarkersList
+        """
+        inside = markers.get_in_frame(fromframe, toframe)
+        if len(inside) < len(markers):
+            logger.info('Dropped ' + str(len(markers) - len(inside)) +
+                        ' of ' + str(len(markers)) + ' markers outside ' +
+                        str(toframe.get_width()) + 'x' +
+                        str(toframe.get_height()) + ' frame in ' + path)
+        return inside
+
+    def _get_mrc_marker_image_dimensions(self, ctx):
+        """Gets dimensions of marker mrc file `ctx` reads, see
+           `_get_marker_files`
         :returns tuple: x, y, z
         """
-        markermrc = os.path.join(self._get_marker_dir(), self._markermrc)
+        markermrc = self._get_marker_files(ctx)[0]
         cmd = ('header -s ' + markermrc)
-        exitcode, out, err = util.run_external_command(cmd,)
+        exitcode, out, err = util.run_external_command(
+            cmd, cwd=ctx.get_workdir())
         if exitcode != 0:
             raise Exception('Unable to run header -s : ' + err)
 
@@ -587,10 +1031,10 @@ class TiltSeriesCreator(object):
             raise Exception('Invalid output from header : ' + out)
         return list[1], list[2], list[3]
 
-    def _write_etspec_parameter_file(self):
+    def _write_etspec_parameter_file(self, ctx):
         """Writes etspec parameter file
         """
-        f = open(os.path.join(self._workdir, self._mrcname +
+        f = open(os.path.join(ctx.get_workdir(), self._mrcname +
                               TiltSeriesCreator.PAR_EXT), 'w')
         f.write('ANGLE_BEGIN = ' + str(self._begintilt) + '\n')
         f.write('ANGLE_INTER = ' + str(self._tiltshift) + '\n')
@@ -616,11 +1060,11 @@ class TiltSeriesCreator(object):
         f.flush()
         f.close()
 
-    def _write_etspec_prepared_project_file(self):
+    def _write_etspec_prepared_project_file(self, ctx):
         """Writes etspec project file for prepared
            phase
         """
-        f = open(os.path.join(self._workdir, self._mrcname +
+        f = open(os.path.join(ctx.get_workdir(), self._mrcname +
                               TiltSeriesCreator.PRO_EXT), 'w')
         f.write('PROJECT_NAME = ' + self._mrcname + '\n')
         f.write('PRO_NAME = ' + self._mrcname + TiltSeriesCreator.PRO_EXT +
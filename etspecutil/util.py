@@ -1,26 +1,34 @@
 # -*- coding: utf-8 -*-
 
 import subprocess
+import hashlib
 import logging
+import multiprocessing
 import shlex
 import string
 
 logger = logging.getLogger(__name__)
 
 
-def run_external_command(cmd_to_run):
+def run_external_command(cmd_to_run, cwd=None):
     """Runs command via external process
+       :param cwd: directory to run the command in, if None the command
+                   is run in the current working directory
        :returns: tuple (exitcode, stdout, stderr)
     """
 
     if cmd_to_run is None:
         return 255, '', 'Command must be set'
 
-    logger.info("Running command " + cmd_to_run)
+    if cwd is None:
+        logger.info("Running command " + cmd_to_run)
+    else:
+        logger.info("Running command " + cmd_to_run + " in " + cwd)
     try:
         p = subprocess.Popen(shlex.split(cmd_to_run),
                              stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE)
+                             stderr=subprocess.PIPE,
+                             cwd=cwd)
     except Exception as e:
             logger.exception("Error caught exception")
             return (255, '', 'Caught exception trying run command: ' +
@@ -30,8 +38,10 @@ def run_external_command(cmd_to_run):
     return p.returncode, out, err
 
 
-def run_mpiexec_command(cmd_to_run, mpiexec, numcores):
+def run_mpiexec_command(cmd_to_run, mpiexec, numcores, cwd=None):
     """Runs mpiexec command
+       :param cwd: directory to run the command in, if None the command
+                   is run in the current working directory
     """
     if cmd_to_run is None:
         return 255, '', 'Command must be set'
@@ -45,7 +55,7 @@ def run_mpiexec_command(cmd_to_run, mpiexec, numcores):
         core_count = numcores
 
     cmd = (mpiexec + ' -np ' + str(core_count) + ' ' + cmd_to_run)
-    return run_external_command(cmd)
+    return run_external_command(cmd, cwd=cwd)
 
 
 def get_tilt_series_label(tiltnumber):
@@ -77,3 +87,51 @@ def get_evenly_distributed_rotations(num_rotations):
         rot_list.append(cur_rot)
         cur_rot += degree_delta
     return rot_list
+
+
+def get_cpu_count():
+    """Gets number of cores on machine
+       :returns: multiprocessing.cpu_count() or 1 if it is unable to
+                 determine the core count
+    """
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        logger.exception('Unable to obtain cpu count from '
+                         'multiprocessing.cpu_count() defaulting to 1')
+        return 1
+
+
+def get_core_budget(cores, numjobs):
+    """Splits `cores` between up to `numjobs` concurrent jobs so no
+       more than `cores` cores are in use at once. Fewer jobs are run
+       if there are fewer cores than jobs and any cores left over from
+       an uneven split go unused
+       :param cores: total number of cores, None is treated as 1
+       :param numjobs: maximum number of jobs to run at once
+       :returns: tuple (number of concurrent jobs, cores per job) where
+                 both values are at least 1
+    """
+    if cores is None:
+        total = 1
+    else:
+        total = max(1, int(cores))
+    concurrent = max(1, min(int(numjobs), total))
+    return concurrent, total // concurrent
+
+
+def get_file_sha256(path, chunksize=1024 * 1024):
+    """Gets sha256 hash of file reading it `chunksize` bytes at a time
+       so large mrc files are never fully in memory
+       :returns: hex digest string
+    """
+    digest = hashlib.sha256()
+    f = open(path, 'rb')
+    try:
+        chunk = f.read(chunksize)
+        while len(chunk) > 0:
+            digest.update(chunk)
+            chunk = f.read(chunksize)
+    finally:
+        f.close()
+    return digest.hexdigest()
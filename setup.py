@@ -14,11 +14,13 @@ with open('HISTORY.rst') as history_file:
     history = history_file.read()
 
 requirements = [
-    "argparse"
+    "argparse",
+    "numpy"
 ]
 
 test_requirements = [
     "argparse",
+    "numpy",
     "mock"
 ]
 
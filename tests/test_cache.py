@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_cache
+----------------------------------
+
+Tests for `cache` module.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+from etspecutil import cache
+from etspecutil.cache import ContentCache
+
+
+def _write_file(path, content):
+    f = open(path, 'w')
+    f.write(content)
+    f.close()
+
+
+def _read_file(path):
+    f = open(path, 'r')
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+
+class TestCache(unittest.TestCase):
+
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_get_key(self):
+        key = cache.get_key(['all_255', 'abc'])
+        self.assertEqual(len(key), 64)
+        self.assertEqual(key, cache.get_key(['all_255', 'abc']))
+        self.assertNotEqual(key, cache.get_key(['all_255', 'abd']))
+        self.assertNotEqual(cache.get_key(['a', 'bc']),
+                            cache.get_key(['ab', 'c']))
+        self.assertEqual(cache.get_key(['rawtlt', -60.0]),
+                         cache.get_key(['rawtlt', '-60.0']))
+
+    def test_store_and_fetch(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            cachedir = os.path.join(temp_dir, 'cache')
+            cc = ContentCache(cachedir)
+            self.assertEqual(cc.get_cache_dir(), cachedir)
+            key = cache.get_key(['foo'])
+            self.assertEqual(cc.get_entry_dir(key),
+                             os.path.join(cachedir, key[:2], key))
+            self.assertFalse(cc.has_entry(key))
+            dest = [os.path.join(temp_dir, 'out', 'a'),
+                    os.path.join(temp_dir, 'out', 'b')]
+            self.assertFalse(cc.fetch(key, dest))
+            self.assertFalse(os.path.isdir(os.path.join(temp_dir, 'out')))
+
+            src = [os.path.join(temp_dir, 'x'), os.path.join(temp_dir, 'y')]
+            _write_file(src[0], 'first')
+            _write_file(src[1], 'second')
+            cc.store(key, src)
+            self.assertTrue(cc.has_entry(key))
+            self.assertEqual(sorted(os.listdir(cc.get_entry_dir(key))),
+                             ['0', '1'])
+            self.assertEqual(os.listdir(os.path.dirname(
+                cc.get_entry_dir(key))), [key])
+            for name in ['0', '1']:
+                self.assertEqual(os.stat(os.path.join(
+                    cc.get_entry_dir(key), name)).st_mode & 0o222, 0)
+
+            # storing the same entry again leaves it alone
+            _write_file(os.path.join(temp_dir, 'z'), 'other')
+            cc.store(key, [os.path.join(temp_dir, 'z')])
+            self.assertEqual(sorted(os.listdir(cc.get_entry_dir(key))),
+                             ['0', '1'])
+
+            # fetch replaces existing files with links to the entry
+            os.makedirs(os.path.join(temp_dir, 'out'))
+            _write_file(dest[0], 'stale')
+            self.assertTrue(cc.fetch(key, dest))
+            self.assertEqual(_read_file(dest[0]), 'first')
+            self.assertEqual(_read_file(dest[1]), 'second')
+            self.assertEqual(os.stat(dest[1]).st_ino,
+                             os.stat(src[1]).st_ino)
+
+            self.assertEqual(cc.get_digests(key), None)
+
+            # hashes are kept with the entry
+            key2 = cache.get_key(['bar'])
+            cc.store(key2, src, ['aa', 'bb'])
+            self.assertEqual(cc.get_digests(key2), ['aa', 'bb'])
+            self.assertTrue(cc.fetch(key2, dest))
+
+            # entry with too few files is ignored
+            self.assertFalse(cc.fetch(key, dest + [os.path.join(temp_dir,
+                                                                'c')]))
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    sys.exit(unittest.main())
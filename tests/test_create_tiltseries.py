@@ -77,7 +77,9 @@ class TestCreateTiltSeries(unittest.TestCase):
         self.assertEqual(theargs.rotationangles, '')
         self.assertEqual(theargs.mpiexec, 'mpiexec')
         self.assertEqual(theargs.cores, None)
+        self.assertEqual(theargs.parallelrotations, 1)
         self.assertEqual(theargs.etspecbin, '')
+        self.assertEqual(theargs.cachedir, '')
 
 
     def test_main(self):
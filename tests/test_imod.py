@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_imod
+----------------------------------
+
+Tests for `imod` module.
+"""
+
+import sys
+import unittest
+import os.path
+import tempfile
+import shutil
+import struct
+
+from etspecutil.imod import IMODModelReader
+from etspecutil.imod import IMODModelWriter
+from etspecutil.imod import UnsupportedIMODModelError
+from etspecutil.imod import InvalidIMODModelError
+from etspecutil import imod
+
+
+def write_test_model(path, objects, extra_chunk=None, flags=0):
+    """Writes a minimal binary IMOD model
+
+       :param objects: list of objects, each a list of contours where
+                       each contour is a list of (x, y, z) tuples
+       :param extra_chunk: optional raw bytes written after the first
+                           contour
+    """
+    f = open(path, 'wb')
+    f.write(b'IMODV1.2')
+    header = bytearray(232)
+    struct.pack_into('>i', header, 140, len(objects))
+    struct.pack_into('>I', header, 144, flags)
+    f.write(bytes(header))
+    for contours in objects:
+        f.write(b'OBJT')
+        objt = bytearray(176)
+        struct.pack_into('>i', objt, 128, len(contours))
+        f.write(bytes(objt))
+        for contour in contours:
+            f.write(b'CONT')
+            f.write(struct.pack('>iIii', len(contour), 0, 0, 0))
+            for (x, y, z) in contour:
+                f.write(struct.pack('>fff', x, y, z))
+            if extra_chunk is not None:
+                f.write(extra_chunk)
+                extra_chunk = None
+    f.write(b'IEOF')
+    f.close()
+
+
+class TestIMOD(unittest.TestCase):
+
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_get_set_model_file(self):
+        reader = IMODModelReader(None)
+        self.assertEqual(reader.get_model_file(), None)
+        reader.set_model_file('foo')
+        self.assertEqual(reader.get_model_file(), 'foo')
+
+    def test_get_points_not_imod_file(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            mfile = os.path.join(temp_dir, 'foo.fid')
+            f = open(mfile, 'w')
+            f.write('imod 1\n')
+            f.close()
+            reader = IMODModelReader(mfile)
+            try:
+                reader.get_points()
+                self.fail('Expected UnsupportedIMODModelError')
+            except UnsupportedIMODModelError:
+                pass
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_get_points_no_contours(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            mfile = os.path.join(temp_dir, 'foo.fid')
+            write_test_model(mfile, [[]])
+            (indexes, xs, ys, zs) = IMODModelReader(mfile).get_points()
+            self.assertEqual(len(indexes), 0)
+            self.assertEqual(len(xs), 0)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_get_points(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            mfile = os.path.join(temp_dir, 'foo.fid')
+            write_test_model(mfile, [[[(1.5, 2, 0), (3, 4, 1)],
+                                      [],
+                                      [(5, 6.25, 2)]],
+                                     [[(7, 8, 3)]]],
+                             extra_chunk=b'SIZE' + struct.pack('>i', 8) +
+                             struct.pack('>ff', 1, 1))
+            (indexes, xs, ys, zs) = IMODModelReader(mfile).get_points()
+            self.assertEqual(indexes.tolist(), [1, 1, 3, 1])
+            self.assertEqual(xs.tolist(), [1.5, 3, 5, 7])
+            self.assertEqual(ys.tolist(), [2, 4, 6.25, 8])
+            self.assertEqual(zs.tolist(), [0, 1, 2, 3])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_iter_contours(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            mfile = os.path.join(temp_dir, 'foo.fid')
+            write_test_model(mfile, [[[(1.5, 2, 0), (3, 4, 1)],
+                                      [(5, 6.25, 2)]],
+                                     [[(7, 8, 3)]]])
+            contours = list(IMODModelReader(mfile).iter_contours())
+            self.assertEqual(len(contours), 3)
+            self.assertEqual(contours[0][0], 1)
+            self.assertEqual(contours[0][1].tolist(), [[1.5, 2, 0],
+                                                       [3, 4, 1]])
+            self.assertEqual(contours[1][0], 2)
+            self.assertEqual(contours[1][1].tolist(), [[5, 6.25, 2]])
+            self.assertEqual(contours[2][0], 1)
+            self.assertEqual(contours[2][1].tolist(), [[7, 8, 3]])
+            self.assertEqual(IMODModelReader(mfile).get_contour_numbers(),
+                             [1, 2, 1])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_get_points_unsupported_chunk(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            mfile = os.path.join(temp_dir, 'foo.fid')
+            write_test_model(mfile, [[[(1, 2, 0)]]],
+                             extra_chunk=b'XXXX' + struct.pack('>i', 0))
+            try:
+                IMODModelReader(mfile).get_points()
+                self.fail('Expected UnsupportedIMODModelError')
+            except UnsupportedIMODModelError as e:
+                self.assertTrue('XXXX' in str(e))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_get_points_flipped_model(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            mfile = os.path.join(temp_dir, 'foo.fid')
+            write_test_model(mfile, [[[(1, 2, 0)]]], flags=1 << 16)
+            try:
+                IMODModelReader(mfile).get_points()
+                self.fail('Expected UnsupportedIMODModelError')
+            except UnsupportedIMODModelError:
+                pass
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_get_points_truncated(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            mfile = os.path.join(temp_dir, 'foo.fid')
+            write_test_model(mfile, [[[(1, 2, 0), (3, 4, 5)]]])
+            f = open(mfile, 'rb')
+            data = f.read()
+            f.close()
+            f = open(mfile, 'wb')
+            f.write(data[:-10])
+            f.close()
+            try:
+                IMODModelReader(mfile).get_points()
+                self.fail('Expected InvalidIMODModelError')
+            except InvalidIMODModelError:
+                pass
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_writer_get_set(self):
+        writer = IMODModelWriter(None)
+        self.assertEqual(writer.get_model_file(), None)
+        writer.set_model_file('foo')
+        self.assertEqual(writer.get_model_file(), 'foo')
+        self.assertEqual(writer.get_circle_size(), 6)
+        writer.set_circle_size(3)
+        self.assertEqual(writer.get_circle_size(), 3)
+
+    def test_write_points_no_points(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            mfile = os.path.join(temp_dir, 'foo.fid')
+            IMODModelWriter(mfile).write_points([], [], [], [])
+            (indexes, xs, ys, zs) = IMODModelReader(mfile).get_points()
+            self.assertEqual(len(indexes), 0)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_write_points_round_trip(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            mfile = os.path.join(temp_dir, 'foo.fid')
+            writer = IMODModelWriter(mfile)
+            writer.write_points([7, 3, 7, 3, 9],
+                                [1.5, 2, 3, 4, 5],
+                                [6, 7, 8, 9, 10.25],
+                                [0, 0, 1, 1, 2])
+            f = open(mfile, 'rb')
+            data = f.read()
+            f.close()
+            self.assertTrue(data.startswith(b'IMODV1.2'))
+            self.assertTrue(data.endswith(b'IEOF'))
+            self.assertEqual(len(data), 8 + 232 + 4 + 176 +
+                             3 * 20 + 5 * 12 + 4)
+
+            # object has 3 contours and circle symbol size 6
+            objt = data.index(b'OBJT') + 4
+            self.assertEqual(struct.unpack_from('>i', data, objt + 128)[0],
+                             3)
+            self.assertEqual(struct.unpack_from('>BB', data, objt + 160),
+                             (0, 6))
+
+            (indexes, xs, ys, zs) = IMODModelReader(mfile).get_points()
+            self.assertEqual(indexes.tolist(), [1, 1, 2, 2, 3])
+            self.assertEqual(xs.tolist(), [2, 4, 1.5, 3, 5])
+            self.assertEqual(ys.tolist(), [7, 9, 6, 8, 10.25])
+            self.assertEqual(zs.tolist(), [0, 1, 0, 1, 2])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_copy_and_shift_points(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            mfile = os.path.join(temp_dir, 'foo.fid')
+            outfile = os.path.join(temp_dir, 'out.fid')
+            write_test_model(mfile, [[[(1.5, 2, 0), (3, 4, 1)],
+                                      [],
+                                      [(5, 6.25, 2)]]],
+                             extra_chunk=b'SIZE' + struct.pack('>i', 8) +
+                             struct.pack('>ff', 1, 1))
+            imod.copy_and_shift_points(mfile, outfile, 10, -2)
+            self.assertEqual(os.path.getsize(mfile),
+                             os.path.getsize(outfile))
+
+            (indexes, xs, ys, zs) = IMODModelReader(outfile).get_points()
+            self.assertEqual(indexes.tolist(), [1, 1, 3])
+            self.assertEqual(xs.tolist(), [11.5, 13, 15])
+            f = open(outfile, 'rb')
+            f.seek(136)
+            self.assertEqual(struct.unpack('>2i', f.read(8)), (15, 5))
+            f.close()
+            self.assertEqual(ys.tolist(), [0, 2, 4.25])
+            self.assertEqual(zs.tolist(), [0, 1, 2])
+
+            # input is not modified
+            (indexes, xs, ys, zs) = IMODModelReader(mfile).get_points()
+            self.assertEqual(xs.tolist(), [1.5, 3, 5])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_copy_and_shift_points_unaligned(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            mfile = os.path.join(temp_dir, 'foo.fid')
+            outfile = os.path.join(temp_dir, 'out.fid')
+            write_test_model(mfile, [[[(1, 2, 0)], [(3, 4, 1), (5, 6, 2)]]],
+                             extra_chunk=b'LABL' + struct.pack('>i', 3) +
+                             b'abc')
+            imod.copy_and_shift_points(mfile, outfile, 1, 2)
+            (indexes, xs, ys, zs) = IMODModelReader(outfile).get_points()
+            self.assertEqual(indexes.tolist(), [1, 2, 2])
+            self.assertEqual(xs.tolist(), [2, 4, 6])
+            self.assertEqual(ys.tolist(), [4, 6, 8])
+            self.assertEqual(zs.tolist(), [0, 1, 2])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_copy_and_shift_points_unsupported(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            mfile = os.path.join(temp_dir, 'foo.fid')
+            outfile = os.path.join(temp_dir, 'out.fid')
+            write_test_model(mfile, [[[(1, 2, 0)]]],
+                             extra_chunk=b'XXXX' + struct.pack('>i', 0))
+            try:
+                imod.copy_and_shift_points(mfile, outfile, 10, -2)
+                self.fail('Expected UnsupportedIMODModelError')
+            except UnsupportedIMODModelError:
+                pass
+            self.assertFalse(os.path.exists(outfile))
+
+            # mesh vertices would not be shifted
+            write_test_model(mfile, [[[(1, 2, 0)]]],
+                             extra_chunk=b'MESH' +
+                             struct.pack('>iiIhh', 1, 1, 0, 0, 0) +
+                             struct.pack('>fff', 1, 2, 0) +
+                             struct.pack('>i', -1))
+            meshes = []
+            IMODModelReader(mfile).get_point_offsets(meshes)
+            self.assertEqual(len(meshes), 1)
+            try:
+                imod.copy_and_shift_points(mfile, outfile, 10, -2)
+                self.fail('Expected UnsupportedIMODModelError')
+            except UnsupportedIMODModelError as e:
+                self.assertTrue('mesh' in str(e))
+            self.assertFalse(os.path.exists(outfile))
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+    def test_write_contour_iter(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            xs = [1.5, 2, 3, 4, 5]
+            ys = [6, 7, 8, 9, 10.25]
+            zs = [0, 0, 1, 1, 2]
+            whole = os.path.join(temp_dir, 'whole.fid')
+            IMODModelWriter(whole).write_contours(xs, ys, zs, [0, 2, 3, 5])
+            streamed = os.path.join(temp_dir, 'streamed.fid')
+            IMODModelWriter(streamed).write_contour_iter(
+                ((xs[s:e], ys[s:e], zs[s:e]) for (s, e) in
+                 [(0, 2), (2, 3), (3, 5)]))
+            f = open(whole, 'rb')
+            expected = f.read()
+            f.close()
+            f = open(streamed, 'rb')
+            self.assertEqual(f.read(), expected)
+            f.close()
+
+            IMODModelWriter(streamed).write_contour_iter([])
+            self.assertEqual(IMODModelReader(streamed).get_contour_numbers(),
+                             [])
+        finally:
+            shutil.rmtree(temp_dir)
+
+if __name__ == '__main__':
+    sys.exit(unittest.main())
@@ -16,12 +16,29 @@ import tempfile
 import math
 import shutil
 
+import logging
+
+import numpy
+
 from etspecutil.marker import Marker
 from etspecutil.marker import MarkersList
 
 from etspecutil.marker import MarkersFrom3DMarkersFileFactory
 from etspecutil.marker import InvalidAngleError
 from etspecutil.marker import CommonByIndexMarkersListFilter
+from etspecutil.marker import TrackIndex
+from etspecutil import marker
+
+
+class RecordingHandler(logging.Handler):
+    """Keeps log records emitted while attached to a logger
+    """
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
 
 
 class TestMarker(unittest.TestCase):
@@ -54,6 +71,47 @@ class TestMarker(unittest.TestCase):
         markers.clear_markers()
         self.assertEqual(len(markers.get_markers()), 0)
 
+    def test_markers_add_none_values(self):
+        markers = MarkersList()
+        markers.add_marker(None, 1, None, 3)
+        self.assertEqual(len(markers), 1)
+        m = markers.get_markers()[0]
+        self.assertEqual(m.get_index(), None)
+        self.assertEqual(m.get_x(), 1)
+        self.assertEqual(m.get_y(), None)
+        self.assertEqual(m.get_z(), 3)
+
+    def test_markers_add_markers_and_arrays(self):
+        markers = MarkersList()
+        markers.add_marker(1, 2, 3, 4)
+        markers.add_markers([2, 3], [5, 6], [7, 8], [9, 10])
+        self.assertEqual(len(markers), 3)
+        self.assertEqual(markers.get_indexes().tolist(), [1, 2, 3])
+        self.assertEqual(markers.get_x().tolist(), [2, 5, 6])
+        self.assertEqual(markers.get_y().tolist(), [3, 7, 8])
+        self.assertEqual(markers.get_z().tolist(), [4, 9, 10])
+        self.assertEqual(markers.get_indexes().dtype, numpy.int64)
+        self.assertEqual(markers.get_x().dtype, numpy.float64)
+
+        # add enough markers to force storage to grow
+        for i in range(100):
+            markers.add_marker(i, i, i, i)
+        self.assertEqual(len(markers), 103)
+        m = markers.get_markers()[102]
+        self.assertEqual(m.get_index(), 99)
+        self.assertEqual(m.get_z(), 99)
+        self.assertEqual(markers.get_markers()[1].get_x(), 5)
+
+        try:
+            markers.add_markers([1, 2], [1], [1, 2], [1, 2])
+            self.fail('Expected ValueError')
+        except ValueError:
+            pass
+
+        markers.clear_markers()
+        self.assertEqual(len(markers), 0)
+        self.assertEqual(len(markers.get_x()), 0)
+
     def test_markers_shift(self):
         markers = MarkersList()
         markers.shift_markers(10, 20, 30)
@@ -163,6 +221,196 @@ class TestMarker(unittest.TestCase):
         self.assertTrue(math.fabs(m.get_y() - 1) < 0.0001)
         self.assertEqual(m.get_z(), 5)
 
+    def test_markers_rotate_by_angle_matches_marker_rotate(self):
+        markers = MarkersList()
+        single = []
+        for i in range(50):
+            x = (i * 37.3) % 1024 - 100.25
+            y = (i * 91.7) % 768 + 0.125
+            markers.add_marker(i, x, y, i)
+            single.append(Marker(i, x, y, i))
+
+        for angle in [22.5, 90, 133.7, -45]:
+            markers.rotate_by_angle(angle, 540, 270)
+            for m in single:
+                m.rotate_by_theta(2 * math.pi * angle / 360, 540, 270)
+
+        for m, expected in zip(markers.get_markers(), single):
+            self.assertEqual(m.get_x(), expected.get_x())
+            self.assertEqual(m.get_y(), expected.get_y())
+            self.assertEqual(m.get_z(), expected.get_z())
+            self.assertEqual(m.get_3dmarker_format(),
+                             expected.get_3dmarker_format())
+
+    def test_markers_transform_chain(self):
+        markers = MarkersList()
+        markers.add_marker(1, 1, 1, 5)
+        markers.add_marker(2, 10, 4, 6)
+        expected = MarkersList()
+        expected.add_marker(1, 1, 1, 5)
+        expected.add_marker(2, 10, 4, 6)
+
+        self.assertFalse(markers.has_pending_transforms())
+        self.assertTrue(numpy.array_equal(markers.get_transform(),
+                                          numpy.identity(3)))
+
+        markers.add_rotation(90, 5, 5)
+        markers.add_shift(-3, 7)
+        markers.add_scale(0.5, 0.5)
+        self.assertTrue(markers.has_pending_transforms())
+
+        expected.rotate_by_angle(90, 5, 5)
+        expected.shift_markers(-3, 7, 0)
+
+        for m, e in zip(markers.get_markers(), expected.get_markers()):
+            self.assertEqual(m.get_index(), e.get_index())
+            self.assertTrue(math.fabs(m.get_x() - e.get_x() / 2) < 0.00001)
+            self.assertTrue(math.fabs(m.get_y() - e.get_y() / 2) < 0.00001)
+            self.assertEqual(m.get_z(), e.get_z())
+        self.assertFalse(markers.has_pending_transforms())
+
+    def test_markers_transform_applies_to_existing_markers_only(self):
+        markers = MarkersList()
+        markers.add_marker(1, 1, 2, 3)
+        markers.add_shift(10, 20)
+        markers.add_marker(2, 1, 2, 3)
+        self.assertEqual(markers.get_x().tolist(), [11, 1])
+        self.assertEqual(markers.get_y().tolist(), [22, 2])
+
+        markers.add_scale(2, 4, 1, 2)
+        self.assertEqual(markers.get_x().tolist(), [21, 1])
+        self.assertEqual(markers.get_y().tolist(), [82, 2])
+
+        markers.add_shift(1, 1)
+        markers.clear_markers()
+        self.assertFalse(markers.has_pending_transforms())
+
+    def test_markers_add_transform_invalid(self):
+        markers = MarkersList()
+        try:
+            markers.add_transform([[1, 0], [0, 1]])
+            self.fail('Expected ValueError')
+        except ValueError:
+            pass
+        try:
+            markers.add_rotation(None, 0, 0)
+            self.fail('Expected InvalidAngleError')
+        except InvalidAngleError:
+            pass
+
+    def test_markers_apply_slice_transforms(self):
+        markers = MarkersList()
+        expected = {}
+        for (index, x, y, z) in [(1, 1, 0, 0), (2, 3, 4, 2), (3, 5, 6, 1),
+                                 (4, 7, 8, 2), (5, 9, 1, 0)]:
+            markers.add_marker(index, x, y, z)
+            expected.setdefault(z, MarkersList()).add_marker(index, x, y,
+                                                             z)
+        expected[0].shift_markers(10, -2, 0)
+        expected[2].rotate_by_angle(30, 4, 5)
+
+        markers.apply_slice_transforms(
+            [2, 0], numpy.concatenate((
+                marker.get_slice_rotation_matrices([30], 4, 5),
+                marker.get_slice_shift_matrices([10], [-2]))))
+        for m in markers.get_markers():
+            e = [em for em in expected[m.get_z()].get_markers()
+                 if em.get_index() == m.get_index()][0]
+            self.assertTrue(math.fabs(m.get_x() - e.get_x()) < 0.00001)
+            self.assertTrue(math.fabs(m.get_y() - e.get_y()) < 0.00001)
+        # slice 1 is not in table
+        self.assertEqual(markers.get_x()[2], 5)
+        self.assertEqual(markers.get_y()[2], 6)
+
+    def test_markers_apply_slice_transforms_after_pending(self):
+        markers = MarkersList()
+        markers.add_markers([1, 2], [1, 1], [2, 2], [0, 1])
+        markers.add_scale(2, 2)
+        markers.apply_slice_transforms([1, 5],
+                                       marker.get_slice_shift_matrices(
+                                           [100, 7], [0, 7]))
+        self.assertFalse(markers.has_pending_transforms())
+        self.assertEqual(markers.get_x().tolist(), [2, 102])
+        self.assertEqual(markers.get_y().tolist(), [4, 4])
+
+        markers.apply_slice_transforms([], marker.
+                                       get_slice_shift_matrices([], []))
+        self.assertEqual(markers.get_x().tolist(), [2, 102])
+
+    def test_markers_apply_slice_transforms_invalid(self):
+        markers = MarkersList()
+        try:
+            markers.apply_slice_transforms([1, 2], [numpy.identity(3)])
+            self.fail('Expected ValueError')
+        except ValueError:
+            pass
+        try:
+            markers.apply_slice_transforms([1, 1], [numpy.identity(3),
+                                                    numpy.identity(3)])
+            self.fail('Expected ValueError')
+        except ValueError:
+            pass
+        try:
+            marker.get_slice_shift_matrices([1, 2], [1])
+            self.fail('Expected ValueError')
+        except ValueError:
+            pass
+
+    def test_markers_get_rotated_by_angles(self):
+        markers = MarkersList()
+        for i in range(10):
+            markers.add_marker(i, i * 13.7, 500 - i * 3.3, i)
+
+        angles = [0, 22.5, 90, 157.5]
+        rotated = markers.get_rotated_by_angles(angles, 540, 270)
+        self.assertEqual(rotated.shape, (4, 10, 3))
+
+        # source markers are not modified
+        self.assertEqual(markers.get_x()[1], 13.7)
+
+        for pos, angle in enumerate(angles):
+            expected = MarkersList()
+            expected.add_markers(markers.get_indexes(), markers.get_x(),
+                                 markers.get_y(), markers.get_z())
+            expected.rotate_by_angle(angle, 540, 270)
+            self.assertEqual(rotated[pos, :, 0].tolist(),
+                             expected.get_x().tolist())
+            self.assertEqual(rotated[pos, :, 1].tolist(),
+                             expected.get_y().tolist())
+            self.assertEqual(rotated[pos, :, 2].tolist(),
+                             expected.get_z().tolist())
+
+        try:
+            markers.get_rotated_by_angles([1, None], 0, 0)
+            self.fail('Expected InvalidAngleError')
+        except InvalidAngleError:
+            pass
+
+    def test_markers_write_rotated_markers_to_files(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            markers = MarkersList()
+            markers.add_marker(1, 1, 1, 5)
+            files = [os.path.join(temp_dir, 'a'),
+                     os.path.join(temp_dir, 'b')]
+            try:
+                markers.write_rotated_markers_to_files([90], 5, 5, files)
+                self.fail('Expected ValueError')
+            except ValueError:
+                pass
+
+            markers.write_rotated_markers_to_files([0, 90], 5, 5, files)
+            f = open(files[0], 'r')
+            self.assertEqual(f.read(),
+                             '     1    1.000000    1.000000    5.000000\n')
+            f.close()
+            f = open(files[1], 'r')
+            self.assertEqual(f.read(),
+                             '     1    9.000000    1.000000    5.000000\n')
+            f.close()
+        finally:
+            shutil.rmtree(temp_dir)
+
     def test_markers_write_markers_to_file(self):
         temp_dir = tempfile.mkdtemp()
         try:
@@ -207,6 +455,35 @@ class TestMarker(unittest.TestCase):
         finally:
             shutil.rmtree(temp_dir)
 
+    def test_markers_write_markers_to_file_matches_3dmarker_format(self):
+        temp_dir = tempfile.mkdtemp()
+        chunk_size = MarkersList.WRITE_CHUNK_SIZE
+        try:
+            markers = MarkersList()
+            expected = ''
+            for i in range(20):
+                x = (i * 37.123456789) - 300
+                y = -(i * 1234.5) - 0.0000004
+                z = i % 7
+                markers.add_marker(i * 1001, x, y, z)
+                expected += Marker(i * 1001, x, y,
+                                   z).get_3dmarker_format() + '\n'
+                if i % 5 == 0:
+                    markers.add_marker(i, None, 1, 2)
+                    markers.add_marker(None, i, 1, 2)
+            markers.add_marker(7, -0.0, 1e9, 0.5)
+            expected += Marker(7, -0.0, 1e9, 0.5).get_3dmarker_format() + '\n'
+
+            MarkersList.WRITE_CHUNK_SIZE = 3
+            mfile = os.path.join(temp_dir, 'markers.txt')
+            markers.write_markers_to_file(mfile)
+            f = open(mfile, 'r')
+            self.assertEqual(f.read(), expected)
+            f.close()
+        finally:
+            MarkersList.WRITE_CHUNK_SIZE = chunk_size
+            shutil.rmtree(temp_dir)
+
     def test_marker_constructor(self):
         m = Marker(1, 2, 3, 4)
         self.assertEqual(m.get_index(), 1)
@@ -403,6 +680,256 @@ class TestMarker(unittest.TestCase):
         finally:
             shutil.rmtree(temp_dir)
 
+    def test_markersfrom3dmarkers_badlines_one_warning(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            mfile = os.path.join(temp_dir, '3Dmarkers.txt')
+            f = open(mfile, 'w')
+            for i in range(10):
+                f.write('bad\n')
+                f.write('%6d %11f %11f %11f\n' % (i, 1.5, -2, 3))
+            f.write('\n')
+            f.close()
+            fac = MarkersFrom3DMarkersFileFactory(mfile)
+            handler = RecordingHandler()
+            logger = logging.getLogger('etspecutil.marker')
+            level = logger.level
+            logger.setLevel(logging.WARNING)
+            logger.addHandler(handler)
+            try:
+                m = fac.get_markerslist()
+            finally:
+                logger.removeHandler(handler)
+                logger.setLevel(level)
+            self.assertEqual(len(m), 10)
+            self.assertEqual(m.get_indexes().tolist(), list(range(10)))
+            self.assertEqual(m.get_x().tolist(), [1.5] * 10)
+            self.assertEqual(m.get_y().tolist(), [-2] * 10)
+            self.assertEqual(len(handler.records), 1)
+            msg = handler.records[0].getMessage()
+            self.assertTrue('Skipped 11 line(s)' in msg)
+            self.assertTrue('line 1 (bad), line 3 (bad)' in msg)
+            self.assertTrue('line 9 (bad)' in msg)
+            self.assertFalse('line 11 ' in msg)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_markersfrom3dmarkers_lines_span_blocks(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            mfile = os.path.join(temp_dir, '3Dmarkers.txt')
+            f = open(mfile, 'w')
+            for i in range(50):
+                f.write(' %d %r %d %d' % (i + 1, i * 0.1, -i, i % 7))
+                if i < 49:
+                    f.write('\n')
+            f.close()
+            fac = MarkersFrom3DMarkersFileFactory(mfile)
+            block_size = MarkersFrom3DMarkersFileFactory.BLOCK_SIZE
+            MarkersFrom3DMarkersFileFactory.BLOCK_SIZE = 7
+            try:
+                m = fac.get_markerslist()
+            finally:
+                MarkersFrom3DMarkersFileFactory.BLOCK_SIZE = block_size
+            self.assertEqual(m.get_indexes().tolist(), list(range(1, 51)))
+            self.assertEqual(m.get_x().tolist(),
+                             [i * 0.1 for i in range(50)])
+            self.assertEqual(m.get_y().tolist(), [-i for i in range(50)])
+            self.assertEqual(m.get_z().tolist(), [i % 7 for i in range(50)])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_markersfrom3dmarkers_cache(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            mfile = os.path.join(temp_dir, '2Dmarkers_all.txt')
+            f = open(mfile, 'w')
+            f.write('     1  442.000000  633.000000   12.000000\n')
+            f.write('     2  452.500000  485.000000\n')
+            f.write('     3  -1.250000  471.000000  100.000000\n')
+            f.close()
+            fac = MarkersFrom3DMarkersFileFactory(mfile)
+            self.assertEqual(fac.get_use_cache(), False)
+            fac.get_markerslist()
+            self.assertEqual(os.listdir(temp_dir), ['2Dmarkers_all.txt'])
+
+            fac.set_use_cache(True)
+            self.assertEqual(fac.get_use_cache(), True)
+            cachefile = fac.get_cache_file()
+            self.assertEqual(os.path.dirname(cachefile), temp_dir)
+            self.assertTrue(os.path.basename(cachefile).
+                            startswith('.2Dmarkers_all.txt.'))
+            m = fac.get_markerslist()
+            self.assertEqual(sorted(os.listdir(temp_dir)),
+                             [os.path.basename(cachefile),
+                              '2Dmarkers_all.txt'])
+            data = numpy.load(cachefile, mmap_mode='r')
+            self.assertEqual(data['index'].tolist(), [1, 3])
+            self.assertEqual(data['x'].tolist(), [442, -1.25])
+            del data
+
+            # cached values are returned while text file is unchanged
+            st = os.stat(mfile)
+            f = open(mfile, 'w')
+            f.write('     9  442.000000  633.000000   12.000000\n')
+            f.write('     2  452.500000  485.000000\n')
+            f.write('     3  -1.250000  471.000000  100.000000\n')
+            f.close()
+            os.utime(mfile, (st.st_atime, st.st_mtime))
+            cached = MarkersFrom3DMarkersFileFactory(mfile, usecache=True)
+            m = cached.get_markerslist()
+            self.assertEqual(m.get_indexes().tolist(), [1, 3])
+            self.assertEqual(m.get_x().tolist(), [442, -1.25])
+            self.assertEqual(m.get_y().tolist(), [633, 471])
+            self.assertEqual(m.get_z().tolist(), [12, 100])
+
+            # new version of file replaces old sidecar
+            os.utime(mfile, (st.st_atime, st.st_mtime + 10))
+            m = fac.get_markerslist()
+            self.assertEqual(m.get_indexes().tolist(), [9, 3])
+            self.assertNotEqual(fac.get_cache_file(), cachefile)
+            self.assertEqual(sorted(os.listdir(temp_dir)),
+                             [os.path.basename(fac.get_cache_file()),
+                              '2Dmarkers_all.txt'])
+
+            # sidecars of another markers file with a longer name that
+            # starts with the same text are left alone
+            other = MarkersFrom3DMarkersFileFactory(mfile + '.x')
+            othercache = other._get_cache_prefix() + '5_6.npy'
+            open(othercache, 'w').close()
+            os.utime(mfile, (st.st_atime, st.st_mtime + 20))
+            fac.get_markerslist()
+            self.assertEqual(sorted(os.listdir(temp_dir)),
+                             [os.path.basename(fac.get_cache_file()),
+                              os.path.basename(othercache),
+                              '2Dmarkers_all.txt'])
+            os.remove(othercache)
+
+            # corrupt sidecar is ignored and rewritten
+            f = open(fac.get_cache_file(), 'w')
+            f.write('garbage')
+            f.close()
+            m = fac.get_markerslist()
+            self.assertEqual(m.get_indexes().tolist(), [9, 3])
+            data = numpy.load(fac.get_cache_file())
+            self.assertEqual(data['index'].tolist(), [9, 3])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_markerslist_compact(self):
+        mlist = MarkersList()
+        self.assertEqual(mlist.is_compact(), False)
+        mlist = MarkersList(compact=True)
+        self.assertEqual(mlist.is_compact(), True)
+        mlist.add_marker(1, 0.1, None, 3)
+        mlist.add_markers([2, 3], [1000.1, 5], [2, 6], [4, 7])
+        self.assertEqual(mlist.get_x().dtype, numpy.float32)
+        self.assertEqual(mlist.get_x().nbytes, 12)
+        self.assertEqual(mlist.get_valid_mask().tolist(), [False, True,
+                                                           True])
+        self.assertEqual(mlist.get_z().tolist(), [3, 4, 7])
+        for (value, stored) in [(0.1, mlist.get_x()[0]),
+                                (1000.1, mlist.get_x()[1])]:
+            self.assertNotEqual(float(stored), value)
+            self.assertTrue(abs(float(stored) - value) <=
+                            value * MarkersList.COMPACT_ERROR)
+
+        mlist.add_shift(1, 1)
+        self.assertEqual(mlist.get_x().dtype, numpy.float32)
+        self.assertEqual(mlist.get_y().tolist()[1:], [3, 7])
+        subset = mlist.get_in_frame(marker.CoordinateFrame(10, 10),
+                                    marker.CoordinateFrame(10, 10))
+        self.assertEqual(subset.is_compact(), True)
+        self.assertEqual(subset.get_indexes().tolist(), [3])
+        self.assertEqual(TrackIndex(mlist).get_markers_list().is_compact(),
+                         True)
+
+    def test_markersfrom3dmarkers_compact_round_trip(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            rng = numpy.random.RandomState(4)
+            num = 2000
+            mlist = MarkersList()
+            mlist.add_markers(numpy.arange(num) % 97 + 1,
+                              rng.rand(num) * 4096 - 2048,
+                              rng.rand(num) * 2048,
+                              numpy.arange(num) % 121)
+            mfile = os.path.join(temp_dir, '2Dmarkers_all.txt')
+            mlist.write_markers_to_file(mfile)
+
+            fac = MarkersFrom3DMarkersFileFactory(mfile, usecache=True,
+                                                  compact=True)
+            self.assertEqual(fac.get_compact(), True)
+            self.assertTrue(fac.get_cache_file().endswith('.f32.npy'))
+            parsed = fac.get_markerslist()
+            cached = fac.get_markerslist()
+            self.assertEqual(parsed.is_compact(), True)
+            self.assertEqual(cached.is_compact(), True)
+            data = numpy.load(fac.get_cache_file(), mmap_mode='r')
+            self.assertEqual(data.dtype,
+                             MarkersFrom3DMarkersFileFactory.
+                             COMPACT_CACHE_DTYPE)
+            self.assertEqual(data.itemsize * 2,
+                             MarkersFrom3DMarkersFileFactory.
+                             CACHE_DTYPE.itemsize)
+            del data
+
+            # double precision sidecar of same file is kept alongside
+            fac.set_compact(False)
+            full = fac.get_markerslist()
+            self.assertEqual(full.is_compact(), False)
+            self.assertEqual(len(os.listdir(temp_dir)), 3)
+
+            f = open(mfile, 'r')
+            expected = f.read().splitlines()
+            f.close()
+            for compact in [parsed, cached]:
+                outfile = os.path.join(temp_dir, 'out.txt')
+                compact.write_markers_to_file(outfile)
+                f = open(outfile, 'r')
+                lines = f.read().splitlines()
+                f.close()
+                self.assertEqual(len(lines), num)
+                for (line, exp) in zip(lines, expected):
+                    self.assertEqual(len(line), len(exp))
+                    values = [float(v) for v in line.split()]
+                    exp_values = [float(v) for v in exp.split()]
+                    self.assertEqual(values[0], exp_values[0])
+                    self.assertEqual(values[3], exp_values[3])
+                    for pos in [1, 2]:
+                        bound = (abs(exp_values[pos]) *
+                                 MarkersList.COMPACT_ERROR + 1e-6)
+                        self.assertTrue(abs(values[pos] -
+                                            exp_values[pos]) <= bound)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_markersfrom3dmarkers_invalid_values(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            mfile = os.path.join(temp_dir, '3Dmarkers.txt')
+            f = open(mfile, 'w')
+            f.write('     1  442.000000  633.000000   12.000000\n')
+            f.write('     2  foo  633.000000   12.000000\n')
+            f.close()
+            fac = MarkersFrom3DMarkersFileFactory(mfile)
+            try:
+                fac.get_markerslist()
+                self.fail('Expected ValueError')
+            except ValueError:
+                pass
+
+            f = open(mfile, 'w')
+            f.write('     1.5  442.000000  633.000000   12.000000\n')
+            f.close()
+            try:
+                fac.get_markerslist()
+                self.fail('Expected ValueError')
+            except ValueError:
+                pass
+        finally:
+            shutil.rmtree(temp_dir)
+
     # test Common 1 markerslist
     def test_filtermarkers_one_markerlist(self):
         mlist = MarkersList()
@@ -500,6 +1027,274 @@ class TestMarker(unittest.TestCase):
         self.assertEqual(uni.get_markers()[1].get_index(), 5)
         self.assertEqual(uni.get_markers()[1].get_y(), 1)
 
+    def test_filtermarkers_iterable_of_markerlists(self):
+        mlist1 = MarkersList()
+        mlist1.add_marker(1, 2, 3, 4)
+        mlist1.add_marker(2, 2, 3, 5)
+        chunk1 = MarkersList()
+        chunk1.add_marker(1, 2, 3, 4)
+        chunk2 = MarkersList()
+        chunk2.add_marker(3, 2, 3, 4)
+        filt = CommonByIndexMarkersListFilter([mlist1,
+                                               iter([chunk1, chunk2])])
+        com, uni = filt.filterMarkers(mlist1)
+        self.assertEqual(len(com.get_markers()), 1)
+        self.assertEqual(com.get_markers()[0].get_index(), 1)
+        self.assertEqual(len(uni.get_markers()), 1)
+        self.assertEqual(uni.get_markers()[0].get_index(), 2)
+
+    def test_filtermarkers_common_indexes_and_mask(self):
+        filt = CommonByIndexMarkersListFilter([])
+        self.assertEqual(filt.get_common_indexes().tolist(), [])
+        mlist1 = MarkersList()
+        mlist1.add_markers([9, 3, 7, 3, 1, 12], [0, 1, 2, 3, 4, 5],
+                           [5, 4, 3, 2, 1, 0], [0, 0, 0, 1, 1, 1])
+        self.assertEqual(filt.get_common_mask(mlist1).tolist(),
+                         [False] * 6)
+
+        mlist2 = MarkersList()
+        mlist2.add_markers([3, 12, 9, 5], [0, 0, 0, 0], [0, 0, 0, 0],
+                           [0, 0, 0, 0])
+        mlist3 = MarkersList()
+        mlist3.add_markers([12, 3, 9, 9], [0, 0, 0, 0], [0, 0, 0, 0],
+                           [0, 0, 0, 0])
+        filt = CommonByIndexMarkersListFilter([mlist1, mlist2, mlist3])
+        self.assertEqual(filt.get_common_indexes().tolist(), [3, 9, 12])
+        self.assertEqual(filt.get_common_mask(mlist1).tolist(),
+                         [True, True, False, True, False, True])
+
+        com, uni = filt.filterMarkers(mlist1)
+        self.assertEqual(com.get_indexes().tolist(), [9, 3, 3, 12])
+        self.assertEqual(com.get_x().tolist(), [0, 1, 3, 5])
+        self.assertEqual(com.get_y().tolist(), [5, 4, 2, 0])
+        self.assertEqual(com.get_z().tolist(), [0, 0, 1, 1])
+        self.assertEqual(uni.get_indexes().tolist(), [7, 1])
+        self.assertEqual(uni.get_x().tolist(), [2, 4])
+
+    def test_filtermarkers_add_markers_list(self):
+        filt = CommonByIndexMarkersListFilter([])
+        self.assertEqual(filt.get_markers_list_count(), 0)
+        mlist1 = MarkersList()
+        mlist1.add_markers([4, 1, 2, 3], [0, 1, 2, 3], [0, 0, 0, 0],
+                           [0, 0, 0, 0])
+        filt.add_markers_list(mlist1)
+        self.assertEqual(filt.get_markers_list_count(), 1)
+        self.assertEqual(filt.get_common_indexes().tolist(), [1, 2, 3, 4])
+
+        chunk1 = MarkersList()
+        chunk1.add_marker(3, 0, 0, 0)
+        chunk2 = MarkersList()
+        chunk2.add_markers([1, 5], [0, 0], [0, 0], [0, 0])
+        filt.add_markers_list(iter([chunk1, chunk2]))
+        self.assertEqual(filt.get_markers_list_count(), 2)
+        self.assertEqual(filt.get_common_indexes().tolist(), [1, 3])
+
+        com, uni = filt.filterMarkers(mlist1)
+        self.assertEqual(com.get_x().tolist(), [1, 3])
+        self.assertEqual(uni.get_x().tolist(), [0, 2])
+
+        filt.add_markers_list(MarkersList())
+        self.assertEqual(filt.get_common_indexes().tolist(), [])
+
+    def test_track_index_empty(self):
+        tindex = TrackIndex(MarkersList())
+        self.assertEqual(len(tindex), 0)
+        self.assertEqual(tindex.get_track_ids().tolist(), [])
+        self.assertEqual(tindex.get_track_offsets().tolist(), [0])
+        self.assertEqual(tindex.get_tilts().tolist(), [])
+        (xs, ys, zs) = tindex.get_track(1)
+        self.assertEqual(len(xs), 0)
+        (indexes, xs, ys) = tindex.get_tilt(0)
+        self.assertEqual(len(indexes), 0)
+
+    def test_track_index(self):
+        markers = MarkersList()
+        markers.add_markers([7, 3, 7, 3, 9, 7], [0, 1, 2, 3, 4, 5],
+                            [10, 11, 12, 13, 14, 15], [1, 0, 0, 1, 1, 2])
+        markers.add_marker(None, 1, 2, 0)
+        markers.add_marker(3, 1, None, 0)
+        tindex = TrackIndex(markers)
+        self.assertEqual(len(tindex), 6)
+        self.assertEqual(tindex.get_track_ids().tolist(), [3, 7, 9])
+        self.assertEqual(tindex.get_track_offsets().tolist(), [0, 2, 5, 6])
+        self.assertEqual(tindex.get_track_lengths().tolist(), [2, 3, 1])
+        self.assertEqual(tindex.get_track_order().tolist(),
+                         [1, 3, 0, 2, 5, 4])
+
+        (xs, ys, zs) = tindex.get_track(7)
+        self.assertEqual(xs.tolist(), [0, 2, 5])
+        self.assertEqual(ys.tolist(), [10, 12, 15])
+        self.assertEqual(zs.tolist(), [1, 0, 2])
+        self.assertFalse(xs.flags['OWNDATA'])
+        (xs, ys, zs) = tindex.get_track(8)
+        self.assertEqual(len(xs), 0)
+        (xs, ys, zs) = tindex.get_track(100)
+        self.assertEqual(len(xs), 0)
+
+        self.assertEqual(tindex.get_tilts().tolist(), [0, 1, 2])
+        self.assertEqual(tindex.get_tilt_offsets().tolist(), [0, 2, 5, 6])
+        self.assertEqual(tindex.get_tilt_order().tolist(),
+                         [1, 2, 0, 3, 4, 5])
+        (indexes, xs, ys) = tindex.get_tilt(1)
+        self.assertEqual(indexes.tolist(), [7, 3, 9])
+        self.assertEqual(xs.tolist(), [0, 3, 4])
+        self.assertEqual(ys.tolist(), [10, 13, 14])
+
+        mlist = tindex.get_markers_list()
+        self.assertEqual(mlist.get_indexes().tolist(), [3, 3, 7, 7, 7, 9])
+        self.assertEqual(mlist.get_x().tolist(), [1, 3, 0, 2, 5, 4])
+        (indexes, xs, ys, zs) = tindex.get_tilt_ordered_markers()
+        self.assertEqual(zs.tolist(), [0, 0, 1, 1, 1, 2])
+
+    def test_filtermarkers_track_index(self):
+        mlist1 = MarkersList()
+        mlist1.add_markers([7, 3, 7, 3, 9], [0, 1, 2, 3, 4],
+                           [0, 0, 0, 0, 0], [0, 0, 1, 1, 0])
+        mlist2 = MarkersList()
+        mlist2.add_markers([9, 7, 4], [0, 0, 0], [0, 0, 0], [0, 0, 0])
+        tindex = TrackIndex(mlist1)
+        filt = CommonByIndexMarkersListFilter([tindex, TrackIndex(mlist2)])
+        self.assertEqual(filt.get_common_indexes().tolist(), [7, 9])
+        self.assertEqual(filt.get_common_track_mask(tindex).tolist(),
+                         [False, True, True])
+
+        com, uni = filt.filterMarkers(tindex)
+        self.assertEqual(com.get_indexes().tolist(), [7, 7, 9])
+        self.assertEqual(com.get_x().tolist(), [0, 2, 4])
+        self.assertEqual(uni.get_indexes().tolist(), [3, 3])
+        self.assertEqual(uni.get_x().tolist(), [1, 3])
+
+    def test_get_euler_rotation_matrix(self):
+        try:
+            marker.get_euler_rotation_matrix((1, None, 2))
+            self.fail('Expected InvalidAngleError')
+        except InvalidAngleError:
+            pass
+        try:
+            marker.get_euler_rotation_matrix((1, 2))
+            self.fail('Expected InvalidAngleError')
+        except InvalidAngleError:
+            pass
+
+        # z rotation matches 2D rotation matrix
+        rot = marker.get_euler_rotation_matrix((30, 0, 0))
+        self.assertTrue(numpy.allclose(rot[:2, :2],
+                                       marker.get_rotation_matrix(30, 0,
+                                                                  0)[:2,
+                                                                     :2]))
+        rot = marker.get_euler_rotation_matrix((0, 90, 0))
+        self.assertTrue(numpy.allclose(numpy.dot(rot, [1, 0, 0]),
+                                       [0, 0, -1]))
+        rot = marker.get_euler_rotation_matrix((0, 0, 90))
+        self.assertTrue(numpy.allclose(numpy.dot(rot, [0, 1, 0]),
+                                       [0, 0, 1]))
+        # z is applied first, then y, then x
+        rot = marker.get_euler_rotation_matrix((90, 90, 0))
+        self.assertTrue(numpy.allclose(numpy.dot(rot, [1, 0, 0]),
+                                       [0, 1, 0]))
+        self.assertTrue(numpy.allclose(numpy.dot(rot, [0, 1, 0]),
+                                       [0, 0, 1]))
+        self.assertEqual(marker.get_volume_center(10, 5, 3), (5, 2.5, 1.5))
+
+    def test_rotate_3d(self):
+        mlist = MarkersList()
+        mlist.add_markers([1, 2, 3], [10, 0, 4], [5, 5, 1], [0, 1, 2])
+        mlist2d = MarkersList()
+        mlist2d.add_markers([1, 2, 3], [10, 0, 4], [5, 5, 1], [0, 1, 2])
+
+        mlist.rotate_3d((25, 0, 0), marker.get_volume_center(10, 10, 4))
+        mlist2d.rotate_by_angle(25, 5, 5)
+        self.assertTrue(numpy.allclose(mlist.get_x(), mlist2d.get_x()))
+        self.assertTrue(numpy.allclose(mlist.get_y(), mlist2d.get_y()))
+        self.assertEqual(mlist.get_z().tolist(), [0, 1, 2])
+
+        mlist = MarkersList()
+        mlist.add_marker(1, 6, 5, 2)
+        mlist.rotate_3d((0, 90, 0), (5, 5, 2), outcenter=(4, 4, 1))
+        self.assertTrue(numpy.allclose(mlist.get_x(), [4]))
+        self.assertTrue(numpy.allclose(mlist.get_y(), [4]))
+        self.assertTrue(numpy.allclose(mlist.get_z(), [0]))
+
+        try:
+            mlist.rotate_3d((0, 90, 0), (5, 5))
+            self.fail('Expected ValueError')
+        except ValueError:
+            pass
+
+    def test_get_rotated_3d_by_angles(self):
+        rng = numpy.random.RandomState(3)
+        mlist = MarkersList()
+        mlist.add_markers(numpy.arange(50), rng.rand(50) * 100,
+                          rng.rand(50) * 100, rng.rand(50) * 20)
+        mlist.add_shift(1, 2)
+        angles_list = [(0, 0, 0), (10, 20, 30), (-45, 5, 90)]
+        center = (50, 50, 10)
+        rotated = mlist.get_rotated_3d_by_angles(angles_list, center)
+        self.assertEqual(rotated.shape, (3, 50, 3))
+        self.assertTrue(numpy.allclose(rotated[0, :, 0], mlist.get_x()))
+        self.assertTrue(numpy.allclose(rotated[0, :, 2], mlist.get_z()))
+        for (pos, angles) in enumerate(angles_list):
+            single = mlist.get_rotated_3d_by_angles([angles], center)[0]
+            self.assertTrue(numpy.allclose(rotated[pos], single))
+            rot = marker.get_euler_rotation_matrix(angles)
+            points = numpy.column_stack((mlist.get_x(), mlist.get_y(),
+                                         mlist.get_z())) - center
+            self.assertTrue(numpy.allclose(rotated[pos],
+                                           numpy.dot(points, rot.T) +
+                                           center))
+
+    def test_coordinate_frame(self):
+        try:
+            marker.CoordinateFrame(10, 10, binning=0)
+            self.fail('Expected ValueError')
+        except ValueError:
+            pass
+        full = marker.CoordinateFrame(300, 600)
+        clip = marker.CoordinateFrame(100, 200, xoffset=100, yoffset=200)
+        binned = clip.get_binned(2)
+        self.assertEqual(binned.get_binning(), 2)
+        self.assertEqual(binned.get_xoffset(), 100)
+        self.assertEqual(binned.get_width(), 100)
+
+        matrix = full.get_transform_from(clip)
+        self.assertEqual(numpy.dot(matrix, [5, 6, 1]).tolist(),
+                         [105, 206, 1])
+        matrix = binned.get_transform_from(full)
+        self.assertEqual(numpy.dot(matrix, [110, 220, 1]).tolist(),
+                         [5, 10, 1])
+        self.assertEqual(binned.get_inside_mask([0, 49.5, 50, -1, 1],
+                                                [0, 99, 1, 1,
+                                                 numpy.nan]).tolist(),
+                         [True, True, False, False, False])
+
+    def test_get_in_frame(self):
+        full = marker.CoordinateFrame(300, 600)
+        clip = marker.CoordinateFrame(100, 200, xoffset=100, yoffset=200)
+        mlist = MarkersList()
+        mlist.add_markers([1, 2, 3, 4], [5, 150, 99, 120],
+                          [6, 300, 199, 220], [0, 1, 2, 3])
+        mlist.add_marker(5, None, 1, 1)
+        mlist.add_shift(0, 0)
+
+        inclip = mlist.get_in_frame(full, clip)
+        self.assertEqual(inclip.get_indexes().tolist(), [2, 4])
+        self.assertEqual(inclip.get_x().tolist(), [50, 20])
+        self.assertEqual(inclip.get_y().tolist(), [100, 20])
+        self.assertEqual(inclip.get_z().tolist(), [1, 3])
+
+        infull = mlist.get_in_frame(clip, full)
+        self.assertEqual(infull.get_indexes().tolist(), [1, 2, 3, 4])
+        self.assertEqual(infull.get_x().tolist(), [105, 250, 199, 220])
+        infull = mlist.get_in_frame(clip, marker.CoordinateFrame(200, 400))
+        self.assertEqual(infull.get_indexes().tolist(), [1, 3])
+
+        inbinned = mlist.get_in_frame(full, full.get_binned(4))
+        self.assertEqual(inbinned.get_x().tolist(), [1.25, 37.5, 24.75, 30])
+
+        # source is not modified
+        self.assertEqual(len(mlist), 5)
+        self.assertEqual(mlist.get_x().tolist()[:4], [5, 150, 99, 120])
+
 
 if __name__ == '__main__':
     sys.exit(unittest.main())
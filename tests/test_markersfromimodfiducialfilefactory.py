@@ -17,6 +17,7 @@ import stat
 import shutil
 
 from etspecutil.marker import MarkersFromIMODFiducialFileFactory
+from tests.test_imod import write_test_model
 
 
 class TestMarkersFromIMODFiducialFileFactory(unittest.TestCase):
@@ -105,6 +106,75 @@ class TestMarkersFromIMODFiducialFileFactory(unittest.TestCase):
         finally:
             shutil.rmtree(temp_dir)
 
+    def test_get_markers_binary_model_skips_model2point(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            fid_file = os.path.join(temp_dir, 'foo.fid')
+            write_test_model(fid_file, [[[(188.5, 283, 0), (192.25, 283, 1)],
+                                         [(10, 11, 0)]]])
+            mfac = MarkersFromIMODFiducialFileFactory(fid_file)
+            mfac.set_model2point_binary('false')
+            mlist = mfac.get_markers()
+            self.assertEqual(len(mlist.get_markers()), 3)
+            m = mlist.get_markers()[1]
+            self.assertEqual(m.get_index(), 1)
+            self.assertEqual(m.get_x(), 192.25)
+            self.assertEqual(m.get_y(), 283)
+            self.assertEqual(m.get_z(), 1)
+            m = mlist.get_markers()[2]
+            self.assertEqual(m.get_index(), 2)
+            self.assertEqual(m.get_x(), 10)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_iter_markers(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            mfac = MarkersFromIMODFiducialFileFactory(None)
+            self.assertEqual(list(mfac.iter_markers()), [])
+
+            fid_file = os.path.join(temp_dir, 'foo.fid')
+            write_test_model(fid_file, [[[(188.5, 283, 0), (192.25, 283, 1)],
+                                         [(10, 11, 0)]]])
+            mfac = MarkersFromIMODFiducialFileFactory(fid_file)
+            mfac.set_model2point_binary('false')
+            chunks = list(mfac.iter_markers())
+            self.assertEqual(len(chunks), 2)
+            self.assertEqual(chunks[0].get_indexes().tolist(), [1, 1])
+            self.assertEqual(chunks[0].get_x().tolist(), [188.5, 192.25])
+            self.assertEqual(chunks[1].get_indexes().tolist(), [2])
+            self.assertEqual(chunks[1].get_z().tolist(), [0])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_iter_markers_model2point_fallback(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            fid_file = os.path.join(temp_dir, 'somefile.txt')
+            open(fid_file, 'a').close()
+            fakemodel2point = os.path.join(temp_dir, 'model2point.py')
+            f = open(fakemodel2point, 'w')
+            f.write('#!/usr/bin/env python\n\n')
+            f.write('import sys\n')
+            f.write('f = open(sys.argv[4], "w")\n')
+            f.write('f.write("     1      188.52      283.08        '
+                    '0.00\\n")\n')
+            f.write('f.write("     2      192.29      283.06        '
+                    '1.00\\n")\n')
+            f.write('f.write("     1      196.04      283.04        '
+                    '2.00\\n")\n')
+            f.write('f.close()\n')
+            f.close()
+            os.chmod(fakemodel2point, stat.S_IRWXU)
+            mfac = MarkersFromIMODFiducialFileFactory(fid_file)
+            mfac.set_model2point_binary(fakemodel2point)
+            chunks = list(mfac.iter_markers())
+            self.assertEqual(len(chunks), 2)
+            self.assertEqual(chunks[0].get_x().tolist(), [188.52, 196.04])
+            self.assertEqual(chunks[1].get_x().tolist(), [192.29])
+        finally:
+            shutil.rmtree(temp_dir)
+
 
 if __name__ == '__main__':
     sys.exit(unittest.main())
@@ -20,6 +20,8 @@ from etspecutil.marker import UnsetMarkersListError
 from etspecutil.marker import UnsetFiducialFileError
 from etspecutil.marker import MarkersToIMODFiducialFileWriter
 from etspecutil.marker import MarkersList
+from etspecutil.marker import TrackIndex
+from etspecutil.marker import MarkersFromIMODFiducialFileFactory
 
 
 class TestMarkersToIMODFiducialFileWriter(unittest.TestCase):
@@ -112,5 +114,79 @@ class TestMarkersToIMODFiducialFileWriter(unittest.TestCase):
         finally:
             shutil.rmtree(temp_dir)
 
+    def test_write_markers_native(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            fid_file = os.path.join(temp_dir, 'foo.fid')
+            mwriter = MarkersToIMODFiducialFileWriter(fid_file)
+            mlist = MarkersList()
+            mlist.add_marker(1, 4, 5, 6)
+            mlist.add_marker(None, 4, 5, 6)
+            mlist.add_marker(2, None, 5, 6)
+            mlist.add_marker(1, 7, 8, 9)
+            mlist.add_marker(5, 1, 2, 3)
+            mwriter.write_markers(mlist)
+
+            mfac = MarkersFromIMODFiducialFileFactory(fid_file)
+            mfac.set_model2point_binary('false')
+            res = mfac.get_markers()
+            self.assertEqual(res.get_indexes().tolist(), [1, 1, 2])
+            self.assertEqual(res.get_x().tolist(), [4, 7, 1])
+            self.assertEqual(res.get_y().tolist(), [5, 8, 2])
+            self.assertEqual(res.get_z().tolist(), [6, 9, 3])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_write_markers_track_index(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            fid_file = os.path.join(temp_dir, 'foo.fid')
+            mwriter = MarkersToIMODFiducialFileWriter(fid_file)
+            mlist = MarkersList()
+            mlist.add_marker(5, 1, 2, 3)
+            mlist.add_marker(1, 4, 5, 6)
+            mlist.add_marker(1, 7, 8, 9)
+            mwriter.write_markers(TrackIndex(mlist))
+
+            mfac = MarkersFromIMODFiducialFileFactory(fid_file)
+            res = mfac.get_markers()
+            self.assertEqual(res.get_indexes().tolist(), [1, 1, 2])
+            self.assertEqual(res.get_x().tolist(), [4, 7, 1])
+            self.assertEqual(res.get_z().tolist(), [6, 9, 3])
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+    def test_write_markers_iter(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            fid_file = os.path.join(temp_dir, 'foo.fid')
+            mwriter = MarkersToIMODFiducialFileWriter(None)
+            try:
+                mwriter.write_markers_iter([])
+                self.fail('Expected UnsetFiducialFileError')
+            except UnsetFiducialFileError:
+                pass
+
+            first = MarkersList()
+            first.add_markers([1, 1], [4, 7], [5, 8], [6, 9])
+            second = MarkersList()
+            second.add_marker(5, 1, 2, 3)
+            mwriter = MarkersToIMODFiducialFileWriter(fid_file)
+            mwriter.write_markers_iter(iter([first, MarkersList(), second]))
+            f = open(fid_file, 'rb')
+            streamed = f.read()
+            f.close()
+
+            allmarkers = MarkersList()
+            allmarkers.add_markers([1, 1, 5], [4, 7, 1], [5, 8, 2],
+                                   [6, 9, 3])
+            mwriter.write_markers(allmarkers)
+            f = open(fid_file, 'rb')
+            self.assertEqual(f.read(), streamed)
+            f.close()
+        finally:
+            shutil.rmtree(temp_dir)
+
 if __name__ == '__main__':
     sys.exit(unittest.main())
@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_pipeline
+----------------------------------
+
+Tests for `pipeline` module.
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+import threading
+
+from etspecutil.pipeline import Stage
+from etspecutil.pipeline import Pipeline
+from etspecutil.pipeline import StageCheckpoint
+from etspecutil.pipeline import InvalidPipelineError
+
+
+class CoreCounter(object):
+    """Records the most cores in use at once by stage functions it
+       makes
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.in_use = 0
+        self.peak = 0
+        self.granted = {}
+        self.started = []
+
+    def get_func(self, name, seconds=0.05):
+        def func(cores):
+            self._lock.acquire()
+            self.in_use += cores
+            self.peak = max(self.peak, self.in_use)
+            self.granted[name] = cores
+            self.started.append(name)
+            self._lock.release()
+            time.sleep(seconds)
+            self._lock.acquire()
+            self.in_use -= cores
+            self._lock.release()
+        return func
+
+
+class FileWriter(object):
+    """Makes stage functions that write `content` to a file and
+       records the names of the stages that ran
+    """
+    def __init__(self):
+        self.ran = []
+        self.content = {}
+
+    def get_func(self, name, path):
+        def func(cores):
+            self.ran.append(name)
+            f = open(path, 'w')
+            f.write(self.content.get(name, name))
+            f.close()
+        return func
+
+
+def _write_file(path, content):
+    f = open(path, 'w')
+    f.write(content)
+    f.close()
+
+
+class TestPipeline(unittest.TestCase):
+
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_stage(self):
+        stage = Stage('foo', None)
+        self.assertEqual(stage.get_name(), 'foo')
+        self.assertEqual(stage.get_inputs(), [])
+        self.assertEqual(stage.get_outputs(), [])
+        self.assertEqual(stage.get_cores(), 1)
+        self.assertEqual(stage.get_estimate(), 1.0)
+        self.assertEqual(stage.get_duration(), None)
+
+        calls = []
+        stage = Stage('foo', calls.append, inputs=['a'], outputs=['b'],
+                      cores=4, estimate=3)
+        stage.run(2)
+        self.assertEqual(calls, [2])
+        self.assertTrue(stage.get_duration() >= 0)
+
+    def test_add_stage_invalid(self):
+        pipe = Pipeline([Stage('a', None, outputs=['x'])])
+        try:
+            pipe.add_stage(Stage('a', None))
+            self.fail('Expected InvalidPipelineError')
+        except InvalidPipelineError:
+            pass
+        try:
+            pipe.add_stage(Stage('b', None, outputs=['y', 'x']))
+            self.fail('Expected InvalidPipelineError')
+        except InvalidPipelineError as e:
+            self.assertTrue('x' in str(e))
+        self.assertEqual(len(pipe.get_stages()), 1)
+
+    def test_get_dependencies_and_order(self):
+        pipe = Pipeline([Stage('d', None, inputs=['c', 'b', 'in']),
+                         Stage('c', None, inputs=['a'], outputs=['c']),
+                         Stage('b', None, inputs=['a'], outputs=['b']),
+                         Stage('a', None, inputs=['in'], outputs=['a']),
+                         Stage('e', None, outputs=['e'])])
+        deps = pipe.get_dependencies()
+        self.assertEqual(deps, {'a': [], 'b': ['a'], 'c': ['a'],
+                                'd': ['c', 'b'], 'e': []})
+        self.assertEqual(pipe.get_order(), ['a', 'e', 'c', 'b', 'd'])
+
+        pipe.add_stage(Stage('f', None, inputs=['g'], outputs=['f']))
+        pipe.add_stage(Stage('g', None, inputs=['f'], outputs=['g']))
+        try:
+            pipe.get_order()
+            self.fail('Expected InvalidPipelineError')
+        except InvalidPipelineError as e:
+            self.assertTrue('f, g' in str(e))
+        try:
+            pipe.run(2)
+            self.fail('Expected InvalidPipelineError')
+        except InvalidPipelineError:
+            pass
+
+    def test_get_critical_path(self):
+        self.assertEqual(Pipeline().get_critical_path(), ([], 0))
+        pipe = Pipeline([Stage('a', None, outputs=['a'], estimate=2),
+                         Stage('b', None, inputs=['a'], outputs=['b'],
+                               estimate=5),
+                         Stage('c', None, inputs=['a'], outputs=['c'],
+                               estimate=1),
+                         Stage('d', None, inputs=['b', 'c'], estimate=1),
+                         Stage('e', None, estimate=7)])
+        self.assertEqual(pipe.get_critical_path(), (['a', 'b', 'd'], 8))
+
+        # measured durations replace the estimates
+        pipe.get_stages()[2].set_duration(10)
+        self.assertEqual(pipe.get_critical_path(), (['a', 'c', 'd'], 13))
+
+    def test_run_respects_dependencies_and_budget(self):
+        counter = CoreCounter()
+        pipe = Pipeline([Stage('chain1', counter.get_func('chain1', 0.2),
+                               outputs=['x'], cores=8, estimate=10),
+                         Stage('chain2', counter.get_func('chain2'),
+                               inputs=['x'], outputs=['y'], cores=8,
+                               estimate=10),
+                         Stage('side1', counter.get_func('side1', 0.01),
+                               outputs=['s'], cores=1),
+                         Stage('side2', counter.get_func('side2', 0.01),
+                               outputs=['t'], cores=1),
+                         Stage('free', counter.get_func('free', 0.01),
+                               outputs=['u'], cores=0),
+                         Stage('last', counter.get_func('last'),
+                               inputs=['y', 's', 't', 'u'], cores=2)])
+        pipe.run(4)
+        self.assertTrue(counter.peak <= 4)
+        # critical stage goes first and leaves a core for each other
+        # ready stage that needs one, the next one in the chain gets
+        # all cores since the side stages are done by then
+        self.assertEqual(counter.granted['chain1'], 2)
+        self.assertEqual(counter.granted['side1'], 1)
+        self.assertEqual(counter.granted['side2'], 1)
+        self.assertEqual(counter.granted['free'], 0)
+        self.assertEqual(counter.granted['chain2'], 4)
+        self.assertEqual(counter.granted['last'], 2)
+        self.assertTrue(counter.started.index('chain2') >
+                        counter.started.index('chain1'))
+        self.assertEqual(counter.started[-1], 'last')
+        for stage in pipe.get_stages():
+            self.assertTrue(stage.get_duration() >= 0.005)
+
+    def test_run_concurrently(self):
+        counter = CoreCounter()
+        pipe = Pipeline([Stage(str(i), counter.get_func(str(i), 0.2))
+                         for i in range(4)])
+        start = time.time()
+        pipe.run(4)
+        self.assertTrue(time.time() - start < 0.6)
+        self.assertEqual(counter.peak, 4)
+
+        # single core runs one stage at a time
+        counter = CoreCounter()
+        pipe = Pipeline([Stage(str(i), counter.get_func(str(i), 0.01),
+                               cores=3)
+                         for i in range(4)])
+        pipe.run(None)
+        self.assertEqual(counter.peak, 1)
+
+    def test_run_stage_fails(self):
+        counter = CoreCounter()
+        ran = []
+
+        def fail(cores):
+            raise ValueError('broken')
+
+        pipe = Pipeline([Stage('a', fail, outputs=['a'], estimate=5),
+                         Stage('b', counter.get_func('b', 0.1)),
+                         Stage('c', ran.append, inputs=['a'])])
+        try:
+            pipe.run(2)
+            self.fail('Expected ValueError')
+        except ValueError as e:
+            self.assertEqual(str(e), 'broken')
+        # stage already running is waited for and dependent one not run
+        self.assertEqual(counter.in_use, 0)
+        self.assertEqual(ran, [])
+
+    def test_stage_checkpoint(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            inpath = os.path.join(temp_dir, 'in')
+            outpath = os.path.join(temp_dir, 'out')
+            _write_file(inpath, 'hello')
+            _write_file(outpath, 'world')
+            checkdir = os.path.join(temp_dir, 'checkpoint')
+            check = StageCheckpoint(checkdir)
+            self.assertEqual(check.get_checkpoint_dir(), checkdir)
+            self.assertEqual(check.get_fingerprint(os.path.join(temp_dir,
+                                                                'nope')),
+                             None)
+            fp = check.get_fingerprint(inpath)
+            self.assertEqual(fp['size'], 5)
+            self.assertEqual(fp['sha256'],
+                             '2cf24dba5fb0a30e26e83b2ac5b9e29e'
+                             '1b161e5c1fa7425e73043362938b9824')
+            known = {'size': 5, 'mtime': fp['mtime'], 'sha256': 'x'}
+            self.assertTrue(check.get_fingerprint(inpath, known) is known)
+
+            # hash set for file as it is now is used instead of hashing
+            seeded = StageCheckpoint(checkdir)
+            seeded.set_hash(inpath, 'abc')
+            self.assertEqual(seeded.get_fingerprint(inpath)['sha256'], 'abc')
+
+            stage = Stage('foo', None, inputs=[inpath], outputs=[outpath],
+                          params=[1, 'a'])
+            self.assertFalse(check.is_complete(stage))
+            check.write(stage, check.get_input_fingerprints(stage))
+            self.assertTrue(os.path.isfile(check.get_manifest_path(stage)))
+            self.assertEqual(os.listdir(checkdir),
+                             ['foo' + StageCheckpoint.MANIFEST_EXT])
+            self.assertTrue(check.is_complete(stage))
+
+            # parameters changed
+            self.assertFalse(check.is_complete(
+                Stage('foo', None, inputs=[inpath], outputs=[outpath],
+                      params=[2, 'a'])))
+
+            # input changed, new checkpoint so the hash is not cached
+            _write_file(inpath, 'hello!')
+            self.assertFalse(StageCheckpoint(checkdir).is_complete(stage))
+            _write_file(inpath, 'hello')
+            self.assertTrue(StageCheckpoint(checkdir).is_complete(stage))
+
+            # output half written or missing
+            _write_file(outpath, 'wor')
+            self.assertFalse(StageCheckpoint(checkdir).is_complete(stage))
+            os.remove(outpath)
+            self.assertFalse(StageCheckpoint(checkdir).is_complete(stage))
+            _write_file(outpath, 'world')
+            self.assertTrue(StageCheckpoint(checkdir).is_complete(stage))
+
+            # unreadable manifest
+            _write_file(check.get_manifest_path(stage), '{')
+            self.assertFalse(check.is_complete(stage))
+            check.remove(stage)
+            check.remove(stage)
+            self.assertFalse(os.path.isfile(check.get_manifest_path(stage)))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def _get_checkpointed_pipeline(self, temp_dir, writer, params=None):
+        paths = [os.path.join(temp_dir, n) for n in ['a', 'b', 'c']]
+        return Pipeline([Stage('a', writer.get_func('a', paths[0]),
+                               inputs=[os.path.join(temp_dir, 'in')],
+                               outputs=[paths[0]], params=params),
+                         Stage('b', writer.get_func('b', paths[1]),
+                               inputs=[paths[0]], outputs=[paths[1]]),
+                         Stage('c', writer.get_func('c', paths[2]),
+                               inputs=[paths[1]], outputs=[paths[2]])],
+                        checkpointdir=os.path.join(temp_dir, 'checkpoint'))
+
+    def test_run_with_checkpoint(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            _write_file(os.path.join(temp_dir, 'in'), 'in')
+            self.assertFalse(Pipeline([Stage('a', None)]).is_complete())
+            self.assertEqual(Pipeline().get_checkpoint(), None)
+            writer = FileWriter()
+            pipe = self._get_checkpointed_pipeline(temp_dir, writer)
+            self.assertFalse(pipe.is_complete())
+            self.assertEqual(pipe.run(2), ['a', 'b', 'c'])
+            self.assertTrue(pipe.is_complete())
+
+            # nothing changed so rerun skips every stage
+            writer = FileWriter()
+            pipe = self._get_checkpointed_pipeline(temp_dir, writer)
+            self.assertTrue(pipe.is_complete())
+            self.assertEqual(pipe.run(2), [])
+            self.assertEqual(writer.ran, [])
+            self.assertEqual(pipe.get_stages()[0].get_duration(), 0)
+
+            # half written output only redoes that stage
+            _write_file(os.path.join(temp_dir, 'c'), '')
+            pipe = self._get_checkpointed_pipeline(temp_dir, writer)
+            self.assertFalse(pipe.is_complete())
+            self.assertEqual(pipe.run(2), ['c'])
+
+            # new parameter that gives the same output leaves the
+            # following stages alone
+            pipe = self._get_checkpointed_pipeline(temp_dir, writer,
+                                                   params=[5])
+            self.assertEqual(pipe.run(2), ['a'])
+
+            # changed output redoes the stage that depends on it, which
+            # writes the same output so the last stage is still skipped
+            writer.content['a'] = 'changed'
+            pipe = self._get_checkpointed_pipeline(temp_dir, writer,
+                                                   params=[6])
+            self.assertEqual(pipe.run(2), ['a', 'b'])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_run_with_checkpoint_stage_fails(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            outpath = os.path.join(temp_dir, 'out')
+
+            def fail(cores):
+                _write_file(outpath, 'half')
+                raise ValueError('broken')
+
+            stage = Stage('a', fail, outputs=[outpath])
+            pipe = Pipeline([stage],
+                            checkpointdir=os.path.join(temp_dir, 'check'))
+            try:
+                pipe.run(1)
+                self.fail('Expected ValueError')
+            except ValueError:
+                pass
+            self.assertFalse(os.path.isfile(
+                pipe.get_checkpoint().get_manifest_path(stage)))
+            self.assertFalse(pipe.is_complete())
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    sys.exit(unittest.main())
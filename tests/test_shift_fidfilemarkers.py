@@ -11,9 +11,15 @@ Tests for `create_tiltseries` module.
 import sys
 import unittest
 import logging
+import os.path
+import tempfile
+import shutil
 
 from etspecutil import shift_fidfilemarkers
 from etspecutil.rotate_3dmarkers import Parameters
+from etspecutil.marker import MarkersFromIMODFiducialFileFactory
+from etspecutil.marker import MarkersToIMODFiducialFileWriter
+from tests.test_imod import write_test_model
 
 
 class TestShiftFidFileMarkers(unittest.TestCase):
@@ -58,15 +64,17 @@ class TestShiftFidFileMarkers(unittest.TestCase):
         self.assertEqual(theargs.outputfidfile, 'outdir')
         self.assertEqual(theargs.xshift, 360)
         self.assertEqual(theargs.yshift, 360)
+        self.assertEqual(theargs.patch, False)
         self.assertEqual(theargs.loglevel, 'WARNING')
 
         alist = ['inputmrc', 'outdir', '--xshift', '10', '--yshift', '20',
-                 '--log', 'DEBUG']
+                 '--patch', '--log', 'DEBUG']
         theargs = shift_fidfilemarkers._parse_arguments('hi', alist)
         self.assertEqual(theargs.inputfidfile, 'inputmrc')
         self.assertEqual(theargs.outputfidfile, 'outdir')
         self.assertEqual(theargs.xshift, 10)
         self.assertEqual(theargs.yshift, 20)
+        self.assertEqual(theargs.patch, True)
         self.assertEqual(theargs.loglevel, 'DEBUG')
 
     def test_main(self):
@@ -76,6 +84,75 @@ class TestShiftFidFileMarkers(unittest.TestCase):
         except Exception:
             pass
 
+    def test_shift_fiducial_file_markers(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            infid = os.path.join(temp_dir, 'in.fid')
+            write_test_model(infid, [[[(1, 2, 0)], [(3, 4, 1)]]])
+            for patch in [True, False]:
+                outfid = os.path.join(temp_dir, 'out' + str(patch) + '.fid')
+                theargs = shift_fidfilemarkers._parse_arguments('hi',
+                                                                [infid,
+                                                                 outfid])
+                theargs.patch = patch
+                theargs.xshift = 5
+                theargs.yshift = 7
+                shift_fidfilemarkers.shift_fiducial_file_markers(theargs)
+                mfac = MarkersFromIMODFiducialFileFactory(outfid)
+                markers = mfac.get_markers()
+                self.assertEqual(markers.get_indexes().tolist(), [1, 2])
+                self.assertEqual(markers.get_x().tolist(), [6, 8])
+                self.assertEqual(markers.get_y().tolist(), [9, 11])
+                self.assertEqual(markers.get_z().tolist(), [0, 1])
+
+            # missing input file is logged and not raised when patching
+            theargs.inputfidfile = os.path.join(temp_dir, 'nope.fid')
+            theargs.patch = True
+            shift_fidfilemarkers.shift_fiducial_file_markers(theargs)
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+    def test_shift_fiducial_file_markers_streamed(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            # contours of a single object are streamed and give the same
+            # file as shifting all markers at once
+            infid = os.path.join(temp_dir, 'in.fid')
+            write_test_model(infid, [[[(1, 2, 0), (2, 3, 1)], [],
+                                      [(3, 4, 1)]]])
+            self.assertTrue(
+                shift_fidfilemarkers._has_increasing_contour_numbers(infid))
+            outfid = os.path.join(temp_dir, 'out.fid')
+            theargs = shift_fidfilemarkers._parse_arguments('hi', [infid,
+                                                                   outfid])
+            shift_fidfilemarkers.shift_fiducial_file_markers(theargs)
+            f = open(outfid, 'rb')
+            streamed = f.read()
+            f.close()
+
+            markers = MarkersFromIMODFiducialFileFactory(infid).get_markers()
+            markers.shift_markers(360, 360, 0)
+            MarkersToIMODFiducialFileWriter(outfid).write_markers(markers)
+            f = open(outfid, 'rb')
+            self.assertEqual(f.read(), streamed)
+            f.close()
+
+            # contour numbers repeat in each object so the markers are
+            # merged by index
+            write_test_model(infid, [[[(1, 2, 0)], [(3, 4, 1)]],
+                                     [[(5, 6, 2)]]])
+            self.assertFalse(
+                shift_fidfilemarkers._has_increasing_contour_numbers(infid))
+            self.assertFalse(
+                shift_fidfilemarkers._has_increasing_contour_numbers(
+                    os.path.join(temp_dir, 'nope')))
+            shift_fidfilemarkers.shift_fiducial_file_markers(theargs)
+            markers = MarkersFromIMODFiducialFileFactory(outfid).get_markers()
+            self.assertEqual(markers.get_indexes().tolist(), [1, 1, 2])
+            self.assertEqual(markers.get_x().tolist(), [361, 365, 363])
+        finally:
+            shutil.rmtree(temp_dir)
 
 if __name__ == '__main__':
     sys.exit(unittest.main())
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_spatial
+----------------------------------
+
+Tests for `spatial` module.
+"""
+
+import sys
+import unittest
+
+import numpy
+
+from etspecutil.spatial import SpatialIndex
+from etspecutil.spatial import InvalidCellSizeError
+from etspecutil import spatial
+from etspecutil.marker import MarkersList
+from etspecutil.marker import TrackIndex
+
+
+class TestSpatial(unittest.TestCase):
+
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_constructor_invalid(self):
+        for cellsize in [None, 0, -1]:
+            try:
+                SpatialIndex([[0, 0]], cellsize)
+                self.fail('Expected InvalidCellSizeError')
+            except InvalidCellSizeError:
+                pass
+        try:
+            SpatialIndex([1, 2, 3], 1)
+            self.fail('Expected ValueError')
+        except ValueError:
+            pass
+        try:
+            SpatialIndex([[1, 2, 3, 4]], 1)
+            self.fail('Expected ValueError')
+        except ValueError:
+            pass
+
+        sindex = SpatialIndex([[1, 2]], 1)
+        self.assertEqual(len(sindex), 1)
+        self.assertEqual(sindex.get_cell_size(), 1)
+        try:
+            sindex.query_radius([[1, 2, 3]], 1)
+            self.fail('Expected ValueError')
+        except ValueError:
+            pass
+
+    def test_empty_index(self):
+        sindex = SpatialIndex(numpy.empty((0, 2)), 5)
+        (offsets, indices, distances) = sindex.query_radius([[0, 0],
+                                                             [1, 1]], 10)
+        self.assertEqual(offsets.tolist(), [0, 0, 0])
+        self.assertEqual(len(indices), 0)
+        (indices, distances) = sindex.query_knn([[0, 0]], 2)
+        self.assertEqual(indices.tolist(), [[-1, -1]])
+        self.assertEqual(distances.tolist(), [[numpy.inf, numpy.inf]])
+
+    def test_query_radius(self):
+        points = [[0, 0], [3, 4], [10, 0], [0.5, 0], [-6, -8]]
+        sindex = SpatialIndex(points, 2)
+        (offsets, indices, distances) = sindex.query_radius([[0, 0],
+                                                             [100, 100],
+                                                             [10, 1]], 5)
+        self.assertEqual(offsets.tolist(), [0, 3, 3, 4])
+        self.assertEqual(indices.tolist(), [0, 3, 1, 2])
+        self.assertEqual(distances.tolist(), [0, 0.5, 5, 1])
+
+    def test_query_radius_matches_brute_force(self):
+        rng = numpy.random.RandomState(1)
+        for dims in [2, 3]:
+            points = rng.rand(500, dims) * 100
+            queries = rng.rand(50, dims) * 120 - 10
+            for (cellsize, radius) in [(5, 7), (20, 3), (1, 50)]:
+                sindex = SpatialIndex(points, cellsize)
+                (offsets, indices,
+                 distances) = sindex.query_radius(queries, radius)
+                for pos in range(len(queries)):
+                    dist = numpy.sqrt(((points - queries[pos]) **
+                                       2).sum(axis=1))
+                    expected = numpy.flatnonzero(dist <= radius)
+                    expected = expected[numpy.argsort(dist[expected],
+                                                      kind='mergesort')]
+                    self.assertEqual(indices[offsets[pos]:
+                                             offsets[pos + 1]].tolist(),
+                                     expected.tolist())
+
+    def test_query_knn(self):
+        rng = numpy.random.RandomState(2)
+        points = rng.rand(300, 2) * 100
+        queries = numpy.vstack((rng.rand(20, 2) * 100, [[1000, -1000]]))
+        sindex = SpatialIndex(points, 3)
+        (indices, distances) = sindex.query_knn(queries, 4)
+        self.assertEqual(indices.shape, (21, 4))
+        for pos in range(len(queries)):
+            dist = numpy.sqrt(((points - queries[pos]) ** 2).sum(axis=1))
+            expected = numpy.argsort(dist, kind='mergesort')[:4]
+            self.assertEqual(indices[pos].tolist(), expected.tolist())
+            self.assertEqual(distances[pos].tolist(),
+                             dist[expected].tolist())
+
+        # fewer points than k
+        sindex = SpatialIndex([[0, 0], [1, 0]], 10)
+        (indices, distances) = sindex.query_knn([[5, 0]], 3)
+        self.assertEqual(indices.tolist(), [[1, 0, -1]])
+        self.assertEqual(distances.tolist(), [[4, 5, numpy.inf]])
+
+    def test_find_pairs(self):
+        sindex = SpatialIndex([[0, 0], [5, 5], [0, 1], [5.5, 5], [20, 20]],
+                              1)
+        (first, second, distances) = sindex.find_pairs(1)
+        self.assertEqual(first.tolist(), [0, 1])
+        self.assertEqual(second.tolist(), [2, 3])
+        self.assertEqual(distances.tolist(), [1, 0.5])
+
+    def test_get_markers_spatial_index(self):
+        markers = MarkersList()
+        markers.add_marker(1, 0, 0, 0)
+        markers.add_marker(2, None, 0, 0)
+        markers.add_marker(3, 1, 0, 10)
+        (sindex, positions) = spatial.get_markers_spatial_index(markers, 5)
+        self.assertEqual(positions.tolist(), [0, 2])
+        self.assertEqual(sindex.get_points().tolist(), [[0, 0], [1, 0]])
+        (first, second, distances) = sindex.find_pairs(2)
+        self.assertEqual(len(first), 1)
+
+        (sindex, positions) = spatial.get_markers_spatial_index(markers, 5,
+                                                                usez=True)
+        self.assertEqual(sindex.get_points().tolist(), [[0, 0, 0],
+                                                        [1, 0, 10]])
+        (first, second, distances) = sindex.find_pairs(2)
+        self.assertEqual(len(first), 0)
+
+    def test_get_tilt_spatial_index(self):
+        markers = MarkersList()
+        markers.add_markers([1, 2, 3, 1], [0, 5, 9, 1], [0, 5, 9, 1],
+                            [0, 1, 0, 1])
+        (sindex, indexes) = spatial.get_tilt_spatial_index(
+            TrackIndex(markers), 0, 5)
+        self.assertEqual(indexes.tolist(), [1, 3])
+        self.assertEqual(sindex.get_points().tolist(), [[0, 0], [9, 9]])
+        (indices, distances) = sindex.query_knn([[8, 8]], 1)
+        self.assertEqual(indexes[indices[0]].tolist(), [3])
+
+
+if __name__ == '__main__':
+    sys.exit(unittest.main())
@@ -14,11 +14,122 @@ import os.path
 import tempfile
 import shutil
 import logging
+import threading
 
+from etspecutil import util
+from etspecutil import create_tiltseries
 from etspecutil.tiltseries import TiltSeriesCreator
+from etspecutil.tiltseries import TiltSeriesContext
+from etspecutil.marker import MarkersList
+from etspecutil.marker import CommonByIndexMarkersListFilter
+from etspecutil.marker import CoordinateFrame
+from etspecutil.imod import IMODModelReader
 from etspecutil.rotate_3dmarkers import Parameters
 
 
+class RecordingTiltSeriesCreator(TiltSeriesCreator):
+    """Writes the cores, thread and working directory it would generate
+       a tilt series with to a file instead of running external programs
+    """
+    def _generate_tilt_series(self, ctx):
+        f = open(os.path.join(ctx.get_workdir(), 'generated'), 'w')
+        f.write(str(ctx.get_rotation()) + ' ' + str(ctx.get_cores()) + ' ' +
+                str(threading.current_thread().ident) + ' ' + os.getcwd())
+        f.close()
+        return ctx.get_workdir()
+
+
+class RecordingHandler(logging.Handler):
+    """Keeps the messages of the log records it handles
+    """
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class FakeStagesTiltSeriesCreator(TiltSeriesCreator):
+    """Writes the output files of each stage, with the stage name as
+       content, instead of running external programs and records the
+       stages that ran
+    """
+    def __init__(self, theargs):
+        super(FakeStagesTiltSeriesCreator, self).__init__(theargs)
+        self.ran = []
+
+    def _write(self, name, paths):
+        self.ran.append(name)
+        for path in paths:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            f = open(path, 'w')
+            f.write(name)
+            f.close()
+
+    def _run_all_255(self, ctx):
+        self._write('all_255', [os.path.join(ctx.get_workdir(),
+                                             self._unimrc)])
+
+    def _run_extend_mean(self, ctx):
+        self._write('extend_mean', [os.path.join(ctx.get_workdir(),
+                                                 self._extmeanmrc)])
+
+    def _run_raw_tilt(self, ctx):
+        self._write('rawtlt', [os.path.join(ctx.get_workdir(),
+                                            self._rawtlt)])
+
+    def _run_warpz(self, ctx):
+        self._write('warpZ_inter_del', [os.path.join(ctx.get_warpz_dir(),
+                                                     self._warpz)])
+
+    def _run_volume_marker(self, ctx):
+        self._write('volume_marker',
+                    [os.path.join(ctx.get_marker_dir(), self._markermrc),
+                     os.path.join(ctx.get_marker_dir(),
+                                  TiltSeriesCreator.THREE_D_MARKERS_TXT)])
+
+    def _run_rotatevol(self, ctx):
+        self._write('rotatevol ' + str(ctx.get_rotation()),
+                    [os.path.join(ctx.get_marker_dir(), self._markermrc)])
+
+    def _run_project_all(self, ctx):
+        self._write('project_all ' + str(ctx.get_rotation()),
+                    [os.path.join(ctx.get_workdir(), self._projectionmrc),
+                     os.path.join(ctx.get_projection_dir(),
+                                  TiltSeriesCreator.OFFSET_ALL_TXT)])
+
+    def _run_clip_projection_mrc(self, ctx):
+        self._write('clip ' + str(ctx.get_rotation()),
+                    [os.path.join(ctx.get_workdir(),
+                                  self._projectionclipmrc)])
+
+    def _run_volume_marker_position_all(self, ctx):
+        self._write('volume_marker_position_all ' + str(ctx.get_rotation()),
+                    [os.path.join(ctx.get_tracking_dir(),
+                                  TiltSeriesCreator.TWO_D_MARKERS_ALL_TXT)])
+
+    def _write_two_d_markers_all_fid(self, ctx):
+        self._write('2Dmarkers_all_fid ' + str(ctx.get_rotation()),
+                    [os.path.join(ctx.get_workdir(),
+                                  TiltSeriesCreator.TWO_D_MARKERS_ALL_FID)])
+
+    def _run_rotate_3dmarkers(self, ctx):
+        self._write('rotate_3dmarkers ' + str(ctx.get_rotation()),
+                    [os.path.join(ctx.get_marker_dir(),
+                                  TiltSeriesCreator.THREE_D_MARKERS_TXT)])
+
+    def _add_to_common_markers_filter(self, path, filt):
+        return path
+
+    def _generate_common_marker_files(self, jobs, filt):
+        self.jobs = jobs
+
+    def _put_all_tilts_into_result_dir(self, dirlist):
+        pass
+
+
 class TestTiltSeriesCreator(unittest.TestCase):
 
     def setUp(self):
@@ -35,6 +146,7 @@ class TestTiltSeriesCreator(unittest.TestCase):
         theargs.endtilt = '60'
         theargs.tiltshift = '2'
         theargs.cores = '1'
+        theargs.parallelrotations = 1
         theargs.mpiexec = ''
         theargs.nummarkers = '20'
         theargs.bottommarkersize = '7'
@@ -46,6 +158,7 @@ class TestTiltSeriesCreator(unittest.TestCase):
         theargs.projmaxangle = '2'
         theargs.numrotations = '2'
         theargs.etspecbin = '/./foo'
+        theargs.cachedir = ''
         theargs.rotationangles = ''
         return theargs
 
@@ -61,10 +174,12 @@ class TestTiltSeriesCreator(unittest.TestCase):
         theargs = self._get_valid_args_for_constructor()
         ts = TiltSeriesCreator(theargs)
         self.assertEqual(ts._etspecbin, '/foo')
+        self.assertEqual(ts._cache, None)
         self.assertEqual(ts._rawrotationlist, [90.0])
 
     def test_initialize(self):
         temp_dir = tempfile.mkdtemp()
+        curdir = os.getcwd()
         try:
             theargs = self._get_valid_args_for_constructor()
             subdir = os.path.join(temp_dir, 'foo')
@@ -74,10 +189,14 @@ class TestTiltSeriesCreator(unittest.TestCase):
             ts = TiltSeriesCreator(theargs)
             ts.initialize()
             self.assertTrue(os.path.isdir(subdir))
-            self.assertTrue(os.getcwd().endswith('foo'))
+            self.assertTrue(os.path.isdir(os.path.join(
+                subdir, TiltSeriesCreator.PREPARED_DIR_NAME)))
+            self.assertEqual(os.getcwd(), curdir)
+            self.assertEqual(ts._outdir, subdir)
             self.assertEqual(ts._rotationangles, [0.0, 45.0, 90.0, 135.0])
 
         finally:
+            os.chdir(curdir)
             shutil.rmtree(temp_dir)
 
     def test_get_methods(self):
@@ -88,18 +207,21 @@ class TestTiltSeriesCreator(unittest.TestCase):
             theargs.outputdirectory = subdir
             theargs.numrotations = '4'
             ts = TiltSeriesCreator(theargs)
-            ts._workdir = temp_dir
-            self.assertEqual(ts._get_warpz_dir(),
+            ctx = TiltSeriesContext(temp_dir, 3, rotation=45.0)
+            self.assertEqual(ctx.get_workdir(), temp_dir)
+            self.assertEqual(ctx.get_cores(), 3)
+            self.assertEqual(ctx.get_rotation(), 45.0)
+            self.assertEqual(ctx.get_warpz_dir(),
                              os.path.join(temp_dir,
                                           TiltSeriesCreator.WARPZ_DIR_NAME))
-            self.assertEqual(ts._get_marker_dir(),
+            self.assertEqual(ctx.get_marker_dir(),
                              os.path.join(temp_dir,
                                           TiltSeriesCreator.MARKER_DIR_NAME))
-            self.assertEqual(ts._get_projection_dir(),
+            self.assertEqual(ctx.get_projection_dir(),
                              os.path.join(temp_dir,
                                           TiltSeriesCreator.
                                           PROJECTION_DIR_NAME))
-            self.assertEqual(ts._get_tracking_dir(),
+            self.assertEqual(ctx.get_tracking_dir(),
                              os.path.join(temp_dir,
                                           TiltSeriesCreator.TRACKING_DIR_NAME))
             self.assertEqual(ts._get_result_dir(),
@@ -107,5 +229,545 @@ class TestTiltSeriesCreator(unittest.TestCase):
                                           TiltSeriesCreator.RESULT_DIR_NAME))
         finally:
             shutil.rmtree(temp_dir)
+
+    def test_get_pipelines(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            theargs = self._get_valid_args_for_constructor()
+            theargs.outputdirectory = os.path.join(temp_dir, 'foo')
+            ts = TiltSeriesCreator(theargs)
+            ts.initialize()
+            ctx = TiltSeriesContext(temp_dir, 4)
+            pipe = ts._get_prepare_pipeline(ctx)
+            self.assertEqual(pipe.get_dependencies(),
+                             {'all_255': [],
+                              'extend_mean': ['all_255'],
+                              'rawtlt': [],
+                              'warpZ_inter_del': ['extend_mean'],
+                              'volume_marker': ['extend_mean',
+                                                'warpZ_inter_del'],
+                              'parameter_file': [],
+                              'project_file': []})
+            (path, total) = pipe.get_critical_path()
+            self.assertEqual(path, ['all_255', 'extend_mean',
+                                    'warpZ_inter_del', 'volume_marker'])
+            self.assertEqual([s.get_cores() for s in pipe.get_stages()],
+                             [4, 4, 1, 4, 4, 0, 0])
+
+            expected = {'project_all': [],
+                        'clip': ['project_all'],
+                        'volume_marker_position_all': ['project_all'],
+                        '2Dmarkers_all_fid': ['volume_marker_position_all']}
+            pipe = ts._get_rotation_pipeline(TiltSeriesContext(temp_dir, 2,
+                                                               rotation=0.0))
+            self.assertEqual(pipe.get_dependencies(), expected)
+
+            expected['rotatevol'] = []
+            expected['rotate_3dmarkers'] = []
+            expected['project_all'] = ['rotatevol']
+            expected['volume_marker_position_all'] = ['rotatevol',
+                                                      'rotate_3dmarkers',
+                                                      'project_all']
+            pipe = ts._get_rotation_pipeline(TiltSeriesContext(temp_dir, 2,
+                                                               rotation=90.0))
+            self.assertEqual(pipe.get_dependencies(), expected)
+
+            # stage runs with copy of context using the granted cores
+            granted = []
+            ts._run_raw_tilt = lambda c: granted.append((c.get_workdir(),
+                                                         c.get_cores()))
+            ts._get_prepare_pipeline(ctx).get_stages()[2].run(1)
+            self.assertEqual(granted, [(temp_dir, 1)])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_rotate_3dmarkers_in_one_batch(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            theargs = self._get_valid_args_for_constructor()
+            theargs.outputdirectory = temp_dir
+            theargs.inputmrcfile = os.path.join(temp_dir, 'input.mrc')
+            ts = TiltSeriesCreator(theargs)
+            ts.initialize()
+            prepared = ts._get_prepared_context()
+            os.makedirs(prepared.get_marker_dir())
+            markers = MarkersList()
+            markers.add_markers([1, 2], [1, 6], [2, 4], [3, 5])
+            markers.write_markers_to_file(ts._get_marker_files(prepared)[1])
+            calls = []
+
+            def get_dimensions(ctx):
+                calls.append(ctx.get_workdir())
+                return '10', '20', '4'
+            ts._get_mrc_marker_image_dimensions = get_dimensions
+
+            ts._set_marker_rotations([0.0, 90.0, 180.0])
+            for rotation in [90.0, 180.0]:
+                ctx = TiltSeriesContext(os.path.join(temp_dir,
+                                                     str(rotation)), 1,
+                                        rotation=rotation)
+                ts._run_rotate_3dmarkers(ctx)
+                expected = os.path.join(temp_dir, 'expected')
+                markers.write_rotated_markers_to_files([rotation], 5, 10,
+                                                       [expected])
+                f = open(ts._get_marker_files(ctx)[1])
+                g = open(expected)
+                self.assertEqual(f.read(), g.read())
+                f.close()
+                g.close()
+            self.assertEqual(calls, [ts._preparedir])
+
+            # rotation outside of the batch rotates the file again
+            ts._get_rotated_3dmarkers(45.0)
+            self.assertEqual(len(calls), 2)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_write_common_marker_files(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            theargs = self._get_valid_args_for_constructor()
+            ts = TiltSeriesCreator(theargs)
+            ts._mrcname = 'foo'
+            rotdir = os.path.join(temp_dir, '90_tiltseries')
+            os.makedirs(os.path.join(rotdir,
+                                     TiltSeriesCreator.TRACKING_DIR_NAME))
+            markers = MarkersList()
+            markers.add_markers([1, 2, 1, 2, 2], [10, 20, 11, 21, 60],
+                                [30, 40, 31, 41, 42], [0, 0, 1, 1, 2])
+            other = MarkersList()
+            other.add_markers([2, 3], [1, 1], [1, 1], [0, 0])
+            filt = CommonByIndexMarkersListFilter([markers, other])
+            clipframe = CoordinateFrame(50, 50, xoffset=100, yoffset=200)
+            fullframe = CoordinateFrame(150, 300)
+            ts._write_common_marker_files(rotdir, markers, filt, clipframe,
+                                          fullframe)
+
+            f = open(os.path.join(rotdir,
+                                  TiltSeriesCreator.TRACKING_DIR_NAME,
+                                  TiltSeriesCreator.TWO_D_MARKERS_COMMON_TXT))
+            self.assertEqual(f.read(),
+                             '     2   20.000000   40.000000    0.000000\n'
+                             '     2   21.000000   41.000000    1.000000\n'
+                             '     2   60.000000   42.000000    2.000000\n')
+            f.close()
+
+            reader = IMODModelReader(os.path.join(rotdir,
+                                                  'foo_projection_clip.fid'))
+            (indexes, xs, ys, zs) = reader.get_points()
+            self.assertEqual(indexes.tolist(), [1, 1])
+            self.assertEqual(xs.tolist(), [20, 21])
+            self.assertEqual(ys.tolist(), [40, 41])
+            self.assertEqual(zs.tolist(), [0, 1])
+
+            # marker at x 160 is outside the full frame too
+            reader.set_model_file(os.path.join(rotdir, 'foo_projection.fid'))
+            (indexes, xs, ys, zs) = reader.get_points()
+            self.assertEqual(xs.tolist(), [120, 121])
+            self.assertEqual(ys.tolist(), [240, 241])
+            self.assertEqual(zs.tolist(), [0, 1])
+
+            # marker at x 60 is outside clip frame but not the full one
+            ts._write_common_marker_files(rotdir, markers, filt, clipframe,
+                                          CoordinateFrame(1000, 1000))
+            (indexes, xs, ys, zs) = reader.get_points()
+            self.assertEqual(xs.tolist(), [120, 121, 160])
+            self.assertEqual(ys.tolist(), [240, 241, 242])
+
+            reader.set_model_file(os.path.join(rotdir,
+                                               'foo_projection_clip.fid'))
+            (indexes, xs, ys, zs) = reader.get_points()
+            self.assertEqual(xs.tolist(), [20, 21])
+
+            # markers passed in are not modified
+            self.assertEqual(markers.get_x().tolist(), [10, 20, 11, 21, 60])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_add_to_common_markers_filter_no_markers_file(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            theargs = self._get_valid_args_for_constructor()
+            ts = TiltSeriesCreator(theargs)
+            filt = CommonByIndexMarkersListFilter([])
+            self.assertEqual(ts._add_to_common_markers_filter(temp_dir,
+                                                              filt), None)
+            self.assertEqual(filt.get_markers_list_count(), 0)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_generate_tilt_series_for_rotations_default_args(self):
+        temp_dir = tempfile.mkdtemp()
+        handler = RecordingHandler()
+        tslogger = logging.getLogger('etspecutil.tiltseries')
+        level = tslogger.level
+        tslogger.setLevel(logging.WARNING)
+        tslogger.addHandler(handler)
+        try:
+            theargs = create_tiltseries._parse_arguments(
+                'hi', ['input.mrc', temp_dir, '--parallelrotations', '3'])
+            self.assertEqual(theargs.cores, None)
+            ts = RecordingTiltSeriesCreator(theargs)
+            self.assertEqual(ts._cores, util.get_cpu_count())
+            todo = []
+            for rotation in [10.0, 20.0, 30.0]:
+                rotationdir = os.path.join(temp_dir, str(rotation))
+                os.makedirs(rotationdir)
+                todo.append((rotation, rotationdir))
+            list(ts._generate_tilt_series_for_rotations(todo))
+            (concurrent, cores) = util.get_core_budget(ts._cores, 3)
+            f = open(os.path.join(todo[0][1], 'generated'))
+            self.assertEqual(f.read().split(' ')[1], str(cores))
+            f.close()
+            self.assertEqual(len([m for m in handler.messages
+                                  if 'raise --cores' in m]),
+                             int(concurrent < 3))
+
+            # too few cores for the rotations asked for is logged
+            handler.messages = []
+            ts._cores = '2'
+            list(ts._generate_tilt_series_for_rotations(todo))
+            self.assertEqual(handler.messages,
+                             ['Running 2 rotation(s) at a time instead of '
+                              '3 since only 2 core(s) are available, '
+                              'raise --cores to run more'])
+        finally:
+            tslogger.removeHandler(handler)
+            tslogger.setLevel(level)
+            shutil.rmtree(temp_dir)
+
+    def test_generate_tilt_series_for_rotations(self):
+        temp_dir = tempfile.mkdtemp()
+        curdir = os.getcwd()
+        try:
+            theargs = self._get_valid_args_for_constructor()
+            theargs.cores = '8'
+            ts = RecordingTiltSeriesCreator(theargs)
+            ts._outdir = temp_dir
+            todo = []
+            for rotation in [10.0, 20.0, 30.0]:
+                rotationdir = os.path.realpath(os.path.join(temp_dir,
+                                                            str(rotation)))
+                os.makedirs(rotationdir)
+                todo.append((rotation, rotationdir))
+
+            # one at a time in this thread with all the cores
+            done = list(ts._generate_tilt_series_for_rotations(todo))
+            self.assertEqual(done, [d for (r, d) in todo])
+            for (rotation, rotationdir) in todo:
+                f = open(os.path.join(rotationdir, 'generated'))
+                vals = f.read().split(' ')
+                f.close()
+                self.assertEqual(vals, [str(rotation), '8',
+                                        str(threading.current_thread().ident),
+                                        curdir])
+
+            # three at a time in worker threads with 2 cores each
+            ts._parallelrotations = 3
+            done = list(ts._generate_tilt_series_for_rotations(todo))
+            self.assertEqual(sorted(done), [d for (r, d) in todo])
+            for (rotation, rotationdir) in todo:
+                f = open(os.path.join(rotationdir, 'generated'))
+                vals = f.read().split(' ')
+                f.close()
+                self.assertEqual(vals[0], str(rotation))
+                self.assertEqual(vals[1], '2')
+                self.assertNotEqual(vals[2],
+                                    str(threading.current_thread().ident))
+                self.assertEqual(vals[3], curdir)
+            self.assertEqual(ts._cores, '8')
+            self.assertEqual(os.getcwd(), curdir)
+        finally:
+            os.chdir(curdir)
+            shutil.rmtree(temp_dir)
+
+    def test_prepare_resumes_from_checkpoints(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            theargs = self._get_valid_args_for_constructor()
+            theargs.outputdirectory = os.path.join(temp_dir, 'out')
+            theargs.inputmrcfile = os.path.join(temp_dir, 'input.mrc')
+            theargs.cores = 2
+            f = open(theargs.inputmrcfile, 'w')
+            f.write('volume')
+            f.close()
+            ts = FakeStagesTiltSeriesCreator(theargs)
+            ts.initialize()
+            ts.prepare_mrc_for_tiltseries_generation()
+            self.assertEqual(sorted(ts.ran), ['all_255', 'extend_mean',
+                                              'rawtlt', 'volume_marker',
+                                              'warpZ_inter_del'])
+            ctx = ts._get_prepared_context()
+            self.assertEqual(ctx.get_checkpoint_dir(),
+                             os.path.join(ts._preparedir,
+                                          TiltSeriesCreator.
+                                          CHECKPOINT_DIR_NAME))
+            self.assertEqual(len(os.listdir(ctx.get_checkpoint_dir())), 7)
+
+            # nothing changed
+            ts.ran = []
+            ts.prepare_mrc_for_tiltseries_generation()
+            self.assertEqual(ts.ran, [])
+
+            # half written file is redone, its output is the same so
+            # the stages after it are not
+            f = open(os.path.join(ts._preparedir, ts._extmeanmrc), 'w')
+            f.close()
+            ts.prepare_mrc_for_tiltseries_generation()
+            self.assertEqual(ts.ran, ['extend_mean'])
+
+            # marker parameter changed
+            ts.ran = []
+            ts._nummarkers = '30'
+            ts.prepare_mrc_for_tiltseries_generation()
+            self.assertEqual(ts.ran, ['volume_marker'])
+
+            # input volume changed
+            ts.ran = []
+            f = open(theargs.inputmrcfile, 'w')
+            f.write('new volume')
+            f.close()
+            ts.prepare_mrc_for_tiltseries_generation()
+            self.assertEqual(ts.ran, ['all_255'])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_create_tiltseries_redoes_incomplete_rotations(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            theargs = self._get_valid_args_for_constructor()
+            theargs.outputdirectory = os.path.join(temp_dir, 'out')
+            theargs.inputmrcfile = os.path.join(temp_dir, 'input.mrc')
+            theargs.numrotations = ''
+            theargs.rotationangles = '90'
+            theargs.cores = 2
+            f = open(theargs.inputmrcfile, 'w')
+            f.write('volume')
+            f.close()
+            ts = FakeStagesTiltSeriesCreator(theargs)
+            ts.initialize()
+            ts.prepare_mrc_for_tiltseries_generation()
+            ts.ran = []
+            ts.create_tiltseries()
+            self.assertEqual(sorted(ts.ran),
+                             ['2Dmarkers_all_fid 0.0',
+                              '2Dmarkers_all_fid 90.0',
+                              'clip 0.0', 'clip 90.0',
+                              'project_all 0.0', 'project_all 90.0',
+                              'rotate_3dmarkers 90.0', 'rotatevol 90.0',
+                              'volume_marker_position_all 0.0',
+                              'volume_marker_position_all 90.0'])
+            dirs = [os.path.join(ts._outdir, r + '_' +
+                                 TiltSeriesCreator.TILTSERIES_DIR_NAME)
+                    for r in ['0.0', '90.0']]
+            self.assertEqual(ts.jobs, dirs)
+            ctx = TiltSeriesContext(dirs[1], 2, rotation=90.0)
+            self.assertTrue(ts._get_rotation_pipeline(ctx).is_complete())
+            self.assertEqual(sorted(os.listdir(ctx.get_checkpoint_dir())),
+                             sorted([n + '.checkpoint.json' for n in
+                                     ['rotatevol', 'rotate_3dmarkers',
+                                      'project_all', 'clip',
+                                      'volume_marker_position_all',
+                                      '2Dmarkers_all_fid']]))
+
+            # complete rotations are skipped
+            ts.ran = []
+            ts.create_tiltseries()
+            self.assertEqual(ts.ran, [])
+            self.assertEqual(ts.jobs, dirs)
+
+            # half written stage is redone, its output is the same so
+            # the stage after it is not
+            os.remove(os.path.join(ctx.get_tracking_dir(),
+                                   TiltSeriesCreator.TWO_D_MARKERS_ALL_TXT))
+            self.assertFalse(ts._get_rotation_pipeline(ctx).is_complete())
+            ts.create_tiltseries()
+            self.assertEqual(ts.ran, ['volume_marker_position_all 90.0'])
+            self.assertEqual(ts.jobs, dirs)
+
+            # changed prepared marker volume and number of markers
+            # redo the stages that depend on them
+            ts.ran = []
+            ts._nummarkers = '30'
+            ts.prepare_mrc_for_tiltseries_generation()
+            f = open(os.path.join(ts._get_prepared_context().
+                                  get_marker_dir(), ts._markermrc), 'w')
+            f.write('other markers')
+            f.close()
+            ts.ran = []
+            ts.create_tiltseries()
+            self.assertEqual(sorted(ts.ran),
+                             ['project_all 0.0', 'rotate_3dmarkers 90.0',
+                              'rotatevol 90.0',
+                              'volume_marker_position_all 0.0',
+                              'volume_marker_position_all 90.0'])
+
+            # rotation directory is never copied from the prepared one
+            self.assertFalse(os.path.exists(os.path.join(dirs[0],
+                                                         ts._unimrc)))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_create_tiltseries_leaves_out_rotations_without_markers(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            theargs = self._get_valid_args_for_constructor()
+            theargs.outputdirectory = os.path.join(temp_dir, 'out')
+            theargs.inputmrcfile = os.path.join(temp_dir, 'input.mrc')
+            theargs.numrotations = ''
+            theargs.rotationangles = '45,90'
+            f = open(theargs.inputmrcfile, 'w')
+            f.write('volume')
+            f.close()
+            ts = FakeStagesTiltSeriesCreator(theargs)
+            ts.initialize()
+            ts.prepare_mrc_for_tiltseries_generation()
+            dirs = [os.path.join(ts._outdir, r + '_' +
+                                 TiltSeriesCreator.TILTSERIES_DIR_NAME)
+                    for r in ['0.0', '45.0', '90.0']]
+            missing = set()
+            ts._add_to_common_markers_filter = \
+                lambda path, filt: None if path in missing else path
+
+            # new rotation without markers
+            missing.add(dirs[1])
+            ts.create_tiltseries()
+            self.assertEqual(ts.jobs, [dirs[0], dirs[2]])
+
+            # complete rotation without markers
+            missing.clear()
+            missing.add(dirs[2])
+            ts.create_tiltseries()
+            self.assertEqual(ts.jobs, [dirs[0], dirs[1]])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_prepare_reuses_cache(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            theargs = self._get_valid_args_for_constructor()
+            theargs.inputmrcfile = os.path.join(temp_dir, 'input.mrc')
+            theargs.cachedir = os.path.join(temp_dir, 'cache')
+            theargs.cores = 2
+            f = open(theargs.inputmrcfile, 'w')
+            f.write('volume')
+            f.close()
+
+            theargs.outputdirectory = os.path.join(temp_dir, 'out1')
+            ts1 = FakeStagesTiltSeriesCreator(theargs)
+            self.assertEqual(ts1._cache.get_cache_dir(), theargs.cachedir)
+            ts1.initialize()
+            ts1.prepare_mrc_for_tiltseries_generation()
+            self.assertEqual(sorted(ts1.ran), ['all_255', 'extend_mean',
+                                               'rawtlt', 'volume_marker',
+                                               'warpZ_inter_del'])
+            # input hash for the cache key came from the checkpoint
+            self.assertEqual(ts1._inputmrchash, None)
+            extmeanmrc = os.path.join(ts1._preparedir, ts1._extmeanmrc)
+            self.assertEqual(os.stat(extmeanmrc).st_mode & 0o222, 0)
+
+            # different marker parameters reuse the cached outputs
+            # whose hashes are taken from the cache entry
+            theargs.outputdirectory = os.path.join(temp_dir, 'out2')
+            theargs.nummarkers = '30'
+            ts2 = FakeStagesTiltSeriesCreator(theargs)
+            ts2.initialize()
+            hashed = []
+            get_file_sha256 = util.get_file_sha256
+
+            def record_sha256(path):
+                hashed.append(os.path.basename(path))
+                return get_file_sha256(path)
+            util.get_file_sha256 = record_sha256
+            try:
+                ts2.prepare_mrc_for_tiltseries_generation()
+            finally:
+                util.get_file_sha256 = get_file_sha256
+            self.assertEqual(ts2.ran, ['volume_marker'])
+            self.assertEqual(hashed.count('input.mrc'), 1)
+            for name in [ts2._unimrc, ts2._extmeanmrc, ts2._rawtlt,
+                         ts2._warpz]:
+                self.assertFalse(name in hashed)
+            for name in [ts2._unimrc, ts2._extmeanmrc, ts2._rawtlt]:
+                f = open(os.path.join(ts2._preparedir, name))
+                self.assertTrue(len(f.read()) > 0)
+                f.close()
+                self.assertEqual(
+                    os.stat(os.path.join(ts1._preparedir, name)).st_ino,
+                    os.stat(os.path.join(ts2._preparedir, name)).st_ino)
+
+            # different tilt range only reuses the volume passes
+            theargs.outputdirectory = os.path.join(temp_dir, 'out3')
+            theargs.endtilt = '50'
+            ts3 = FakeStagesTiltSeriesCreator(theargs)
+            ts3.initialize()
+            ts3.prepare_mrc_for_tiltseries_generation()
+            self.assertEqual(sorted(ts3.ran), ['rawtlt', 'volume_marker',
+                                               'warpZ_inter_del'])
+            self.assertEqual(ts3._get_cache_key('all_255'),
+                             ts1._get_cache_key('all_255'))
+            self.assertNotEqual(ts3._get_cache_key('warpZ_inter_del'),
+                                ts1._get_cache_key('warpZ_inter_del'))
+
+            # stage missing from the cache replaces the hard link to the
+            # old entry instead of writing through it
+            key = ts2._get_cache_key('rawtlt')
+            shutil.rmtree(ts2._cache.get_entry_dir(key))
+            ctx = ts2._get_prepared_context()
+            os.remove(os.path.join(ctx.get_checkpoint_dir(),
+                                   'rawtlt.checkpoint.json'))
+            ts2.ran = []
+            ts2.prepare_mrc_for_tiltseries_generation()
+            self.assertEqual(ts2.ran, ['rawtlt'])
+            self.assertTrue(ts2._cache.has_entry(key))
+            self.assertNotEqual(
+                os.stat(os.path.join(ts1._preparedir, ts1._rawtlt)).st_ino,
+                os.stat(os.path.join(ts2._preparedir, ts2._rawtlt)).st_ino)
+
+            # missing input mrc file is reported by the hash
+            os.rename(theargs.inputmrcfile, theargs.inputmrcfile + '.x')
+            try:
+                ts2._get_input_mrc_hash(ts2._get_prepare_pipeline(
+                    ts2._get_prepared_context()).get_checkpoint())
+                self.fail('Expected IOError')
+            except IOError:
+                pass
+            os.rename(theargs.inputmrcfile + '.x', theargs.inputmrcfile)
+
+            # rerunning a stage without the cache does not write through
+            # the hard link into the cache entry
+            theargs.outputdirectory = os.path.join(temp_dir, 'out1')
+            theargs.nummarkers = '20'
+            theargs.endtilt = '60'
+            theargs.cachedir = ''
+            ts4 = FakeStagesTiltSeriesCreator(theargs)
+            ts4.initialize()
+            entry = os.path.join(ts1._cache.get_entry_dir(
+                ts1._get_cache_key('extend_mean')), '0')
+            self.assertEqual(os.stat(extmeanmrc).st_ino,
+                             os.stat(entry).st_ino)
+            os.remove(os.path.join(ts4._get_prepared_context().
+                                   get_checkpoint_dir(),
+                                   'extend_mean.checkpoint.json'))
+            ts4.prepare_mrc_for_tiltseries_generation()
+            self.assertEqual(ts4.ran, ['extend_mean'])
+            self.assertNotEqual(os.stat(extmeanmrc).st_ino,
+                                os.stat(entry).st_ino)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_generate_common_marker_files_cores_none(self):
+        theargs = self._get_valid_args_for_constructor()
+        theargs.cores = None
+        ts = TiltSeriesCreator(theargs)
+        filt = CommonByIndexMarkersListFilter([])
+        ts._generate_common_marker_files([], filt)
+
+        written = []
+        ts._write_common_marker_files_for_job = written.append
+        ts._generate_common_marker_files([('a',), ('b',)], filt)
+        self.assertEqual(written, [('a', filt), ('b', filt)])
+
+
 if __name__ == '__main__':
     sys.exit(unittest.main())
@@ -144,6 +144,45 @@ class TestUtil(unittest.TestCase):
         finally:
             shutil.rmtree(temp_dir)
 
+    def test_run_commands_with_cwd(self):
+        temp_dir = tempfile.mkdtemp()
+        curdir = os.getcwd()
+        try:
+            script = os.path.join(temp_dir, 'yo.py')
+            subdir = os.path.join(temp_dir, 'sub')
+            os.makedirs(subdir)
+
+            # create a small python script that writes the directory
+            # it was run in and its arguments to a relative path
+            f = open(script, 'w')
+            f.write('#! /usr/bin/env python\n\n')
+            f.write('import os\n')
+            f.write('import sys\n')
+            f.write('f = open("where.txt", "w")\n')
+            f.write('f.write(os.getcwd() + " " + " ".join(sys.argv[1:]))\n')
+            f.write('f.close()\n')
+            f.flush()
+            f.close()
+            os.chmod(script, stat.S_IRWXU)
+
+            ecode, out, err = util.run_external_command(script + ' a',
+                                                        cwd=subdir)
+            self.assertEqual(ecode, 0)
+            f = open(os.path.join(subdir, 'where.txt'))
+            self.assertEqual(f.read(), os.path.realpath(subdir) + ' a')
+            f.close()
+            self.assertEqual(os.getcwd(), curdir)
+
+            ecode, out, err = util.run_mpiexec_command('foo', script, 2,
+                                                       cwd=temp_dir)
+            self.assertEqual(ecode, 0)
+            f = open(os.path.join(temp_dir, 'where.txt'))
+            self.assertEqual(f.read(), os.path.realpath(temp_dir) +
+                             ' -np 2 foo')
+            f.close()
+        finally:
+            shutil.rmtree(temp_dir)
+
     def test_run_mpiexec_command_fail_with_cores_not_set(self):
         temp_dir = tempfile.mkdtemp()
         try:
@@ -215,5 +254,30 @@ class TestUtil(unittest.TestCase):
         self.assertEqual(rots[0], 1.0)
         self.assertEqual(rots[178], 179.0)
 
+    def test_get_core_budget(self):
+        self.assertEqual(util.get_core_budget(None, 4), (1, 1))
+        self.assertEqual(util.get_core_budget('1', 4), (1, 1))
+        self.assertEqual(util.get_core_budget(8, 1), (1, 8))
+        self.assertEqual(util.get_core_budget(8, 0), (1, 8))
+        self.assertEqual(util.get_core_budget('8', 4), (4, 2))
+        self.assertEqual(util.get_core_budget(8, 3), (3, 2))
+        self.assertEqual(util.get_core_budget(3, 12), (3, 1))
+        self.assertEqual(util.get_core_budget(0, 2), (1, 1))
+
+    def test_get_file_sha256(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(temp_dir, 'foo')
+            f = open(path, 'w')
+            f.write('hello')
+            f.close()
+            expected = ('2cf24dba5fb0a30e26e83b2ac5b9e29e'
+                        '1b161e5c1fa7425e73043362938b9824')
+            self.assertEqual(util.get_file_sha256(path), expected)
+            self.assertEqual(util.get_file_sha256(path, chunksize=2),
+                             expected)
+        finally:
+            shutil.rmtree(temp_dir)
+
 if __name__ == '__main__':
     sys.exit(unittest.main())